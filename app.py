@@ -1,41 +1,176 @@
 """Flask App for Flask Cafe."""
 
 import os
+import time
 
-from flask import Flask, render_template, redirect, flash, session, g, jsonify, request
-from flask_debugtoolbar import DebugToolbarExtension
+import click
+from flask import Blueprint, Flask, render_template, redirect, flash, session, g, jsonify, request, abort
+from jinja2 import FileSystemBytecodeCache
 from sqlalchemy.exc import IntegrityError
-from models import db, connect_db, Cafe, City, User
+from models import db, connect_db, Cafe, CafeCard, City, Like, User
 
 from forms import CafeForm, SignupForm, LoginForm, ProfileEditForm, CSRFProtection
+from assets import init_assets
+from autocomplete import autocomplete
+from cafe_cards import (
+    count_likes, init_cafe_cards, write_cafe_card, write_city_cards)
+from city_counts import city_counts
+from compression import init_compression
+from config import get_config
+from events import on_change, on_write
+from health import configure_pool, init_health
+from images import init_images, refresh_in_background
+from index_report import init_index_report
+from invalidation import invalidation_bus
+from like_buffer import like_buffer, record_like_changes
+from mapping import save_map_in_background
+from page_cache import page_cache
+from recommendations import recommender
+from replicas import replicas, read_replica, mark_write
+from sitemap import init_sitemap, sitemap_cache
+from stale import stale_cache, serve_stale
+from traffic import traffic_recorder
+from trending import trending
+
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), "migrations")
+
+bp = Blueprint("cafes", __name__)
+
+
+def create_app(config=None, **settings):
+    """Create Flask Cafe app.
+
+    config is a config name or class (see config.py); settings override it.
+    """
+
+    started = time.perf_counter()
+
+    app = Flask(__name__)
+
+    if config is None or isinstance(config, str):
+        config = get_config(config)
+
+    app.config.from_object(config)
+    app.config.update(settings)
+
+    if app.config.get("DEBUG_TB_ENABLED", app.debug):
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    configure_pool(app)
+    connect_db(app)
+
+    # only the CLI (flask db ...) needs migrations, and alembic is slow to
+    # import, so web workers skip it
+    if click.get_current_context(silent=True) is not None:
+        init_migrate(app)
+
+    replicas.init_app(app)
+    like_buffer.init_app(app)
+    page_cache.init_app(app)
+    stale_cache.init_app(app)
+    invalidation_bus.init_app(app)
+    traffic_recorder.init_app(app)
+    init_assets(app)
+    init_cafe_cards(app)
+    init_compression(app)
+    init_images(app)
+    init_health(app)
+    init_index_report(app)
+    init_sitemap(app)
+    init_templates(app)
+
+    app.register_blueprint(bp)
+
+    os.register_at_fork(after_in_child=lambda: reinit_after_fork(app))
 
+    app.logger.info("Created app in %.3fs", time.perf_counter() - started)
+    return app
 
-app = Flask(__name__)
 
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
-    "DATABASE_URL", 'postgresql:///flask_cafe')
-app.config['SECRET_KEY'] = os.environ.get("FLASK_SECRET_KEY", "shhhh")
-app.config['SQLALCHEMY_ECHO'] = True
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+def init_migrate(app):
+    """Set up Flask-Migrate, for `flask db` and flask_migrate.upgrade()."""
 
-toolbar = DebugToolbarExtension(app)
+    from flask_migrate import Migrate
+    Migrate(app, db, directory=MIGRATIONS_DIR)
+
+
+def init_templates(app):
+    """Cache compiled templates on disk, and precompile them if configured."""
+
+    directory = app.config["JINJA_BYTECODE_CACHE_DIR"] or os.path.join(
+        app.instance_path, "jinja_cache")
+    os.makedirs(directory, exist_ok=True)
+
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+
+    if app.config["PRECOMPILE_TEMPLATES"]:
+        compile_templates(app)
+
+    @app.cli.command("compile-templates")
+    def compile_templates_command():
+        """Compile all templates into the bytecode cache."""
+
+        count = compile_templates(app)
+        click.echo(f"Compiled {count} templates into {directory}")
+
+
+def compile_templates(app):
+    """Load every template, so workers forked later share them.
+
+    Returns number of templates.
+    """
+
+    names = app.jinja_env.list_templates()
+
+    for name in names:
+        app.jinja_env.get_template(name)
+
+    return len(names)
+
+
+def reinit_after_fork(app):
+    """Drop connections & restart threads inherited from the parent process.
+
+    Lets the app be created before forking (e.g. gunicorn --preload): the
+    child must not share the parent's sockets, and threads don't survive
+    the fork.
+    """
+
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+    replicas.after_fork()
+    like_buffer.after_fork()
+    stale_cache.after_fork()
+    invalidation_bus.after_fork()
+    traffic_recorder.after_fork()
 
-connect_db(app)
 
 #######################################
 # auth & auth routes
 
 CURR_USER_KEY = "curr_user"
+# {cafe id: liked} of this user's likes still in a like buffer
+PENDING_LIKES_KEY = "pending_likes"
 NOT_LOGGED_IN_MSG = "You are not logged in."
 
+LIKED_CAFES_PER_PAGE = 20
+# profiles with more likes show this many, plus "+"
+LIKED_COUNT_LIMIT = 1000
+TRENDING_LIMIT = 10
+AUTOCOMPLETE_LIMIT = 10
 
-@app.before_request
+
+@bp.before_app_request
 def add_csrf_from_to_g():
 
     g.csrf_form = CSRFProtection()
 
 
-@app.before_request
+@bp.before_app_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
@@ -59,10 +194,184 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
+#######################################
+# change events
+
+
+@on_write(Cafe)
+def update_cafe_card(event):
+    """Write the cafe's card along with the cafe."""
+
+    write_cafe_card(event)
+
+
+@on_write(City, columns={"name", "state"}, actions=("update",))
+def update_city_cards(event):
+    """Write a renamed city into its cafes' cards."""
+
+    write_city_cards(event)
+
+
+@on_change(Cafe, columns={"address", "city_code"}, actions=("insert", "update"))
+def update_cafe_map(event):
+    """Save a new map for a cafe when its address or city changes.
+
+    The map is fetched in the background, not during the commit.
+    """
+
+    with db.engine.connect() as conn:
+        city = conn.execute(
+            db.select(City.name, City.state)
+            .where(City.code == event.values["city_code"])
+        ).one()
+
+    save_map_in_background(
+        event.id, event.values["address"], f'{city.name}, {city.state}')
+
+
+@on_change(Cafe, columns={"city_code"}, actions=("update",))
+def move_trending_cafe(event):
+    """Move a cafe to its new city's trending list."""
+
+    trending.move_cafe(event.id, event.values["city_code"])
+
+
+@on_change(Cafe, actions=("delete",))
+def drop_trending_cafe(event):
+    """Take a deleted cafe out of trending."""
+
+    trending.remove_cafe(event.id)
+
+
+@on_change(Cafe, columns={"image_url"}, actions=("insert", "update"))
+@on_change(User, columns={"image_url"}, actions=("insert", "update"))
+def mirror_new_image(event):
+    """Start mirroring a cafe or user's new image."""
+
+    kind = "cafe" if event.model is Cafe else "user"
+    refresh_in_background(kind, event.id, event.values["image_url"])
+
+
+@on_change(Cafe, columns={"city_code"})
+def update_city_counts(event):
+    """Keep per-city cafe counts current."""
+
+    city_counts.apply(event)
+
+
+@on_change(City)
+def reload_city_counts(event):
+    """Reload per-city cafe counts when cities change."""
+
+    city_counts.invalidate()
+
+
+@on_change(Cafe, columns={"name", "city_code"})
+def update_autocomplete(event):
+    """Keep the cafe name index current."""
+
+    autocomplete.apply(event)
+
+
+@on_change(City)
+def reload_autocomplete(event):
+    """Reload the cafe name index when cities change."""
+
+    autocomplete.invalidate()
+
+
+@on_change(Cafe)
+@on_change(City)
+def expire_cached_pages(event):
+    """Expire cached pages, which may show the changed cafe or city."""
+
+    page_cache.clear()
+
+
+@on_change(Cafe)
+def expire_cafe_sitemap(event):
+    """Expire the sitemap shard and feed that list the changed cafe."""
+
+    sitemap_cache.expire_cafe(event.id)
+
+
+@on_change(City)
+def expire_pages_sitemap(event):
+    """Expire sitemaps listing city pages."""
+
+    sitemap_cache.expire("sitemap", "pages")
+
+
+@on_change(Cafe)
+@on_change(City)
+@on_change(User)
+def publish_change(event):
+    """Tell other workers to drop their cached copies of the change."""
+
+    invalidation_bus.publish(event.model.__tablename__, event.id)
+
+
+@invalidation_bus.subscribe("cafes")
+@invalidation_bus.subscribe("cities")
+def expire_remote_change(id):
+    """Drop caches that may show a cafe or city another worker changed."""
+
+    autocomplete.invalidate()
+    city_counts.invalidate()
+    page_cache.clear()
+    sitemap_cache.clear()
+
+
+@invalidation_bus.subscribe("cafes")
+def update_remote_trending_cafe(id):
+    """Move or drop a cafe another worker moved to another city or deleted.
+
+    Trending only depends on likes and on each cafe's city, so other cafe
+    changes leave it alone.
+    """
+
+    if id is None:
+        trending.reset()
+        return
+
+    city_code = db.session.scalar(
+        db.select(Cafe.city_code).where(Cafe.id == id))
+
+    if city_code is None:
+        trending.remove_cafe(id)
+    else:
+        trending.move_cafe(id, city_code)
+
+
+@invalidation_bus.subscribe("likes")
+def apply_remote_like(id):
+    """Count a like or unlike another worker wrote, as the database has it."""
+
+    if id is None:
+        recommender.reset()
+        trending.reset()
+        return
+
+    user_id, cafe_id = id
+    like = db.session.execute(
+        db.select(Cafe.city_code, Like.created_at)
+        .join(Cafe, Cafe.id == Like.cafe_id)
+        .where(Like.user_id == user_id, Like.cafe_id == cafe_id)
+    ).one_or_none()
+
+    if like is None:
+        recommender.remove_like(user_id, cafe_id)
+        trending.remove_like(user_id, cafe_id)
+    else:
+        recommender.add_like(user_id, cafe_id)
+        trending.add_like(user_id, cafe_id, like.city_code, like.created_at)
+
+
 #######################################
 # homepage
 
-@app.get("/")
+@bp.get("/")
+@page_cache.cached
 def homepage():
     """Show homepage."""
 
@@ -73,33 +382,166 @@ def homepage():
 # cafe routes
 
 
-@app.get('/cafes')
+@bp.get('/cafes')
+@page_cache.cached(args=("city",))
+@read_replica
+@serve_stale
 def cafe_list():
-    """Return list of all cafes."""
+    """Return list of all cafes, or those in the city given by ?city=."""
+
+    return render_cafe_list(request.args.get('city') or None)
+
+
+@bp.get('/cities/<city_code>')
+@page_cache.cached
+@read_replica
+@serve_stale
+def city_cafe_list(city_code):
+    """Return list of cafes in a city."""
+
+    return render_cafe_list(city_code)
+
+
+def load_cafe_list(city_code=None):
+    """Return (cafe cards, city, [(code, name, count), ...]) for cafe list.
+
+    Cards hold all the list shows, so they can render without a session.
+    """
+
+    city = None
+    query = db.select(CafeCard).order_by(CafeCard.name)
+
+    if city_code:
+        city = City.query.get_or_404(city_code)
+        query = query.where(CafeCard.city_code == city_code)
 
-    cafes = Cafe.query.order_by('name').all()
+    return db.session.scalars(query).all(), city, city_counts.get()
+
+
+def render_cafe_list(city_code=None):
+    """Render list of cafes, optionally only those in city_code."""
+
+    cafes, city, cities = stale_cache.fetch(
+        ("cafe_list", city_code), lambda: load_cafe_list(city_code))
 
     return render_template(
         'cafe/list.html',
         cafes=cafes,
+        city=city,
+        cities=cities,
+        total=sum(count for code, name, count in cities),
         form=g.csrf_form
     )
 
 
-@app.get('/cafes/<int:cafe_id>')
+def get_trending_cafes():
+    """Return [(id, name, score), ...] of trending cafes.
+
+    Uses city & limit query params.
+    """
+
+    limit = request.args.get('limit', TRENDING_LIMIT, type=int)
+
+    top = trending.top(
+        n=max(1, min(limit, 100)),
+        city_code=request.args.get('city') or None
+    )
+
+    if not top:
+        return []
+
+    names = dict(db.session.execute(
+        db.select(Cafe.id, Cafe.name).where(Cafe.id.in_([id for id, _ in top]))
+    ).all())
+
+    return [(id, names[id], score) for id, score in top if id in names]
+
+
+@bp.get('/cafes/trending')
+def trending_cafes():
+    """Show cafes with the most recent likes."""
+
+    return render_template(
+        'cafe/trending.html',
+        cafes=get_trending_cafes(),
+        cities=CafeForm.get_city_choices(),
+        city_code=request.args.get('city'),
+        form=g.csrf_form
+    )
+
+
+@bp.get('/api/cafes/trending')
+def handle_trending_query():
+    """Return JSON {cafes: [{id, name, score}, ...]} of trending cafes."""
+
+    cafes = [
+        {"id": id, "name": name, "score": round(score, 3)}
+        for id, name, score in get_trending_cafes()
+    ]
+
+    return jsonify(cafes=cafes)
+
+
+@bp.get('/api/cafes/autocomplete')
+def handle_autocomplete_query():
+    """Return JSON {cafes: [{id, name, city, likes}, ...]} of cafes whose name,
+    or city's name, has a word starting with ?q=; most liked first."""
+
+    cafes = [
+        {"id": id, "name": name, "city": city, "likes": likes}
+        for id, name, city, likes in autocomplete.search(
+            request.args.get('q', ''),
+            request.args.get('limit', AUTOCOMPLETE_LIMIT, type=int))
+    ]
+
+    return jsonify(cafes=cafes)
+
+
+@bp.get('/cafes/<int:cafe_id>')
+@page_cache.cached
+@read_replica
+@serve_stale
 def cafe_detail(cafe_id):
-    """Show detail for cafe."""
+    """Show detail for cafe, with whether current user likes it."""
 
-    cafe = Cafe.query.get_or_404(cafe_id)
+    user_id = g.user.id if g.user else None
+
+    settle_pending_likes()
+
+    cafe, similar_cafes = stale_cache.fetch(
+        ("cafe_detail", cafe_id, user_id),
+        lambda: load_cafe_detail(cafe_id, user_id))
 
     return render_template(
         'cafe/detail.html',
         cafe=cafe,
+        similar_cafes=similar_cafes,
         form=g.csrf_form
     )
 
 
-@app.route('/cafes/add', methods=["GET", "POST"])
+def load_cafe_detail(cafe_id, user_id=None):
+    """Return (CafeDetail, [(id, name) of similar cafes]); 404 if no cafe."""
+
+    cafe = Cafe.get_detail(cafe_id, user_id=user_id)
+
+    if cafe is None:
+        abort(404)
+
+    similar_ids = [id for id, score in recommender.similar(cafe_id)]
+    similar_cafes = []
+
+    if similar_ids:
+        names = dict(db.session.execute(
+            db.select(CafeCard.id, CafeCard.name)
+            .where(CafeCard.id.in_(similar_ids))
+        ).all())
+        similar_cafes = [(id, names[id]) for id in similar_ids if id in names]
+
+    return cafe, similar_cafes
+
+
+@bp.route('/cafes/add', methods=["GET", "POST"])
 def handle_add_cafe():
     """If GET, shows add cafe form. If POST, handles form submission."""
 
@@ -121,12 +563,7 @@ def handle_add_cafe():
         )
 
         db.session.add(cafe)
-        db.session.flush()
-
-        cafe.save_map()
-        
         db.session.commit()
-    
 
         flash(f"{cafe.name} added", "success")
 
@@ -136,7 +573,7 @@ def handle_add_cafe():
         return render_template('cafe/add-form.html', form=form)
 
 
-@app.route('/cafes/<int:cafe_id>/edit', methods=["GET", "POST"])
+@bp.route('/cafes/<int:cafe_id>/edit', methods=["GET", "POST"])
 def handle_edit_cafe(cafe_id):
     """If GET, shows edit cafe form. If POST, handles form submission."""
 
@@ -159,18 +596,15 @@ def handle_edit_cafe(cafe_id):
     form.city_code.choices = CafeForm.get_city_choices()
 
     if form.validate_on_submit():
-        cafe.name = form.name.data,
-        cafe.description = form.description.data,
-        cafe.url = form.url.data,
-        cafe.address = form.address.data,
-        cafe.city_code = form.city_code.data,
+        cafe.name = form.name.data
+        cafe.description = form.description.data
+        cafe.url = form.url.data
+        cafe.address = form.address.data
+        cafe.city_code = form.city_code.data
         cafe.image_url = form.image_url.data or Cafe.image_url.default.arg
 
-        
         db.session.commit()
 
-        cafe.save_map()
-
         flash(f"{cafe.name} edited", "success")
 
         return redirect(f'/cafes/{cafe.id}')
@@ -182,7 +616,7 @@ def handle_edit_cafe(cafe_id):
 # user routes
 
 
-@app.route('/signup', methods=["GET", "POST"])
+@bp.route('/signup', methods=["GET", "POST"])
 def handle_signup():
     """If GET, display signup form.
 
@@ -223,7 +657,7 @@ def handle_signup():
         return render_template('auth/signup-form.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@bp.route('/login', methods=["GET", "POST"])
 def handle_login():
     """If GET, display login form."""
 
@@ -247,7 +681,7 @@ def handle_login():
     return render_template('auth/login-form.html', form=form)
 
 
-@app.post('/logout')
+@bp.post('/logout')
 def handle_logout():
     """Logs out current user and removes user id from session.
     Redirects to hompage.
@@ -265,9 +699,13 @@ def handle_logout():
     return redirect('/')
 
 
-@app.get('/profile')
+@bp.get('/profile')
+@read_replica
 def show_user_profile():
-    """Show user profile page."""
+    """Show user profile page, with a page of the cafes they like.
+
+    Pages of liked cafes are chosen with the after query param.
+    """
 
     if not g.user:
         flash(NOT_LOGGED_IN_MSG, "danger")
@@ -275,10 +713,25 @@ def show_user_profile():
 
     user = g.user
 
-    return render_template('profile/detail.html', user=user, form=g.csrf_form)
+    settle_pending_likes()
+
+    liked_cafes, next_after = user.get_liked_cafes_page(
+        after=request.args.get('after', type=int),
+        per_page=LIKED_CAFES_PER_PAGE
+    )
+
+    return render_template(
+        'profile/detail.html',
+        user=user,
+        liked_count=user.count_liked_cafes(up_to=LIKED_COUNT_LIMIT + 1),
+        liked_count_limit=LIKED_COUNT_LIMIT,
+        liked_cafes=liked_cafes,
+        next_after=next_after,
+        form=g.csrf_form
+    )
 
 
-@app.route('/profile/edit', methods=["GET", "POST"])
+@bp.route('/profile/edit', methods=["GET", "POST"])
 def handle_edit_profile():
     """If GET, display edit profile form.
     IF POST, update db with entered information.
@@ -326,7 +779,31 @@ def handle_edit_profile():
 # like routes
 
 
-@app.get('/api/likes')
+def remember_pending_like(cafe_id, liked, stamp):
+    """Note a buffered like in the session, for settle_pending_likes()."""
+
+    pending = session.get(PENDING_LIKES_KEY, {})
+    session[PENDING_LIKES_KEY] = {**pending, str(cafe_id): [liked, stamp]}
+
+
+def settle_pending_likes():
+    """Write this user's buffered likes before reading their likes back.
+
+    The worker buffering them may not be this one, so the session carries
+    them here.
+    """
+
+    pending = session.pop(PENDING_LIKES_KEY, None)
+
+    if pending and g.user:
+        like_buffer.settle(
+            g.user.id,
+            {int(cafe_id): (liked, stamp)
+             for cafe_id, (liked, stamp) in pending.items()})
+
+
+@bp.get('/api/likes')
+@read_replica
 def handle_like_query():
     if not g.user:
         error_msg = {"error": "Not logged in"}
@@ -334,6 +811,8 @@ def handle_like_query():
 
     cafe_id = int(request.args['cafe_id'])
 
+    settle_pending_likes()
+
     for cafe in g.user.liked_cafes:
 
         if cafe.id == cafe_id:
@@ -342,7 +821,7 @@ def handle_like_query():
     return jsonify({"likes": False})
 
 
-@app.post('/api/like')
+@bp.post('/api/like')
 def handle_like_cafe():
     if not g.user:
         error_msg = {"error": "Not logged in"}
@@ -351,14 +830,24 @@ def handle_like_cafe():
     cafe_id = int(request.json['cafe_id'])
 
     cafe = Cafe.query.get(cafe_id)
-    g.user.liked_cafes.append(cafe)
 
-    db.session.commit()
+    if like_buffer.enabled:
+        # recommender & trending are updated when the buffer writes it
+        stamp = like_buffer.record(g.user.id, cafe.id, liked=True)
+        remember_pending_like(cafe.id, True, stamp)
+        mark_write()
+    else:
+        g.user.liked_cafes.append(cafe)
+        count_likes(db.session, {cafe.id: 1})
+        db.session.commit()
+
+        record_like_changes(
+            [(g.user.id, cafe.id)], [], {cafe.id: cafe.city_code})
 
     return jsonify(liked=cafe.id)
 
 
-@app.post('/api/unlike')
+@bp.post('/api/unlike')
 def handle_unlike_cafe():
     if not g.user:
         error_msg = {"error": "Not logged in"}
@@ -367,8 +856,16 @@ def handle_unlike_cafe():
     cafe_id = int(request.json['cafe_id'])
 
     cafe = Cafe.query.get(cafe_id)
-    g.user.liked_cafes.remove(cafe)
 
-    db.session.commit()
+    if like_buffer.enabled:
+        stamp = like_buffer.record(g.user.id, cafe.id, liked=False)
+        remember_pending_like(cafe.id, False, stamp)
+        mark_write()
+    else:
+        g.user.liked_cafes.remove(cafe)
+        count_likes(db.session, {cafe.id: -1})
+        db.session.commit()
+
+        record_like_changes([], [(g.user.id, cafe.id)], {})
 
     return jsonify(unliked=cafe.id)
@@ -0,0 +1,28 @@
+"""ASGI entry point: async like API, with the Flask app for everything else.
+
+Run with:
+
+    uvicorn asgi:application --workers 4
+"""
+
+from asgiref.wsgi import WsgiToAsgi
+
+from app import create_app
+from like_api import init_like_api, like_api, ROUTES
+
+
+app = create_app()
+init_like_api(app)
+
+flask_app = WsgiToAsgi(app)
+
+ASYNC_PATHS = {path for method, path in ROUTES}
+
+
+async def application(scope, receive, send):
+    """Send like API requests (and lifespan events) to the async handlers."""
+
+    if scope["type"] == "lifespan" or scope.get("path") in ASYNC_PATHS:
+        await like_api(scope, receive, send)
+    else:
+        await flask_app(scope, receive, send)
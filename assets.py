@@ -0,0 +1,194 @@
+"""Fingerprinted, precompressed static assets."""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+import brotli
+import click
+from flask import abort, redirect, request, send_file
+from flask.helpers import get_root_path
+
+
+STATIC_DIR = os.path.join(get_root_path(__name__), "static")
+MANIFEST_PATH = os.path.join(STATIC_DIR, "manifest.json")
+
+# generated at runtime, so left out of the build manifest
+SKIP_DIRS = ("mirror", "maps")
+
+COMPRESSIBLE = (".js", ".css", ".svg", ".json", ".txt", ".html")
+
+# sidecar suffix for each content-encoding, in order of preference
+ENCODINGS = (
+    ("br", ".br"),
+    ("gzip", ".gz"),
+)
+
+ONE_YEAR = 60 * 60 * 24 * 365
+
+HASHED_NAME = re.compile(
+    r"^(?P<stem>.+)\.(?P<digest>[0-9a-f]{10})(?P<ext>\.[^./]+)$")
+
+_manifest = None
+_digests = {}
+
+
+def file_digest(path):
+    """Return short content hash for file, cached until it is modified."""
+
+    mtime = os.stat(path).st_mtime_ns
+    cached = _digests.get(path)
+
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with open(path, "rb") as f:
+        digest = hashlib.sha1(f.read()).hexdigest()[:10]
+
+    _digests[path] = (mtime, digest)
+    return digest
+
+
+def _load_manifest():
+    global _manifest
+
+    if _manifest is None:
+        try:
+            with open(MANIFEST_PATH) as f:
+                _manifest = json.load(f)
+        except FileNotFoundError:
+            _manifest = {}
+
+    return _manifest
+
+
+def _hashed_name(filename, digest):
+    stem, ext = os.path.splitext(filename)
+    return f"{stem}.{digest}{ext}"
+
+
+def asset_url(filename):
+    """Return fingerprinted URL for file in static directory.
+
+    Files listed in the build manifest use the built name; anything else
+    (like maps saved at runtime) is hashed on first use. Missing files fall
+    back to their plain /static URL.
+    """
+
+    hashed = _load_manifest().get(filename)
+    if hashed:
+        return f"/assets/{hashed}"
+
+    path = os.path.join(STATIC_DIR, filename)
+    if not os.path.isfile(path):
+        return f"/static/{filename}"
+
+    return f"/assets/{_hashed_name(filename, file_digest(path))}"
+
+
+def serve_asset(filename):
+    """Serve fingerprinted asset, using a precompressed copy if accepted."""
+
+    match = HASHED_NAME.match(filename)
+    if not match:
+        abort(404)
+
+    source = match["stem"] + match["ext"]
+    path = os.path.abspath(os.path.join(STATIC_DIR, source))
+
+    if not path.startswith(STATIC_DIR + os.sep) or not os.path.isfile(path):
+        abort(404)
+
+    digest = file_digest(path)
+    if digest != match["digest"]:
+        return redirect(f"/assets/{_hashed_name(source, digest)}")
+
+    mimetype = None
+    encoding = None
+
+    for name, suffix in ENCODINGS:
+        sidecar = path + suffix
+        if (name in request.accept_encodings
+                and os.path.isfile(sidecar)
+                and os.stat(sidecar).st_mtime >= os.stat(path).st_mtime):
+            encoding = name
+            mimetype = mimetypes.guess_type(path)[0]
+            path = sidecar
+            break
+
+    resp = send_file(path, mimetype=mimetype, max_age=ONE_YEAR,
+                     conditional=True)
+    resp.cache_control.public = True
+    resp.cache_control.immutable = True
+
+    if encoding:
+        resp.headers["Content-Encoding"] = encoding
+
+    resp.vary.add("Accept-Encoding")
+    return resp
+
+
+def _static_files():
+    for root, dirs, files in os.walk(STATIC_DIR):
+        rel_root = os.path.relpath(root, STATIC_DIR)
+        if rel_root.split(os.sep)[0] in SKIP_DIRS:
+            continue
+
+        for name in files:
+            if name.endswith((".gz", ".br")) or name == "manifest.json":
+                continue
+            yield os.path.normpath(os.path.join(rel_root, name))
+
+
+def build_assets():
+    """Write manifest and gzip/brotli copies of compressible static files.
+
+    Returns the manifest.
+    """
+
+    global _manifest
+
+    manifest = {}
+
+    for filename in sorted(_static_files()):
+        path = os.path.join(STATIC_DIR, filename)
+        manifest[filename.replace(os.sep, "/")] = _hashed_name(
+            filename.replace(os.sep, "/"), file_digest(path))
+
+        if not filename.endswith(COMPRESSIBLE):
+            continue
+
+        with open(path, "rb") as f:
+            data = f.read()
+
+        with open(path + ".gz", "wb") as f:
+            f.write(gzip.compress(data, compresslevel=9, mtime=0))
+
+        with open(path + ".br", "wb") as f:
+            f.write(brotli.compress(data, quality=11))
+
+    with open(MANIFEST_PATH, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    _manifest = manifest
+    return manifest
+
+
+def init_assets(app):
+    """Register asset route, template helper and build command on app."""
+
+    app.add_url_rule(
+        "/assets/<path:filename>",
+        endpoint="serve_asset",
+        view_func=serve_asset)
+    app.jinja_env.globals["asset_url"] = asset_url
+
+    @app.cli.command("build-assets")
+    def build_assets_command():
+        """Fingerprint and precompress static files."""
+
+        manifest = build_assets()
+        click.echo(f"Built {len(manifest)} assets into {MANIFEST_PATH}")
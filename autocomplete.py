@@ -0,0 +1,207 @@
+"""Prefix search over cafe and city names, for autocompleting cafes."""
+
+import bisect
+import heapq
+import re
+import threading
+import unicodedata
+
+from models import db, Cafe, City
+from recommendations import recommender
+
+
+# most results one search() returns
+MAX_LIMIT = 50
+
+
+def normalize(text):
+    """Return text lowercased, without accents, as space-separated words."""
+
+    text = unicodedata.normalize("NFKD", text.casefold())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(re.findall(r"\w+", text))
+
+
+def word_keys(text):
+    """Return keys matching text from the start of each of its words.
+
+    "The Blue Door" -> ["the blue door", "blue door", "door"]
+    """
+
+    words = normalize(text).split(" ")
+    return [" ".join(words[i:]) for i in range(len(words)) if words[i]]
+
+
+class CafeAutocomplete:
+    """Sorted arrays of name keys, searched by prefix with bisect.
+
+    A cafe matches when a word of its name, or of its city's name, starts
+    with the query (so "blue" and "san fr" find "The Blue Door" in San
+    Francisco). Matches are ranked by like count.
+
+    Loaded with two queries on first use, then kept current by apply()ing
+    cafe change events; city changes invalidate() it. Every apply() or
+    invalidate() bumps a version, and a load is only kept if no change
+    landed while its queries ran; otherwise it would miss that change.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = 0
+        self.invalidate()
+
+    def invalidate(self):
+        """Forget the index; it's reloaded on next use."""
+
+        with self._lock:
+            self._version += 1
+            self._loaded = False
+            # sorted [(key, cafe id)] and [(key, city code)]
+            self._cafe_keys = []
+            self._city_keys = []
+            # cafe id -> (name, city code)
+            self._cafes = {}
+            # city code -> (name, set of cafe ids)
+            self._cities = {}
+
+    def load(self):
+        """Load index; return it as (cafes, cities, cafe keys, city keys).
+
+        The index is only kept if nothing changed while it loaded, but is
+        returned either way.
+        """
+
+        with self._lock:
+            version = self._version
+
+        cafes = db.session.execute(
+            db.select(Cafe.id, Cafe.name, Cafe.city_code)).all()
+        cities = db.session.execute(db.select(City.code, City.name)).all()
+
+        index = self._build(cafes, cities)
+
+        with self._lock:
+            if self._version == version:
+                (self._cafes, self._cities,
+                 self._cafe_keys, self._city_keys) = index
+                self._loaded = True
+
+        return index
+
+    @staticmethod
+    def _build(cafes, cities):
+        """Return index of [(id, name, city code)] & [(code, name)] rows."""
+
+        city_index = {code: (name, set()) for code, name in cities}
+        city_keys = sorted(
+            (key, code) for code, name in cities for key in word_keys(name))
+
+        cafe_index = {}
+        cafe_keys = []
+        for id, name, city_code in cafes:
+            cafe_index[id] = (name, city_code)
+            if city_code in city_index:
+                city_index[city_code][1].add(id)
+            cafe_keys.extend((key, id) for key in word_keys(name))
+        cafe_keys.sort()
+
+        return cafe_index, city_index, cafe_keys, city_keys
+
+    def _add(self, id, name, city_code):
+        self._cafes[id] = (name, city_code)
+        if city_code in self._cities:
+            self._cities[city_code][1].add(id)
+
+        for key in word_keys(name):
+            bisect.insort(self._cafe_keys, (key, id))
+
+    def _remove(self, id):
+        name, city_code = self._cafes.pop(id, (None, None))
+        if name is None:
+            return
+
+        if city_code in self._cities:
+            self._cities[city_code][1].discard(id)
+
+        for key in word_keys(name):
+            i = bisect.bisect_left(self._cafe_keys, (key, id))
+            if i < len(self._cafe_keys) and self._cafe_keys[i] == (key, id):
+                del self._cafe_keys[i]
+
+    def apply(self, event):
+        """Update index for a cafe insert, delete, rename or move."""
+
+        with self._lock:
+            self._version += 1
+
+            if not self._loaded:
+                return
+
+            # columns expired before the change aren't in values
+            name, city_code = self._cafes.get(event.id, (None, None))
+            name = event.values.get("name", name)
+            city_code = event.values.get("city_code", city_code)
+
+            self._remove(event.id)
+            if event.action != "delete" and name is not None:
+                self._add(event.id, name, city_code)
+
+    @staticmethod
+    def _prefixed(keys, prefix):
+        """Yield values of (key, value) pairs whose key starts with prefix."""
+
+        i = bisect.bisect_left(keys, (prefix,))
+
+        while i < len(keys) and keys[i][0].startswith(prefix):
+            yield keys[i][1]
+            i += 1
+
+    @classmethod
+    def _match(cls, index, prefix):
+        """Return [(id, name, city name)] of cafes in index matching prefix."""
+
+        cafes, cities, cafe_keys, city_keys = index
+
+        ids = set(cls._prefixed(cafe_keys, prefix))
+        for code in cls._prefixed(city_keys, prefix):
+            ids |= cities[code][1]
+
+        return [
+            (id, cafes[id][0], cities.get(cafes[id][1], ("",))[0])
+            for id in ids if id in cafes
+        ]
+
+    def search(self, query, limit=10):
+        """Return [(id, name, city name, like count), ...] matching query.
+
+        Most liked first, then by name; at most limit (1 to MAX_LIMIT).
+        """
+
+        prefix = normalize(query)
+        if not prefix:
+            return []
+
+        limit = max(1, min(limit, MAX_LIMIT))
+
+        with self._lock:
+            matches = None
+            if self._loaded:
+                matches = self._match(
+                    (self._cafes, self._cities,
+                     self._cafe_keys, self._city_keys),
+                    prefix)
+
+        # Even if a racing change meant the load wasn't kept, its index is
+        # still fine to answer this search from.
+        if matches is None:
+            matches = self._match(self.load(), prefix)
+
+        top = heapq.nsmallest(
+            limit,
+            ((-recommender.like_count(id), name, id, city)
+             for id, name, city in matches))
+
+        return [(id, name, city, -likes) for likes, name, id, city in top]
+
+
+autocomplete = CafeAutocomplete()
@@ -0,0 +1,149 @@
+"""Compare like API throughput of the WSGI and ASGI serving modes.
+
+Start the site both ways against the same database, e.g.:
+
+    gunicorn --workers 4 --threads 8 --bind :8000 'app:create_app()'
+    uvicorn asgi:application --workers 4 --port 8001
+
+then run:
+
+    python bench_likes.py --user-ids 1-100 --cafe-ids 1-50 \\
+        http://localhost:8000 http://localhost:8001
+
+Each client thread is logged in as one of the users (clients share users
+round-robin) and works through the cafes from its own starting point,
+liking, checking and unliking each in turn, so requests are spread over
+many user & cafe rows rather than contending for one. Latency percentiles
+and throughput are printed per server.
+
+Results, with FLASK_CAFE_ENV=production and LIKE_WRITE_BEHIND off (the
+async like API never buffers likes), 100 users and 50 cafes, --concurrency
+50 and 60 requests per client, on one vCPU shared by the client, the
+servers and Postgres 16 (three runs each):
+
+    gunicorn, 2 workers x 8 threads   67-74 req/s    p50 620-675 ms
+                                                     p99 1300-1480 ms
+    uvicorn, 2 workers               215-250 req/s   p50 190-230 ms
+                                                     p99 350-435 ms
+
+Both servers left every cafe's like count at zero. Re-run on hardware like
+production's before sizing workers from this.
+"""
+
+import argparse
+import json
+import statistics
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from replay import make_cookie_factory
+
+
+def parse_ids(value):
+    """Parse ids like "1-100" or "3,5,8" into a list of ints."""
+
+    ids = []
+
+    for part in value.split(","):
+        first, _, last = part.partition("-")
+        ids.extend(range(int(first), int(last or first) + 1))
+
+    return ids
+
+
+def make_requests(base_url, cafe_ids):
+    """Return the cycle of (method, url, body) a client repeats."""
+
+    requests = []
+
+    for cafe_id in cafe_ids:
+        body = json.dumps({"cafe_id": cafe_id}).encode()
+        requests += [
+            ("POST", f"{base_url}/api/like", body),
+            ("GET", f"{base_url}/api/likes?cafe_id={cafe_id}", None),
+            ("POST", f"{base_url}/api/unlike", body),
+        ]
+
+    return requests
+
+
+def run_client(requests, cookie, count):
+    """Make count requests; return list of latencies in seconds."""
+
+    latencies = []
+
+    for i in range(count):
+        method, url, body = requests[i % len(requests)]
+        req = urllib.request.Request(url, data=body, method=method, headers={
+            "Cookie": cookie,
+            "Content-Type": "application/json",
+        })
+
+        start = time.perf_counter()
+        with urllib.request.urlopen(req) as resp:
+            resp.read()
+        latencies.append(time.perf_counter() - start)
+
+    return latencies
+
+
+def bench(base_url, cookies, cafe_ids, concurrency, per_client):
+    """Run concurrency clients against base_url; return summary stats.
+
+    Client i is logged in with cookies[i % len(cookies)], and starts its
+    walk through cafe_ids at cafe i, so concurrent clients mostly touch
+    different rows.
+    """
+
+    def client(i):
+        start = i % len(cafe_ids)
+        requests = make_requests(
+            base_url, cafe_ids[start:] + cafe_ids[:start])
+        return run_client(requests, cookies[i % len(cookies)], per_client)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = pool.map(client, range(concurrency))
+        latencies = sorted(lat for result in results for lat in result)
+    elapsed = time.perf_counter() - start
+
+    pct = statistics.quantiles(latencies, n=100)
+
+    return {
+        "requests": len(latencies),
+        "req_per_sec": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(pct[49] * 1000, 1),
+        "p95_ms": round(pct[94] * 1000, 1),
+        "p99_ms": round(pct[98] * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("base_urls", nargs="+")
+    parser.add_argument("--user-ids", type=parse_ids, required=True,
+                        help='users to log in as, e.g. "1-100"')
+    parser.add_argument("--cafe-ids", type=parse_ids, required=True,
+                        help='cafes to like, e.g. "1-50"')
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--requests-per-client", type=int, default=50)
+    parser.add_argument("--config",
+                        help="config whose SECRET_KEY signs session cookies")
+    args = parser.parse_args()
+
+    cookie = make_cookie_factory(args.config)
+    cookies = [cookie(user_id) for user_id in args.user_ids]
+
+    for base_url in args.base_urls:
+        result = bench(
+            base_url,
+            cookies,
+            args.cafe_ids,
+            args.concurrency,
+            args.requests_per_client)
+        print(base_url, json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Keep the cafe_cards read model in step with cafes, cities and likes.
+
+Cafe and city changes reach the cards through on_write handlers (see
+app.py), so a card always commits with the change it reflects. Likes are
+counted by the code that writes them: count_likes() in the like views and
+the like buffer, and SQL of its own in like_api.
+"""
+
+import click
+
+from models import db, Cafe, CafeCard, City, card_query
+
+
+# cafe columns copied to its card as they are
+CAFE_COLUMNS = ("name", "description", "url", "address", "city_code", "image_url")
+
+# written as a table, not through the ORM: nothing loads cards to sync
+cards = CafeCard.__table__
+
+
+def insert_cards(query):
+    """Insert cards for the cafes query selects; return how many."""
+
+    return db.session.execute(
+        cards.insert().from_select([column.key for column in cards.c], query)
+    ).rowcount
+
+
+def write_cafe_card(event):
+    """Insert, update or delete a cafe's card for a change event."""
+
+    if event.action == "delete":
+        db.session.execute(cards.delete().where(cards.c.id == event.id))
+
+    elif event.action == "insert":
+        insert_cards(card_query().where(Cafe.id == event.id))
+
+    else:
+        values = {
+            column: event.values[column]
+            for column in CAFE_COLUMNS
+            if column in event.changes
+        }
+
+        if "city_code" in values:
+            city = db.session.get(City, values["city_code"])
+            values["city_state"] = f"{city.name}, {city.state}"
+
+        if values:
+            db.session.execute(
+                cards.update().where(cards.c.id == event.id).values(**values))
+
+
+def write_city_cards(event):
+    """Update 'city, state' on the cards of a renamed city's cafes."""
+
+    city = db.session.get(City, event.id)
+
+    db.session.execute(
+        cards.update()
+        .where(cards.c.city_code == event.id)
+        .values(city_state=f"{city.name}, {city.state}"))
+
+
+def count_likes(conn, deltas):
+    """Add {cafe id: change in likes} to the cards' like counts.
+
+    conn is db.session or a connection, whose transaction wrote the likes.
+    """
+
+    params = [
+        {"cafe_id": cafe_id, "delta": delta}
+        for cafe_id, delta in deltas.items()
+        if delta
+    ]
+
+    if params:
+        conn.execute(
+            cards.update()
+            .where(cards.c.id == db.bindparam("cafe_id"))
+            .values(like_count=cards.c.like_count + db.bindparam("delta")),
+            params)
+
+
+def rebuild_cafe_cards():
+    """Replace every card with one built from the cafes, cities and likes.
+
+    Returns number of cards.
+    """
+
+    db.session.execute(cards.delete())
+    count = insert_cards(card_query())
+    db.session.commit()
+
+    return count
+
+
+def init_cafe_cards(app):
+    """Register rebuild-cafe-cards command on app."""
+
+    @app.cli.command("rebuild-cafe-cards")
+    def rebuild_cafe_cards_command():
+        """Rebuild the cafe_cards read model from scratch."""
+
+        click.echo(f"Rebuilt {rebuild_cafe_cards()} cafe cards")
@@ -0,0 +1,85 @@
+"""Cached number of cafes in each city."""
+
+import threading
+
+from models import db, Cafe, City
+
+
+class CityCafeCounts:
+    """Cities with their cafe counts, for the city navigation bar.
+
+    Loaded with one GROUP BY on first use, then kept current by apply()ing
+    cafe change events rather than re-counting.  Every apply() or
+    invalidate() bumps a version, and a load is only kept if no change
+    landed while its query ran; otherwise it would miss that change.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = 0
+        self._cities = None
+        self._counts = None
+
+    def _load(self):
+        with self._lock:
+            version = self._version
+
+        rows = db.session.execute(
+            db.select(City.code, City.name, db.func.count(Cafe.id))
+            .outerjoin(Cafe, Cafe.city_code == City.code)
+            .group_by(City.code, City.name)
+            .order_by(City.name)
+        ).all()
+
+        with self._lock:
+            if self._version == version:
+                self._cities = [(code, name) for code, name, count in rows]
+                self._counts = {code: count for code, name, count in rows}
+
+        return rows
+
+    def get(self):
+        """Return [(code, name, cafe count), ...] ordered by city name."""
+
+        with self._lock:
+            if self._counts is not None:
+                return [
+                    (code, name, self._counts.get(code, 0))
+                    for code, name in self._cities
+                ]
+
+        # Even if a racing change meant the load wasn't kept, its rows are
+        # still fine to show for this request.
+        return [(code, name, count) for code, name, count in self._load()]
+
+    def total(self):
+        """Return number of cafes in all cities."""
+
+        return sum(count for code, name, count in self.get())
+
+    def apply(self, event):
+        """Update counts for a cafe insert, delete or change of city."""
+
+        old, new = event.changes.get("city_code", (None, None))
+
+        with self._lock:
+            self._version += 1
+
+            if self._counts is None:
+                return
+
+            if old is not None:
+                self._counts[old] = self._counts.get(old, 0) - 1
+            if new is not None:
+                self._counts[new] = self._counts.get(new, 0) + 1
+
+    def invalidate(self):
+        """Forget cached cities and counts; they're reloaded on next use."""
+
+        with self._lock:
+            self._version += 1
+            self._cities = None
+            self._counts = None
+
+
+city_counts = CityCafeCounts()
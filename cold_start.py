@@ -0,0 +1,70 @@
+"""Measure how long a fresh Flask Cafe process takes to serve its first page.
+
+    python cold_start.py --runs 10 --config production
+
+Each run starts a new Python process, which imports app, calls create_app()
+and makes one request with the test client; the median and fastest time of
+each step is printed.
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+
+PROBE = """
+import json, sys, time
+
+started = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+app = create_app(sys.argv[1])
+created = time.perf_counter()
+resp = app.test_client().get(sys.argv[2])
+served = time.perf_counter()
+
+print(json.dumps({
+    "import": imported - started,
+    "create_app": created - imported,
+    "first_request": served - created,
+    "total": served - started,
+    "status": resp.status_code,
+}))
+"""
+
+STEPS = ("import", "create_app", "first_request", "total")
+
+
+def measure(config, path):
+    """Return timings of one cold start, in seconds."""
+
+    out = subprocess.run(
+        [sys.executable, "-c", PROBE, config, path],
+        check=True, capture_output=True, text=True,
+    ).stdout
+
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--config", default="production")
+    parser.add_argument("--path", default="/")
+    args = parser.parse_args()
+
+    runs = [measure(args.config, args.path) for i in range(args.runs)]
+
+    print(f"{args.runs} cold starts, {args.config} config, GET {args.path} "
+          f"-> {runs[-1]['status']}")
+
+    for step in STEPS:
+        times = [run[step] * 1000 for run in runs]
+        print(f"  {step:<14} median {statistics.median(times):7.1f} ms"
+              f"   min {min(times):7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
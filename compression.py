@@ -0,0 +1,184 @@
+"""Gzip/brotli compression of dynamic responses."""
+
+from collections import OrderedDict
+import gzip
+import threading
+
+import brotli
+from flask import current_app, request, session
+
+
+COMPRESS_MIMETYPES = (
+    "text/html",
+    "text/css",
+    "text/plain",
+    "text/xml",
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "application/atom+xml",
+    "image/svg+xml",
+)
+
+
+def _gzip(data, level):
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def _brotli(data, level):
+    return brotli.compress(data, quality=level, mode=brotli.MODE_TEXT)
+
+
+# content-encoding, compressor & config key for its level, in order of
+# preference
+ENCODINGS = (
+    ("br", _brotli, "COMPRESS_BR_LEVEL"),
+    ("gzip", _gzip, "COMPRESS_GZIP_LEVEL"),
+)
+
+
+class CompressedCache:
+    """LRU of compressed bodies, keyed by (ETag, encoding).
+
+    Bounded by the total size of the bodies held.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._size = 0
+        self._bodies = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, etag, encoding):
+        with self._lock:
+            body = self._bodies.get((etag, encoding))
+            if body is not None:
+                self._bodies.move_to_end((etag, encoding))
+            return body
+
+    def set(self, etag, encoding, body):
+        if len(body) > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._bodies.pop((etag, encoding), None)
+            if old is not None:
+                self._size -= len(old)
+
+            self._bodies[(etag, encoding)] = body
+            self._size += len(body)
+
+            while self._size > self.max_bytes:
+                key, evicted = self._bodies.popitem(last=False)
+                self._size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._bodies.clear()
+            self._size = 0
+
+
+compressed_cache = CompressedCache()
+
+
+def choose_encoding():
+    """Return preferred encoding the client accepts, or None."""
+
+    for name, compress, level_key in ENCODINGS:
+        if request.accept_encodings.quality(name) > 0:
+            return name, compress, current_app.config[level_key]
+
+    return None
+
+
+def should_compress(resp):
+    """Is this a response worth compressing?"""
+
+    config = current_app.config
+
+    return (
+        config["COMPRESS_ENABLED"]
+        and 200 <= resp.status_code < 300
+        and resp.status_code != 204
+        and not resp.direct_passthrough
+        and not resp.is_streamed
+        and "Content-Encoding" not in resp.headers
+        and not resp.cache_control.no_transform
+        and resp.mimetype in config["COMPRESS_MIMETYPES"]
+        and (resp.content_length or 0) >= config["COMPRESS_MIN_SIZE"]
+    )
+
+
+def is_shared(resp):
+    """Is this response the same for everyone who gets its ETag?
+
+    Not if it's private or no-store, or depends on the session cookie: the
+    session interface only adds Vary: Cookie after this runs, so check
+    whether the session was read, too.
+    """
+
+    return not (
+        resp.cache_control.private
+        or resp.cache_control.no_store
+        or "Cookie" in resp.vary
+        or "Set-Cookie" in resp.headers
+        or session.accessed
+    )
+
+
+def compress_response(resp):
+    """Compress response body if client accepts gzip or brotli.
+
+    Responses without an ETag get one from their uncompressed body, so an
+    unchanged page is compressed once and then served from the cache.
+    Responses that aren't shared (see is_shared) are compressed afresh
+    each time, and never cached.
+    """
+
+    if not should_compress(resp):
+        return resp
+
+    resp.vary.add("Accept-Encoding")
+
+    chosen = choose_encoding()
+    if chosen is None:
+        return resp
+
+    encoding, compress, level = chosen
+
+    etag, weak = resp.get_etag()
+    if etag is None:
+        resp.add_etag()
+        etag, weak = resp.get_etag()
+
+    if is_shared(resp):
+        body = compressed_cache.get(etag, encoding)
+        if body is None:
+            body = compress(resp.get_data(), level)
+            compressed_cache.set(etag, encoding, body)
+    else:
+        body = compress(resp.get_data(), level)
+
+    resp.set_data(body)
+    resp.headers["Content-Encoding"] = encoding
+    # each encoding is a different representation, so needs its own ETag
+    resp.set_etag(f"{etag}-{encoding}", weak=weak)
+
+    return resp.make_conditional(request)
+
+
+def init_compression(app):
+    """Compress app's responses, after its other after_request hooks."""
+
+    app.config.setdefault("COMPRESS_ENABLED", True)
+    app.config.setdefault("COMPRESS_MIMETYPES", COMPRESS_MIMETYPES)
+    app.config.setdefault("COMPRESS_MIN_SIZE", 500)
+    app.config.setdefault("COMPRESS_GZIP_LEVEL", 6)
+    app.config.setdefault("COMPRESS_BR_LEVEL", 5)
+    app.config.setdefault("COMPRESS_CACHE_MAX_BYTES", 16 * 1024 * 1024)
+
+    compressed_cache.max_bytes = app.config["COMPRESS_CACHE_MAX_BYTES"]
+
+    # after_request hooks run in reverse order, so going first makes this
+    # run last: hooks like the debug toolbar's expect an uncompressed body
+    app.after_request_funcs.setdefault(None, []).insert(0, compress_response)
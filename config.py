@@ -0,0 +1,92 @@
+"""Settings for each environment Flask Cafe runs in.
+
+Pick one with FLASK_CAFE_ENV (development, testing or production), or pass
+its name to create_app().
+"""
+
+import os
+
+
+class Config:
+    """Settings shared by every environment."""
+
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        "DATABASE_URL", "postgresql:///flask_cafe")
+    SQLALCHEMY_REPLICA_URIS = [
+        uri
+        for uri in os.environ.get("DATABASE_REPLICA_URLS", "").split(",")
+        if uri
+    ]
+    SQLALCHEMY_ECHO = False
+
+    # connection pool for the primary database; see health.engine_options
+    DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+    DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+    DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))
+    DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+    DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "1") == "1"
+    # milliseconds; 0 for no limit (Postgres only)
+    DB_STATEMENT_TIMEOUT_MS = int(
+        os.environ.get("DB_STATEMENT_TIMEOUT_MS", 15000))
+
+    REPLICA_MAX_LAG_SECONDS = float(
+        os.environ.get("REPLICA_MAX_LAG_SECONDS", 5))
+    LIKE_WRITE_BEHIND = os.environ.get("LIKE_WRITE_BEHIND") == "1"
+    INVALIDATION_BUS_ENABLED = os.environ.get("INVALIDATION_BUS") != "0"
+
+    SECRET_KEY = os.environ.get("FLASK_SECRET_KEY", "shhhh")
+
+    # public address of the site, for absolute URLs in sitemaps and feeds
+    SITE_URL = os.environ.get("SITE_URL", "http://localhost:5000/")
+
+    # NDJSON file to record a sample of requests to; see traffic.py
+    TRAFFIC_CAPTURE_PATH = os.environ.get("TRAFFIC_CAPTURE_PATH")
+    TRAFFIC_SAMPLE_RATE = float(os.environ.get("TRAFFIC_SAMPLE_RATE", 0.01))
+
+    # the debug toolbar is installed if DEBUG_TB_ENABLED is set, which it is
+    # by default in debug mode
+    DEBUG_TB_INTERCEPT_REDIRECTS = False
+
+    # directory for compiled templates; None puts them in the instance folder
+    JINJA_BYTECODE_CACHE_DIR = None
+    # compile every template when the app is created, not on first use
+    PRECOMPILE_TEMPLATES = False
+
+
+class DevelopmentConfig(Config):
+    SQLALCHEMY_ECHO = True
+
+
+class TestingConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        "TEST_DATABASE_URL", "postgresql:///flaskcafe_test")
+    SQLALCHEMY_REPLICA_URIS = []
+    LIKE_WRITE_BEHIND = False
+    INVALIDATION_BUS_ENABLED = False
+    TRAFFIC_CAPTURE_PATH = None
+    SITE_URL = "http://localhost/"
+
+    # tests see their own changes at once
+    PAGE_CACHE_ENABLED = False
+
+    # don't require CSRF tokens in test forms
+    WTF_CSRF_ENABLED = False
+
+
+class ProductionConfig(Config):
+    DEBUG_TB_ENABLED = False
+    PRECOMPILE_TEMPLATES = True
+
+
+CONFIGS = {
+    "development": DevelopmentConfig,
+    "testing": TestingConfig,
+    "production": ProductionConfig,
+}
+
+
+def get_config(name=None):
+    """Return config class for name, or for FLASK_CAFE_ENV if not given."""
+
+    return CONFIGS[name or os.environ.get("FLASK_CAFE_ENV", "development")]
@@ -0,0 +1,185 @@
+"""After-commit hooks for changes to model instances.
+
+Subscribe with @on_change; handlers get a ChangeEvent once the transaction
+that made the change has committed:
+
+    @on_change(Cafe, columns={"address", "city_code"})
+    def update_map(event):
+        ...
+
+Handlers run after commit, when the session can't emit SQL, so they should
+use event.values or a connection of their own.
+
+Handlers subscribed with @on_write instead run just before the commit,
+inside the transaction, so what they write with db.session commits or
+rolls back along with the change.
+"""
+
+from collections import namedtuple
+import logging
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+
+logger = logging.getLogger(__name__)
+
+ACTIONS = ("insert", "update", "delete")
+
+# key in session.info for changes flushed but not yet committed
+PENDING_KEY = "pending_change_events"
+
+
+class ChangeEvent(namedtuple(
+        "ChangeEvent", ["model", "id", "action", "changes", "values"])):
+    """A committed insert, update or delete of one model instance.
+
+    id is the primary key (a tuple for composite keys). changes maps each
+    changed column to (old, new): for inserts, every column that was set;
+    for deletes, every loaded column. values holds the latest value of each
+    loaded column.
+    """
+
+    __slots__ = ()
+
+
+_subscribers = []
+
+_writers = []
+
+
+def on_change(model, columns=None, actions=ACTIONS):
+    """Decorator: call handler(event) after commits that change model.
+
+    If columns is given, the handler is only called if one of them changed.
+    """
+
+    columns = frozenset(columns) if columns else None
+
+    def decorator(handler):
+        _subscribers.append((model, columns, frozenset(actions), handler))
+        return handler
+
+    return decorator
+
+
+def on_write(model, columns=None, actions=ACTIONS):
+    """Decorator: call handler(event) in commits that change model.
+
+    The handler runs before the commit, so an error aborts it.
+    """
+
+    columns = frozenset(columns) if columns else None
+
+    def decorator(handler):
+        _writers.append((model, columns, frozenset(actions), handler))
+        return handler
+
+    return decorator
+
+
+def _handlers(subscribers, change):
+    """Yield handlers of subscribers interested in change."""
+
+    for model, columns, actions, handler in subscribers:
+        if not issubclass(change.model, model):
+            continue
+        if change.action not in actions:
+            continue
+        if columns is not None and not columns & change.changes.keys():
+            continue
+
+        yield handler
+
+
+def _column_changes(state, action):
+    changes = {}
+
+    for attr in state.mapper.column_attrs:
+        if action == "delete":
+            if attr.key in state.dict:
+                changes[attr.key] = (state.dict[attr.key], None)
+            continue
+
+        history = state.attrs[attr.key].history
+        if action == "insert" and history.added:
+            changes[attr.key] = (None, history.added[0])
+        elif action == "update" and history.has_changes():
+            old = history.deleted[0] if history.deleted else None
+            new = history.added[0] if history.added else None
+            changes[attr.key] = (old, new)
+
+    return changes
+
+
+@event.listens_for(Session, "after_flush")
+def collect_changes(session, flush_context):
+    pending = session.info.setdefault(PENDING_KEY, {})
+
+    for action, objs in (
+            ("insert", session.new),
+            ("update", session.dirty),
+            ("delete", session.deleted)):
+        for obj in objs:
+            state = inspect(obj)
+            changes = _column_changes(state, action)
+
+            if not changes:
+                continue
+
+            values = {
+                attr.key: state.dict[attr.key]
+                for attr in state.mapper.column_attrs
+                if attr.key in state.dict
+            }
+            ident = tuple(state.mapper.primary_key_from_instance(obj))
+            id = ident[0] if len(ident) == 1 else ident
+            key = (type(obj), id)
+            earlier = pending.get(key)
+
+            if earlier:
+                # several flushes in one transaction: merge into one event
+                for column, (old, new) in earlier.changes.items():
+                    if column in changes:
+                        changes[column] = (old, changes[column][1])
+                    else:
+                        changes[column] = (old, new)
+
+            # an insert that's updated before commit is still an insert
+            obj_action = action
+            if earlier and earlier.action == "insert" and action == "update":
+                obj_action = "insert"
+
+            pending[key] = ChangeEvent(
+                type(obj), id, obj_action, changes, values)
+
+
+@event.listens_for(Session, "before_commit")
+def dispatch_writes(session):
+    if not _writers:
+        return
+
+    # collect changes not flushed yet, too
+    session.flush()
+
+    for change in list(session.info.get(PENDING_KEY, {}).values()):
+        for handler in _handlers(_writers, change):
+            handler(change)
+
+
+@event.listens_for(Session, "after_commit")
+def dispatch_changes(session):
+    events = session.info.pop(PENDING_KEY, {}).values()
+
+    for change in events:
+        for handler in _handlers(_subscribers, change):
+            try:
+                handler(change)
+            except Exception:
+                logger.exception("%s failed for %s", handler.__name__, change)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def discard_changes(session, previous_transaction):
+    if previous_transaction.parent is None:
+        session.info.pop(PENDING_KEY, None)
@@ -0,0 +1,204 @@
+"""Connection pool settings, health checks and metrics."""
+
+import bisect
+import threading
+import time
+
+from flask import jsonify
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.pool import QueuePool
+
+from models import db
+
+
+# upper bounds, in seconds, of the pool wait histogram's buckets
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class WaitHistogram:
+    """Counts of how long checkouts waited for a connection."""
+
+    def __init__(self, buckets=WAIT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # last count is for waits longer than the largest bucket
+            self.counts = [0] * (len(self.buckets) + 1)
+            self.total = 0
+            self.max = 0
+
+    def observe(self, seconds):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def summary(self):
+        """Return dict of count, total, mean and max wait in seconds."""
+
+        with self._lock:
+            count = sum(self.counts)
+            return {
+                "count": count,
+                "total": round(self.total, 6),
+                "mean": round(self.total / count, 6) if count else 0,
+                "max": round(self.max, 6),
+            }
+
+    def cumulative(self):
+        """Return [(upper bound, count of waits <= it), ...], ending with inf."""
+
+        with self._lock:
+            counts = list(self.counts)
+
+        running = 0
+        result = []
+
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            running += count
+            result.append((bound, running))
+
+        return result
+
+
+pool_wait = WaitHistogram()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_wait.observe(time.perf_counter() - started)
+
+
+def engine_options(config):
+    """Return SQLALCHEMY_ENGINE_OPTIONS for the DB_POOL_* settings."""
+
+    options = {
+        "poolclass": TimedQueuePool,
+        "pool_size": config["DB_POOL_SIZE"],
+        "max_overflow": config["DB_MAX_OVERFLOW"],
+        "pool_timeout": config["DB_POOL_TIMEOUT"],
+        "pool_recycle": config["DB_POOL_RECYCLE"],
+        "pool_pre_ping": config["DB_POOL_PRE_PING"],
+    }
+
+    url = make_url(config["SQLALCHEMY_DATABASE_URI"])
+    timeout = config["DB_STATEMENT_TIMEOUT_MS"]
+
+    if url.get_backend_name() == "postgresql" and timeout:
+        options["connect_args"] = {"options": f"-c statement_timeout={timeout}"}
+
+    return options
+
+
+def configure_pool(app):
+    """Set engine options from app's DB_POOL_* settings.
+
+    Call before connect_db(); an explicit SQLALCHEMY_ENGINE_OPTIONS wins.
+    """
+
+    app.config.setdefault(
+        "SQLALCHEMY_ENGINE_OPTIONS", engine_options(app.config))
+
+
+def pool_status(engine=None):
+    """Return dict describing the primary database's connection pool."""
+
+    pool = (engine or db.engine).pool
+
+    status = {"wait_seconds": pool_wait.summary()}
+
+    if isinstance(pool, QueuePool):
+        status.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            idle=pool.checkedin(),
+            overflow=max(pool.overflow(), 0),
+        )
+
+    return status
+
+
+def healthz():
+    """Liveness: the process is up. Doesn't touch the database."""
+
+    return jsonify(status="ok", pool=pool_status())
+
+
+def readyz():
+    """Readiness: the database answers. 503 if it doesn't."""
+
+    started = time.perf_counter()
+
+    try:
+        with db.engine.connect() as conn:
+            conn.execute(db.text("SELECT 1"))
+    except SQLAlchemyError as e:
+        error = type(getattr(e, "orig", None) or e).__name__
+        resp = jsonify(status="unavailable", error=error, pool=pool_status())
+        resp.status_code = 503
+        return resp
+
+    return jsonify(
+        status="ok",
+        db_seconds=round(time.perf_counter() - started, 6),
+        pool=pool_status())
+
+
+def metrics():
+    """Pool gauges & wait histogram, in Prometheus text format.
+
+    Numbers are for this worker process.
+    """
+
+    status = pool_status()
+    lines = []
+
+    for key, help in (
+            ("size", "Connections the pool keeps open."),
+            ("checked_out", "Connections in use."),
+            ("idle", "Connections open and waiting in the pool."),
+            ("overflow", "Connections open beyond the pool size.")):
+        if key in status:
+            name = f"flaskcafe_db_pool_{key}"
+            lines += [
+                f"# HELP {name} {help}",
+                f"# TYPE {name} gauge",
+                f"{name} {status[key]}",
+            ]
+
+    name = "flaskcafe_db_pool_wait_seconds"
+    lines += [
+        f"# HELP {name} Time checkouts waited for a connection.",
+        f"# TYPE {name} histogram",
+    ]
+
+    for bound, count in pool_wait.cumulative():
+        le = "+Inf" if bound == float("inf") else repr(bound)
+        lines.append(f'{name}_bucket{{le="{le}"}} {count}')
+
+    summary = pool_wait.summary()
+    lines += [
+        f"{name}_sum {summary['total']}",
+        f"{name}_count {summary['count']}",
+    ]
+
+    return "\n".join(lines) + "\n", 200, {
+        "Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+def init_health(app):
+    """Register /healthz, /readyz and /metrics on app."""
+
+    app.add_url_rule("/healthz", endpoint="healthz", view_func=healthz)
+    app.add_url_rule("/readyz", endpoint="readyz", view_func=readyz)
+    app.add_url_rule("/metrics", endpoint="metrics", view_func=metrics)
@@ -0,0 +1,256 @@
+"""Local mirror and resized variants of cafe and user images."""
+
+import hashlib
+import io
+import ipaddress
+import logging
+import os
+import re
+import shutil
+import socket
+import threading
+import urllib.request
+from urllib.parse import urlsplit
+
+from flask import abort, redirect, request, send_file
+from PIL import Image
+
+from models import Cafe, User
+
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+STATIC_DIR = os.path.join(BASE_DIR, "static")
+MIRROR_DIR = os.path.join(STATIC_DIR, "mirror")
+
+# width in pixels of each generated variant
+SIZES = {
+    "thumb": 320,
+    "medium": 640,
+    "large": 1280,
+}
+
+MODELS = {
+    "cafe": Cafe,
+    "user": User,
+}
+
+FORMATS = {
+    "webp": "image/webp",
+    "jpeg": "image/jpeg",
+}
+
+ONE_YEAR = 60 * 60 * 24 * 365
+FETCH_TIMEOUT = 10
+
+# larger downloads and images are refused
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+MAX_IMAGE_PIXELS = 40_000_000
+
+# what source_version() returns
+VERSION_RE = re.compile(r"[0-9a-f]{12}")
+
+_in_flight = set()
+_in_flight_lock = threading.Lock()
+
+
+def source_version(source_url):
+    """Return short version string identifying this source URL."""
+
+    return hashlib.sha1(source_url.encode("utf8")).hexdigest()[:12]
+
+
+def thumbnail_url(kind, id, source_url, size="thumb"):
+    """Return URL of the mirrored variant of an image.
+
+    The version query string changes whenever the source URL changes, so
+    the response can be cached forever.
+    """
+
+    return f"/img/{kind}/{id}/{size}?v={source_version(source_url)}"
+
+
+def _variant_dir(kind, id, version):
+    return os.path.join(MIRROR_DIR, kind, str(id), version)
+
+
+def _variant_path(kind, id, version, size, fmt):
+    return os.path.join(_variant_dir(kind, id, version), f"{size}.{fmt}")
+
+
+def _check_public_url(url):
+    """Raise ValueError unless url is http(s) on a public address.
+
+    Image URLs come from users, so they mustn't reach internal hosts.
+    """
+
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ValueError(f"Not an http(s) URL: {url}")
+
+    try:
+        infos = socket.getaddrinfo(parts.hostname, parts.port or None)
+    except socket.gaierror as exc:
+        raise ValueError(f"Can't resolve {parts.hostname}: {exc}") from exc
+
+    for info in infos:
+        address = ipaddress.ip_address(info[4][0].split("%")[0])
+        if not address.is_global:
+            raise ValueError(f"{parts.hostname} is not a public address")
+
+
+class PublicRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """Follow redirects only to public http(s) URLs."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        _check_public_url(newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+opener = urllib.request.build_opener(PublicRedirectHandler)
+
+
+def _read_limited(f):
+    data = f.read(MAX_IMAGE_BYTES + 1)
+    if len(data) > MAX_IMAGE_BYTES:
+        raise ValueError(f"Image is over {MAX_IMAGE_BYTES} bytes")
+    return data
+
+
+def _fetch(source_url):
+    """Return bytes of image at source_url (a remote URL or /static path)."""
+
+    if source_url.startswith("/static/"):
+        path = os.path.normpath(os.path.join(BASE_DIR, source_url.lstrip("/")))
+        if not path.startswith(STATIC_DIR + os.sep):
+            raise ValueError(f"Not a static file: {source_url}")
+
+        with open(path, "rb") as f:
+            return _read_limited(f)
+
+    url = source_url.replace(' ', '%20')
+    _check_public_url(url)
+
+    with opener.open(url, timeout=FETCH_TIMEOUT) as resp:
+        return _read_limited(resp)
+
+
+def _open_image(data):
+    """Return PIL image of data, refusing decompression bombs."""
+
+    try:
+        img = Image.open(io.BytesIO(data))
+    except Image.DecompressionBombError as exc:
+        raise ValueError(str(exc)) from exc
+
+    # open() only reads the header; check before decoding the pixels
+    if img.width * img.height > MAX_IMAGE_PIXELS:
+        raise ValueError(f"Image is {img.width}x{img.height} pixels")
+
+    return img
+
+
+def mirror_image(kind, id, source_url):
+    """Download image and write all size/format variants to the mirror.
+
+    Older versions of this image are removed once the new one is in place.
+    """
+
+    version = source_version(source_url)
+    final_dir = _variant_dir(kind, id, version)
+    tmp_dir = f"{final_dir}.tmp-{threading.get_ident()}"
+
+    img = _open_image(_fetch(source_url))
+    img = img.convert("RGB")
+
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    for size, width in SIZES.items():
+        variant = img.copy()
+        # thumbnail() keeps the aspect ratio and never upscales
+        variant.thumbnail((width, width * 4))
+        variant.save(os.path.join(tmp_dir, f"{size}.jpeg"),
+                     "JPEG", quality=82, optimize=True, progressive=True)
+        variant.save(os.path.join(tmp_dir, f"{size}.webp"),
+                     "WEBP", quality=80, method=4)
+
+    shutil.rmtree(final_dir, ignore_errors=True)
+    os.replace(tmp_dir, final_dir)
+
+    parent = os.path.dirname(final_dir)
+    for old_version in os.listdir(parent):
+        if old_version != version and ".tmp-" not in old_version:
+            shutil.rmtree(os.path.join(parent, old_version), ignore_errors=True)
+
+
+def refresh_in_background(kind, id, source_url):
+    """Mirror image in a background thread, unless already in progress."""
+
+    key = (kind, id, source_version(source_url))
+
+    with _in_flight_lock:
+        if key in _in_flight:
+            return
+        _in_flight.add(key)
+
+    def work():
+        try:
+            mirror_image(kind, id, source_url)
+        except Exception:
+            logger.exception(
+                "Could not mirror %s %s image %s", kind, id, source_url)
+        finally:
+            with _in_flight_lock:
+                _in_flight.discard(key)
+
+    threading.Thread(target=work, daemon=True).start()
+
+
+def serve_image(kind, id, size):
+    """Serve mirrored variant of image, preferring WebP if accepted.
+
+    If the requested version has not been mirrored yet, start mirroring it
+    and redirect to the source image in the meantime.
+    """
+
+    if kind not in MODELS or size not in SIZES:
+        abort(404)
+
+    version = request.args.get("v", "")
+    if version and not VERSION_RE.fullmatch(version):
+        abort(404)
+
+    fmt = "webp" if "image/webp" in request.accept_mimetypes else "jpeg"
+    path = _variant_path(kind, id, version, size, fmt)
+
+    if version and os.path.exists(path):
+        resp = send_file(path, mimetype=FORMATS[fmt], max_age=ONE_YEAR,
+                         conditional=True)
+        resp.cache_control.public = True
+        resp.cache_control.immutable = True
+        resp.vary.add("Accept")
+        return resp
+
+    obj = MODELS[kind].query.get_or_404(id)
+    current = source_version(obj.image_url)
+
+    if version != current and os.path.exists(
+            _variant_path(kind, id, current, size, fmt)):
+        return redirect(thumbnail_url(kind, id, obj.image_url, size))
+
+    refresh_in_background(kind, id, obj.image_url)
+
+    resp = redirect(obj.image_url)
+    resp.cache_control.no_store = True
+    return resp
+
+
+def init_images(app):
+    """Register image route and template helper on app."""
+
+    app.add_url_rule(
+        "/img/<kind>/<int:id>/<size>",
+        endpoint="serve_image",
+        view_func=serve_image)
+    app.jinja_env.globals["thumbnail_url"] = thumbnail_url
@@ -0,0 +1,121 @@
+"""Report unused and missing indexes from Postgres statistics."""
+
+import click
+
+from models import db
+
+
+UNUSED_INDEXES_SQL = """
+    SELECT s.relname AS table,
+           s.indexrelname AS index,
+           s.idx_scan AS scans,
+           pg_size_pretty(pg_relation_size(s.indexrelid)) AS size
+    FROM pg_stat_user_indexes s
+    JOIN pg_index i ON i.indexrelid = s.indexrelid
+    WHERE s.idx_scan = 0
+      AND NOT i.indisunique
+      AND NOT i.indisprimary
+    ORDER BY pg_relation_size(s.indexrelid) DESC
+"""
+
+# foreign keys whose columns don't lead any index: joins and cascades on
+# them scan the whole table
+UNINDEXED_FOREIGN_KEYS_SQL = """
+    SELECT c.conrelid::regclass::text AS table,
+           string_agg(a.attname, ', ' ORDER BY a.attnum) AS columns
+    FROM pg_constraint c
+    JOIN pg_attribute a
+      ON a.attrelid = c.conrelid AND a.attnum = ANY (c.conkey)
+    WHERE c.contype = 'f'
+      AND NOT EXISTS (
+          SELECT 1 FROM pg_index i
+          WHERE i.indrelid = c.conrelid
+            AND (i.indkey::int2[])[0:array_length(c.conkey, 1) - 1]
+                @> c.conkey
+      )
+    GROUP BY c.conrelid, c.conname
+    ORDER BY 1
+"""
+
+SEQ_SCANNED_TABLES_SQL = """
+    SELECT relname AS table,
+           seq_scan,
+           seq_tup_read,
+           coalesce(idx_scan, 0) AS idx_scan,
+           n_live_tup AS rows
+    FROM pg_stat_user_tables
+    WHERE seq_scan > 0
+      AND n_live_tup >= :min_rows
+      AND seq_scan > coalesce(idx_scan, 0)
+    ORDER BY seq_tup_read DESC
+"""
+
+SLOW_QUERIES_SQL = """
+    SELECT calls,
+           round(mean_exec_time::numeric, 2) AS mean_ms,
+           rows,
+           left(regexp_replace(query, '\\s+', ' ', 'g'), 120) AS query
+    FROM pg_stat_statements
+    WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+    ORDER BY total_exec_time DESC
+    LIMIT :limit
+"""
+
+
+def _rows(sql, **params):
+    return db.session.execute(db.text(sql), params).mappings().all()
+
+
+def has_pg_stat_statements():
+    return bool(db.session.scalar(db.text(
+        "SELECT 1 FROM pg_extension WHERE extname = 'pg_stat_statements'")))
+
+
+def index_report(min_rows=1000, limit=10):
+    """Return dict of lists of rows about index use in this database."""
+
+    report = {
+        "unused_indexes": _rows(UNUSED_INDEXES_SQL),
+        "unindexed_foreign_keys": _rows(UNINDEXED_FOREIGN_KEYS_SQL),
+        "seq_scanned_tables": _rows(SEQ_SCANNED_TABLES_SQL, min_rows=min_rows),
+        "slow_queries": [],
+    }
+
+    if has_pg_stat_statements():
+        report["slow_queries"] = _rows(SLOW_QUERIES_SQL, limit=limit)
+
+    return report
+
+
+TITLES = {
+    "unused_indexes": "Unused indexes (never scanned since stats reset)",
+    "unindexed_foreign_keys": "Foreign keys with no index",
+    "seq_scanned_tables": "Tables read mostly by sequential scan",
+    "slow_queries": "Queries with the most total time (pg_stat_statements)",
+}
+
+
+def init_index_report(app):
+    """Register index-report command on app."""
+
+    @app.cli.command("index-report")
+    @click.option("--min-rows", default=1000,
+                  help="Ignore tables with fewer live rows.")
+    @click.option("--limit", default=10, help="Number of queries to show.")
+    def index_report_command(min_rows, limit):
+        """Report unused and missing indexes."""
+
+        report = index_report(min_rows=min_rows, limit=limit)
+
+        for key, title in TITLES.items():
+            click.echo(f"\n{title}:")
+
+            if not report[key]:
+                click.echo("  (none)")
+
+            for row in report[key]:
+                click.echo("  " + "  ".join(f"{k}={v}" for k, v in row.items()))
+
+        if not has_pg_stat_statements():
+            click.echo(
+                "\n(Install the pg_stat_statements extension for query stats.)")
@@ -0,0 +1,188 @@
+"""Tell other workers to drop cached copies of changed rows.
+
+Changes are published with Postgres NOTIFY; every worker runs a thread
+that LISTENs and calls the handlers subscribed to that kind of entity:
+
+    @invalidation_bus.subscribe("cafes")
+    def forget_cafe(id):
+        ...
+
+Handlers get the changed row's id (a list for composite keys), or None if
+any row may have changed (e.g. after messages were missed while
+reconnecting). They run in the listener thread, in an app context.
+"""
+
+from collections import defaultdict
+from contextlib import nullcontext
+import json
+import logging
+import select
+import threading
+import time
+import uuid
+
+from models import db
+
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "cache_invalidation"
+
+# numbers every message, so a worker can tell if it missed any
+VERSION_SEQUENCE = db.Sequence(
+    "cache_invalidation_version", metadata=db.metadata)
+
+LAST_VERSION_SQL = """
+    SELECT CASE WHEN is_called THEN last_value ELSE 0 END
+    FROM cache_invalidation_version
+"""
+
+
+class InvalidationBus:
+    """Publish and receive entity-change messages over LISTEN/NOTIFY.
+
+    Off unless INVALIDATION_BUS_ENABLED is set; it needs Postgres.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.version = None
+        self.origin = uuid.uuid4().hex
+        self.poll_seconds = 5
+        self.retry_seconds = 5
+        self._app = None
+        self._handlers = defaultdict(list)
+        self._listener = None
+
+    def init_app(self, app):
+        app.config.setdefault("INVALIDATION_BUS_ENABLED", False)
+        app.config.setdefault("INVALIDATION_BUS_RETRY_SECONDS", 5)
+
+        self._app = app
+        self.enabled = app.config["INVALIDATION_BUS_ENABLED"]
+        self.retry_seconds = app.config["INVALIDATION_BUS_RETRY_SECONDS"]
+
+        if self.enabled:
+            self.start()
+
+    def subscribe(self, entity):
+        """Decorator: call handler(id) when another worker changes entity."""
+
+        def decorator(handler):
+            self._handlers[entity].append(handler)
+            return handler
+
+        return decorator
+
+    def publish(self, entity, id):
+        """Tell every other worker that a row of entity changed."""
+
+        self.publish_all(entity, [id])
+
+    def publish_all(self, entity, ids):
+        """Tell every other worker that rows of entity changed."""
+
+        if not self.enabled or not ids:
+            return
+
+        with db.engine.begin() as conn:
+            for id in ids:
+                version = conn.execute(
+                    db.select(VERSION_SEQUENCE.next_value())).scalar()
+                payload = json.dumps({
+                    "entity": entity,
+                    "id": id,
+                    "version": version,
+                    "origin": self.origin,
+                })
+                conn.execute(
+                    db.text("SELECT pg_notify(:channel, :payload)"),
+                    {"channel": CHANNEL, "payload": payload})
+
+    def receive(self, payload):
+        """Handle one message from the channel."""
+
+        message = json.loads(payload)
+        self.version = max(self.version or 0, message["version"])
+
+        # the publisher already updated its own caches
+        if message["origin"] != self.origin:
+            self._dispatch(message["entity"], message["id"])
+
+    def catch_up(self, version):
+        """Evict everything if messages before version were missed."""
+
+        if self.version is not None and version > self.version:
+            logger.warning(
+                "Missed cache invalidations %s-%s; evicting everything",
+                self.version + 1, version)
+            for entity in list(self._handlers):
+                self._dispatch(entity, None)
+
+        self.version = max(self.version or 0, version)
+
+    def _dispatch(self, entity, id):
+        for handler in self._handlers.get(entity, []):
+            try:
+                with self._app.app_context() if self._app else nullcontext():
+                    handler(id)
+            except Exception:
+                logger.exception("%s failed for %s %s", handler.__name__,
+                                 entity, id)
+
+    def start(self):
+        """Start listening in a background thread, unless already running."""
+
+        if self._listener and self._listener.is_alive():
+            return
+
+        def run():
+            while True:
+                try:
+                    self._listen()
+                except Exception:
+                    logger.exception("Cache invalidation listener failed")
+                time.sleep(self.retry_seconds)
+
+        self._listener = threading.Thread(target=run, daemon=True)
+        self._listener.start()
+
+    def after_fork(self):
+        """In a forked child: get a new origin and start listening."""
+
+        self.origin = uuid.uuid4().hex
+
+        if self.enabled:
+            self.start()
+
+    def _listen(self):
+        with self._app.app_context():
+            raw = db.engine.raw_connection()
+
+        # keep this connection out of the pool; it's listening for good
+        # (detaching drops raw's driver_connection, so take it first)
+        conn = raw.driver_connection
+        raw.detach()
+        conn.autocommit = True
+
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(f"LISTEN {CHANNEL}")
+                cursor.execute(LAST_VERSION_SQL)
+                self.catch_up(cursor.fetchone()[0])
+
+            while True:
+                if not select.select([conn], [], [], self.poll_seconds)[0]:
+                    # quiet: make sure the connection is still alive
+                    with conn.cursor() as cursor:
+                        cursor.execute("SELECT 1")
+
+                conn.poll()
+                while conn.notifies:
+                    self.receive(conn.notifies.pop(0).payload)
+
+        finally:
+            conn.close()
+
+
+invalidation_bus = InvalidationBus()
@@ -0,0 +1,241 @@
+"""Write-behind buffer for likes and unlikes."""
+
+import atexit
+import threading
+import time
+from collections import Counter
+
+from sqlalchemy.dialects.postgresql import insert
+
+from cafe_cards import count_likes
+from invalidation import invalidation_bus
+from models import db, Cafe, Like, LikeWrite
+from recommendations import recommender
+from trending import trending
+
+
+class LikeBuffer:
+    """Like/unlike writes held in memory and flushed in batches.
+
+    Only the latest write for each (user, cafe) is kept, so rapid toggling
+    costs at most one row change. Each write is stamped when recorded and
+    only written if newer than the last one written for that user & cafe
+    (see LikeWrite), so workers flushing in any order agree on the last
+    writer. The buffer is flushed when it holds
+    LIKE_BUFFER_MAX_SIZE writes, every LIKE_BUFFER_MAX_DELAY seconds, and
+    when the process exits. Recommendations and trending only count likes
+    once they're written (see record_like_changes).
+
+    The buffer belongs to one process, so views reading a user's likes
+    back settle() that user's writes first (see app.settle_pending_likes).
+
+    Off unless LIKE_WRITE_BEHIND is set.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.max_size = 500
+        self.max_delay = 1.0
+        self._app = None
+        self._pending = {}
+        self._last_stamp = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._timer = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("LIKE_WRITE_BEHIND", False)
+        app.config.setdefault("LIKE_BUFFER_MAX_SIZE", 500)
+        app.config.setdefault("LIKE_BUFFER_MAX_DELAY", 1.0)
+
+        self._app = app
+        self.enabled = app.config["LIKE_WRITE_BEHIND"]
+        self.max_size = app.config["LIKE_BUFFER_MAX_SIZE"]
+        self.max_delay = app.config["LIKE_BUFFER_MAX_DELAY"]
+
+        if self.enabled:
+            self.start()
+            atexit.register(self.flush)
+
+    def start(self):
+        """Start background flushing, unless already running."""
+
+        if self._timer and self._timer.is_alive():
+            return
+
+        def run():
+            while True:
+                time.sleep(self.max_delay)
+                try:
+                    self.flush()
+                except Exception:  # pragma: no cover
+                    self._app.logger.exception("Could not flush likes")
+
+        self._timer = threading.Thread(target=run, daemon=True)
+        self._timer.start()
+
+    def after_fork(self):
+        """In a forked child: forget the parent's writes, restart flushing.
+
+        The parent still flushes the writes it queued.
+        """
+
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+        if self.enabled:
+            self.start()
+
+    def record(self, user_id, cafe_id, liked):
+        """Queue a like (liked=True) or unlike (liked=False).
+
+        Returns the write's stamp, for settling it elsewhere (see settle).
+        """
+
+        with self._lock:
+            # later than any earlier write here, even if the clock is coarse
+            stamp = self._last_stamp = max(
+                time.time_ns(), self._last_stamp + 1)
+            self._pending[(user_id, cafe_id)] = (liked, stamp)
+            full = len(self._pending) >= self.max_size
+
+        if full:
+            self.flush()
+
+        return stamp
+
+    def _write(self, conn, batch):
+        """Write {(user id, cafe id): (liked, stamp)} on conn.
+
+        Writes no newer than the last written for their user & cafe are
+        skipped, as are likes already written, so writing one twice or late
+        is harmless. Returns (added, removed, cities) for
+        record_like_changes() once committed.
+        """
+
+        added = removed = []
+        cities = {}
+
+        if not batch:
+            return added, removed, cities
+
+        stamps = insert(LikeWrite).values([
+            {"user_id": u, "cafe_id": c, "stamp": stamp}
+            for (u, c), (liked, stamp) in batch.items()
+        ])
+        newer = conn.execute(
+            stamps.on_conflict_do_update(
+                index_elements=[LikeWrite.user_id, LikeWrite.cafe_id],
+                set_={"stamp": stamps.excluded.stamp},
+                where=LikeWrite.stamp < stamps.excluded.stamp)
+            .returning(LikeWrite.user_id, LikeWrite.cafe_id)
+        ).all()
+
+        batch = {tuple(key): batch[tuple(key)][0] for key in newer}
+        likes = [key for key, liked in batch.items() if liked]
+        unlikes = [key for key, liked in batch.items() if not liked]
+
+        if likes:
+            added = conn.execute(
+                insert(Like)
+                .values([{"user_id": u, "cafe_id": c} for u, c in likes])
+                .on_conflict_do_nothing()
+                .returning(Like.user_id, Like.cafe_id)
+            ).all()
+
+        if unlikes:
+            removed = conn.execute(
+                db.delete(Like)
+                .where(db.tuple_(Like.user_id, Like.cafe_id).in_(unlikes))
+                .returning(Like.user_id, Like.cafe_id)
+            ).all()
+
+        # cafe id -> change in likes, for the cafe cards
+        deltas = Counter(cafe_id for _, cafe_id in added)
+        deltas.subtract(cafe_id for _, cafe_id in removed)
+        count_likes(conn, deltas)
+
+        if added:
+            cities = dict(conn.execute(
+                db.select(Cafe.id, Cafe.city_code)
+                .where(Cafe.id.in_({cafe_id for _, cafe_id in added}))
+            ).all())
+
+        return added, removed, cities
+
+    def write(self, batch):
+        """Write a batch, as _write() takes it, in a transaction of its own."""
+
+        with self._app.app_context():
+            with db.engine.begin() as conn:
+                changes = self._write(conn, batch)
+
+            record_like_changes(*changes)
+
+    def settle(self, user_id, writes):
+        """Write user's likes {cafe id: (liked, stamp)} ahead of the buffer.
+
+        They're written and committed in db.session, so the rest of the
+        request reads them back. They may be queued in another process,
+        whose later flush of them then changes nothing.
+        """
+
+        batch = {
+            (user_id, cafe_id): write for cafe_id, write in writes.items()}
+        changes = self._write(db.session, batch)
+        db.session.commit()
+        record_like_changes(*changes)
+
+        with self._lock:
+            for key, write in batch.items():
+                if self._pending.get(key) == write:
+                    del self._pending[key]
+
+    def flush(self):
+        """Write all queued likes and unlikes in one transaction.
+
+        If the write fails, the writes are queued again (unless newer ones
+        for the same user & cafe arrived meanwhile) and the error re-raised.
+        """
+
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+
+            if not batch:
+                return
+
+            try:
+                self.write(batch)
+            except Exception:
+                with self._lock:
+                    for key, write in batch.items():
+                        self._pending.setdefault(key, write)
+                raise
+
+
+like_buffer = LikeBuffer()
+
+
+def record_like_changes(added, removed, cities):
+    """Count committed likes in recommendations and trending, everywhere.
+
+    added and removed are [(user id, cafe id)]; cities maps added cafes'
+    ids to their city codes. Other workers are told through the
+    invalidation bus (see app.apply_remote_like).
+    """
+
+    for user_id, cafe_id in added:
+        recommender.add_like(user_id, cafe_id)
+        trending.add_like(user_id, cafe_id, cities.get(cafe_id))
+
+    for user_id, cafe_id in removed:
+        recommender.remove_like(user_id, cafe_id)
+        trending.remove_like(user_id, cafe_id)
+
+    invalidation_bus.publish_all(
+        "likes", [list(key) for key in [*added, *removed]])
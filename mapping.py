@@ -1,12 +1,19 @@
+import logging
 import os
+import threading
 import urllib.request
 from dotenv import load_dotenv
 
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 API_KEY = os.environ.get("MAPQUEST_API_KEY")
 
+# seconds to wait on MapQuest before giving up
+MAP_TIMEOUT = 10
+
 def get_map_url(address, city_state):
     """Get MapQuest URL for a static map for this location."""
 
@@ -20,6 +27,26 @@ def save_map(id, address, city_state):
 
     path = os.path.abspath(os.path.dirname(__file__))
     full_path = f"{path}/static/maps/{id}.jpg"
+    tmp_path = f"{full_path}.tmp-{threading.get_ident()}"
     url = get_map_url(address, city_state)
 
-    urllib.request.urlretrieve(url.replace(' ', '%20'), full_path)
+    with urllib.request.urlopen(
+            url.replace(' ', '%20'), timeout=MAP_TIMEOUT) as resp:
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            f.write(resp.read())
+
+    # readers never see a half-written map
+    os.replace(tmp_path, full_path)
+
+
+def save_map_in_background(id, address, city_state):
+    """Save map in a background thread, so requests don't wait on MapQuest."""
+
+    def work():
+        try:
+            save_map(id, address, city_state)
+        except Exception:
+            logger.exception("Could not save map for cafe %s", id)
+
+    threading.Thread(target=work, daemon=True).start()
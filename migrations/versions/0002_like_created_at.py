@@ -0,0 +1,27 @@
+"""Add likes.created_at, for trending cafes.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-19 00:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # IF NOT EXISTS: some databases already added this by hand
+    op.execute(
+        "ALTER TABLE likes "
+        "ADD COLUMN IF NOT EXISTS created_at TIMESTAMP NOT NULL DEFAULT now()"
+    )
+
+
+def downgrade():
+    op.drop_column('likes', 'created_at')
@@ -0,0 +1,64 @@
+"""Add indexes for the hot queries.
+
+cafes.name orders the cafe list, cafes.city_code filters it by city and
+likes.cafe_id finds the likes of a cafe. Indexes are built CONCURRENTLY,
+so tables stay writable meanwhile.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-19 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ('ix_cafes_name', 'cafes', ['name']),
+    ('ix_cafes_city_code', 'cafes', ['city_code']),
+    ('ix_likes_cafe_id', 'likes', ['cafe_id']),
+]
+
+
+def drop_invalid_index(name, table):
+    """Drop index if an interrupted CONCURRENTLY build left it INVALID.
+
+    Otherwise if_not_exists would keep the broken index forever.
+    """
+
+    invalid = op.get_bind().execute(
+        sa.text(
+            "SELECT 1 FROM pg_index i "
+            "JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE c.relname = :name AND NOT i.indisvalid"),
+        {"name": name}
+    ).first()
+
+    if invalid:
+        op.drop_index(name, table_name=table, postgresql_concurrently=True)
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            drop_invalid_index(name, table)
+            op.create_index(
+                name,
+                table,
+                columns,
+                postgresql_concurrently=True,
+                if_not_exists=True
+            )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
@@ -0,0 +1,26 @@
+"""Add sequence numbering cache invalidation messages.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-19 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(sa.schema.CreateSequence(
+        sa.Sequence('cache_invalidation_version'), if_not_exists=True))
+
+
+def downgrade():
+    op.execute(sa.schema.DropSequence(
+        sa.Sequence('cache_invalidation_version')))
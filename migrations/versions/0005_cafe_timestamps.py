@@ -0,0 +1,66 @@
+"""Add cafes.created_at and cafes.updated_at, for the sitemap and feed.
+
+updated_at is indexed: the feed lists the most recently updated cafes.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-19 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def drop_invalid_index(name, table):
+    """Drop index if an interrupted CONCURRENTLY build left it INVALID.
+
+    Otherwise if_not_exists would keep the broken index forever.
+    """
+
+    invalid = op.get_bind().execute(
+        sa.text(
+            "SELECT 1 FROM pg_index i "
+            "JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE c.relname = :name AND NOT i.indisvalid"),
+        {"name": name}
+    ).first()
+
+    if invalid:
+        op.drop_index(name, table_name=table, postgresql_concurrently=True)
+
+
+def upgrade():
+    op.execute(
+        "ALTER TABLE cafes "
+        "ADD COLUMN IF NOT EXISTS created_at TIMESTAMP NOT NULL DEFAULT now(), "
+        "ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT now()"
+    )
+
+    with op.get_context().autocommit_block():
+        drop_invalid_index('ix_cafes_updated_at', 'cafes')
+        op.create_index(
+            'ix_cafes_updated_at',
+            'cafes',
+            ['updated_at'],
+            postgresql_concurrently=True,
+            if_not_exists=True
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            'ix_cafes_updated_at',
+            table_name='cafes',
+            postgresql_concurrently=True
+        )
+
+    op.drop_column('cafes', 'updated_at')
+    op.drop_column('cafes', 'created_at')
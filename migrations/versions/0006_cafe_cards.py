@@ -0,0 +1,59 @@
+"""Add cafe_cards, the read model behind the cafe list and detail pages.
+
+Cards are filled in from the existing cafes, cities and likes; after that
+the app keeps them current.
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-19 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'cafe_cards',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.Text(), nullable=False),
+        sa.Column('description', sa.Text(), nullable=False),
+        sa.Column('url', sa.Text(), nullable=False),
+        sa.Column('address', sa.Text(), nullable=False),
+        sa.Column('city_code', sa.Text(), nullable=False),
+        sa.Column('city_state', sa.Text(), nullable=False),
+        sa.Column('image_url', sa.Text(), nullable=False),
+        sa.Column('map_path', sa.Text(), nullable=False),
+        sa.Column('like_count', sa.Integer(), server_default='0',
+                  nullable=False),
+        sa.ForeignKeyConstraint(['id'], ['cafes.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_cafe_cards_name', 'cafe_cards', ['name'])
+    op.create_index(
+        'ix_cafe_cards_city_code_name', 'cafe_cards', ['city_code', 'name'])
+
+    op.execute("""
+        INSERT INTO cafe_cards (id, name, description, url, address,
+                                city_code, city_state, image_url, map_path,
+                                like_count)
+        SELECT c.id, c.name, c.description, c.url, c.address,
+               c.city_code, ci.name || ', ' || ci.state, c.image_url,
+               'maps/' || c.id || '.jpg',
+               (SELECT count(*) FROM likes l WHERE l.cafe_id = c.id)
+        FROM cafes c
+        JOIN cities ci ON ci.code = c.city_code
+    """)
+
+
+def downgrade():
+    op.drop_index('ix_cafe_cards_city_code_name', table_name='cafe_cards')
+    op.drop_index('ix_cafe_cards_name', table_name='cafe_cards')
+    op.drop_table('cafe_cards')
@@ -0,0 +1,34 @@
+"""Add like_writes, stamping each user & cafe's last buffered like change.
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-19 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0007'
+down_revision = '0006'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'like_writes',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('cafe_id', sa.Integer(), nullable=False),
+        sa.Column('stamp', sa.BigInteger(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'],
+                                ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['cafe_id'], ['cafes.id'],
+                                ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('user_id', 'cafe_id')
+    )
+
+
+def downgrade():
+    op.drop_table('like_writes')
@@ -1,14 +1,19 @@
 """Data models for Flask Cafe"""
 
 
+from collections import namedtuple
+from datetime import datetime
+
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import IntegrityError
 
 from mapping import save_map
+from replicas import RoutingSession
 
 
 bcrypt = Bcrypt()
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 
 
 class City(db.Model):
@@ -45,6 +50,7 @@ class Cafe(db.Model):
     name = db.Column(
         db.Text,
         nullable=False,
+        index=True,
     )
 
     description = db.Column(
@@ -66,6 +72,7 @@ class Cafe(db.Model):
         db.Text,
         db.ForeignKey('cities.code'),
         nullable=False,
+        index=True,
     )
 
     image_url = db.Column(
@@ -74,6 +81,22 @@ class Cafe(db.Model):
         default="/static/images/default-cafe.jpg",
     )
 
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=db.func.now(),
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+        server_default=db.func.now(),
+        index=True,
+    )
+
     city = db.relationship("City", backref='cafes')
 
     # liking_users <-> user.liked_cafes
@@ -95,6 +118,176 @@ class Cafe(db.Model):
 
         save_map(self.id, address, city_state)
 
+    @classmethod
+    def get_detail(cls, cafe_id, user_id=None):
+        """Return CafeDetail for cafe, or None if there is no such cafe.
+
+        Read from the cafe's card, with whether user_id likes the cafe, in a
+        single statement. A cafe with no card yet (say, its card write
+        failed) is read from the cafe tables instead, and its card written.
+        """
+
+        def liked(id_column):
+            return db.exists().where(
+                Like.cafe_id == id_column,
+                Like.user_id == user_id,
+            )
+
+        row = db.session.execute(
+            db.select(*CafeCard.__table__.columns, liked(CafeCard.id))
+            .where(CafeCard.id == cafe_id)
+        ).first()
+
+        if row is None:
+            row = db.session.execute(
+                card_query()
+                .add_columns(liked(cls.id))
+                .where(cls.id == cafe_id)
+            ).first()
+
+            if row is None:
+                return None
+
+            write_missing_card(cafe_id)
+
+        return CafeDetail(*row)
+
+
+class CafeCard(db.Model):
+    """What the cafe list and detail pages show of a cafe, in one row.
+
+    A read model, written by cafe_cards.py as cafes, cities and likes
+    change, and by Cafe.get_detail() for a cafe found without one; rebuild
+    it with `flask rebuild-cafe-cards`.
+    """
+
+    __tablename__ = 'cafe_cards'
+
+    __table_args__ = (
+        db.Index('ix_cafe_cards_city_code_name', 'city_code', 'name'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        db.ForeignKey('cafes.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    name = db.Column(
+        db.Text,
+        nullable=False,
+        index=True,
+    )
+
+    description = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    url = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    address = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    city_code = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # 'city, state'
+    city_state = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    image_url = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # of the cafe's map, under static/
+    map_path = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    def __repr__(self):
+        return f'<CafeCard id={self.id} name="{self.name}">'
+
+
+def card_query():
+    """Return select of card rows, in CafeCard's column order."""
+
+    like_count = (
+        db.select(db.func.count())
+        .where(Like.cafe_id == Cafe.id)
+        .scalar_subquery()
+    )
+
+    return (
+        db.select(
+            Cafe.id,
+            Cafe.name,
+            Cafe.description,
+            Cafe.url,
+            Cafe.address,
+            Cafe.city_code,
+            City.name + ", " + City.state,
+            Cafe.image_url,
+            # where mapping.save_map() puts the cafe's map
+            db.literal("maps/") + db.cast(Cafe.id, db.Text) + ".jpg",
+            like_count,
+        )
+        .join(Cafe.city)
+    )
+
+
+def write_missing_card(cafe_id):
+    """Write the card for a cafe that has none.
+
+    Uses a primary connection of its own, so it works while the session
+    reads from a replica and doesn't commit the caller's changes.
+    """
+
+    cards = CafeCard.__table__
+
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(cards.insert().from_select(
+                [column.key for column in cards.c],
+                card_query().where(Cafe.id == cafe_id)))
+    except IntegrityError:
+        # another request wrote it first
+        pass
+
+
+class CafeDetail(namedtuple("CafeDetail", [
+        column.key for column in CafeCard.__table__.columns] + ["liked"])):
+    """Read-only view of a cafe's card for its detail page.
+
+    Unlike a CafeCard, this is not tracked by the session.
+    """
+
+    __slots__ = ()
+
+    def get_city_state(self):
+        """Return 'city, state' for cafe."""
+
+        return self.city_state
+
+
 class User(db.Model):
     """User information."""
 
@@ -157,6 +350,45 @@ class User(db.Model):
     def get_full_name(self):
         return f'{self.first_name} {self.last_name}'
 
+    def count_liked_cafes(self, up_to=None):
+        """Return number of cafes user likes, counting no more than up_to."""
+
+        likes = db.select(Like.cafe_id).where(Like.user_id == self.id)
+
+        if up_to is not None:
+            likes = likes.limit(up_to)
+
+        return db.session.scalar(
+            db.select(db.func.count()).select_from(likes.subquery()))
+
+    def get_liked_cafes_page(self, after=None, per_page=20):
+        """Return (rows, next_after) for one page of cafes user likes.
+
+        Rows have only id and name, and are ordered by cafe id: the likes
+        primary key, so each page is a short index range scan however many
+        likes the user has. Pass after=the id of the last row on a page to
+        get the next page; next_after is None on the last page.
+        """
+
+        query = (
+            db.select(Cafe.id, Cafe.name)
+            .select_from(Like)
+            .join(Cafe, Cafe.id == Like.cafe_id)
+            .where(Like.user_id == self.id)
+            .order_by(Like.cafe_id)
+            .limit(per_page + 1)
+        )
+
+        if after is not None:
+            query = query.where(Like.cafe_id > after)
+
+        rows = db.session.execute(query).all()
+
+        if len(rows) > per_page:
+            return rows[:per_page], rows[per_page - 1].id
+
+        return rows, None
+
     @classmethod
     def register(
             cls,
@@ -222,16 +454,51 @@ class Like(db.Model):
     cafe_id = db.Column(
         db.Integer,
         db.ForeignKey('cafes.id'),
+        primary_key=True,
+        index=True
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=db.func.now()
+    )
+
+
+
+class LikeWrite(db.Model):
+    """When a user's like or unlike of a cafe was last written.
+
+    Stamps are time.time_ns() of the request that made the change; the
+    like buffer only writes changes newer than the stamp here, so a stale
+    write flushed late by one worker can't undo a newer one from another.
+    """
+
+    __tablename__ = "like_writes"
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True
+    )
+
+    cafe_id = db.Column(
+        db.Integer,
+        db.ForeignKey('cafes.id', ondelete='CASCADE'),
         primary_key=True
     )
 
+    stamp = db.Column(
+        db.BigInteger,
+        nullable=False
+    )
 
 def connect_db(app):
     """Connect this database to provided Flask app.
 
-    You should call this in your Flask app.
+    You should call this in your Flask app. It doesn't push an app context:
+    code using the database outside requests needs `with app.app_context()`.
     """
 
-    app.app_context().push()
-    db.app = app
     db.init_app(app)
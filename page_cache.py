@@ -0,0 +1,184 @@
+"""Cache of whole pages rendered for logged-out visitors."""
+
+import functools
+import hashlib
+import json
+import os
+import tempfile
+import time
+from urllib.parse import urlencode
+
+from flask import current_app, request, session
+
+
+# prefix of pages being written, which clear() leaves alone
+TMP_PREFIX = ".tmp"
+
+# seconds after which prune() deletes a page that was never finished
+ABANDONED_SECONDS = 60 * 60
+
+
+class PageCache:
+    """Rendered pages stored on disk, shared by all workers on a host.
+
+    Pages are keyed by path and the query args the view reads (any others
+    are ignored), and expire after PAGE_CACHE_TTL seconds, or when clear()
+    is called. Expired pages are deleted once per TTL. Requests whose
+    session holds any of PAGE_CACHE_BYPASS_KEYS (a logged-in user or
+    flashed messages) neither read nor fill the cache.
+    """
+
+    def __init__(self, app=None):
+        self.directory = None
+        self.ttl = 60
+        self._pruned_at = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("PAGE_CACHE_ENABLED", True)
+        app.config.setdefault("PAGE_CACHE_TTL", 60)
+        app.config.setdefault(
+            "PAGE_CACHE_DIR", os.path.join(app.instance_path, "page_cache"))
+        app.config.setdefault("PAGE_CACHE_BYPASS_KEYS", ("curr_user", "_flashes"))
+
+        self.ttl = app.config["PAGE_CACHE_TTL"]
+        self.directory = app.config["PAGE_CACHE_DIR"]
+
+    def _path(self, key):
+        digest = hashlib.sha1(key.encode("utf8")).hexdigest()
+        return os.path.join(self.directory, digest)
+
+    def get(self, key):
+        """Return (mimetype, body) of cached page, or None."""
+
+        path = self._path(key)
+
+        try:
+            if os.stat(path).st_mtime + self.ttl < time.time():
+                return None
+
+            with open(path, "rb") as f:
+                meta = json.loads(f.readline())
+                return meta["mimetype"], f.read()
+
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, mimetype, body):
+        """Store page, replacing any cached copy atomically."""
+
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=TMP_PREFIX)
+
+        with os.fdopen(fd, "wb") as f:
+            f.write(json.dumps({"key": key, "mimetype": mimetype}).encode())
+            f.write(b"\n")
+            f.write(body)
+
+        os.replace(tmp, self._path(key))
+
+        if self._pruned_at + self.ttl < time.time():
+            self.prune()
+
+    def _names(self):
+        try:
+            return os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+
+    def _unlink(self, name):
+        try:
+            os.unlink(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+
+    def prune(self):
+        """Delete expired pages, and partial writes abandoned long ago."""
+
+        now = self._pruned_at = time.time()
+
+        for name in self._names():
+            try:
+                mtime = os.stat(os.path.join(self.directory, name)).st_mtime
+            except FileNotFoundError:
+                continue
+
+            if name.startswith(TMP_PREFIX):
+                max_age = ABANDONED_SECONDS
+            else:
+                max_age = self.ttl
+
+            if mtime + max_age < now:
+                self._unlink(name)
+
+    def clear(self):
+        """Expire every cached page."""
+
+        for name in self._names():
+            # pages being written belong to other requests
+            if not name.startswith(TMP_PREFIX):
+                self._unlink(name)
+
+    def bypass(self):
+        """Should this request skip the cache?"""
+
+        config = current_app.config
+        keys = config["PAGE_CACHE_BYPASS_KEYS"]
+
+        return (
+            not config["PAGE_CACHE_ENABLED"]
+            or request.method not in ("GET", "HEAD")
+            or any(key in session for key in keys)
+        )
+
+    def cached(self, view=None, *, args=()):
+        """Decorator: serve view from the cache for logged-out visitors.
+
+        args names the query args the view reads; they're part of the key.
+
+            @page_cache.cached
+            @page_cache.cached(args=("city",))
+        """
+
+        if view is None:
+            return functools.partial(self.cached, args=args)
+
+        @functools.wraps(view)
+        def wrapper(*view_args, **kwargs):
+            if self.bypass():
+                return view(*view_args, **kwargs)
+
+            key = request.path
+            query = [
+                (arg, value)
+                for arg in sorted(args)
+                for value in request.args.getlist(arg)
+            ]
+            if query:
+                key += "?" + urlencode(query)
+            hit = self.get(key)
+
+            if hit is not None:
+                mimetype, body = hit
+                resp = current_app.response_class(body, mimetype=mimetype)
+                resp.headers["X-Page-Cache"] = "HIT"
+                return resp
+
+            resp = current_app.make_response(view(*view_args, **kwargs))
+
+            # pages that set cookies are specific to this visitor
+            if (resp.status_code == 200
+                    and not resp.is_streamed
+                    and not resp.cache_control.no_store
+                    and not session.modified):
+                self.set(key, resp.mimetype, resp.get_data())
+                resp.headers["X-Page-Cache"] = "MISS"
+
+            return resp
+
+        return wrapper
+
+
+page_cache = PageCache()
@@ -0,0 +1,142 @@
+"""Item-to-item cafe recommendations from likes."""
+
+import heapq
+import math
+import threading
+from collections import Counter, defaultdict
+
+from models import db, Like
+
+
+class CafeRecommender:
+    """In-memory index of cafes liked by the same users.
+
+    Similarity of two cafes is the cosine of their like vectors:
+    co-likes / sqrt(likes of a * likes of b). Co-like counts are kept as a
+    sparse map that is updated as likes change, and each cafe's top-k list
+    is recomputed the next time it's asked for after a change.
+
+    The index is loaded from the likes table on first use.
+    """
+
+    def __init__(self, k=5):
+        self.k = k
+        self._lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        """Forget everything; the index is reloaded on next use."""
+
+        with self._lock:
+            self._loaded = False
+            self._user_cafes = defaultdict(set)
+            self._like_counts = Counter()
+            self._co_likes = defaultdict(Counter)
+            self._top = {}
+
+    def load(self, likes=None):
+        """Build index from (user_id, cafe_id) pairs.
+
+        likes defaults to every row of the likes table.
+        """
+
+        with self._lock:
+            if likes is None:
+                likes = db.session.execute(
+                    db.select(Like.user_id, Like.cafe_id)
+                ).all()
+
+            self.reset()
+
+            for user_id, cafe_id in likes:
+                self._add(user_id, cafe_id)
+
+            self._loaded = True
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+
+    def _forget_top(self, cafe_id):
+        """Drop cached top-k of cafe and of every cafe whose score with it
+        may have changed."""
+
+        self._top.pop(cafe_id, None)
+        for other in self._co_likes.get(cafe_id, ()):
+            self._top.pop(other, None)
+
+    def _add(self, user_id, cafe_id):
+        cafes = self._user_cafes[user_id]
+        if cafe_id in cafes:
+            return
+
+        for other in cafes:
+            self._co_likes[cafe_id][other] += 1
+            self._co_likes[other][cafe_id] += 1
+
+        cafes.add(cafe_id)
+        self._like_counts[cafe_id] += 1
+        self._forget_top(cafe_id)
+
+    def _remove(self, user_id, cafe_id):
+        cafes = self._user_cafes.get(user_id)
+        if not cafes or cafe_id not in cafes:
+            return
+
+        self._forget_top(cafe_id)
+        cafes.discard(cafe_id)
+
+        for other in cafes:
+            for a, b in ((cafe_id, other), (other, cafe_id)):
+                self._co_likes[a][b] -= 1
+                if self._co_likes[a][b] <= 0:
+                    del self._co_likes[a][b]
+
+        self._like_counts[cafe_id] -= 1
+        if self._like_counts[cafe_id] <= 0:
+            del self._like_counts[cafe_id]
+
+    def add_like(self, user_id, cafe_id):
+        """Record that user likes cafe. (No-op until the index is loaded.)"""
+
+        with self._lock:
+            if self._loaded:
+                self._add(user_id, cafe_id)
+
+    def remove_like(self, user_id, cafe_id):
+        """Record that user unliked cafe. (No-op until the index is loaded.)"""
+
+        with self._lock:
+            if self._loaded:
+                self._remove(user_id, cafe_id)
+
+    def like_count(self, cafe_id):
+        """Return number of users who like cafe."""
+
+        self._ensure_loaded()
+        return self._like_counts.get(cafe_id, 0)
+
+    def similar(self, cafe_id, k=None):
+        """Return up to k [(cafe_id, score), ...], most similar first."""
+
+        self._ensure_loaded()
+
+        with self._lock:
+            top = self._top.get(cafe_id)
+
+            if top is None:
+                count = self._like_counts.get(cafe_id, 0)
+                scores = (
+                    (co / math.sqrt(count * self._like_counts[other]), other)
+                    for other, co in self._co_likes.get(cafe_id, {}).items()
+                )
+                top = [
+                    (other, score) for score, other in
+                    heapq.nlargest(self.k, scores, key=lambda s: (s[0], -s[1]))
+                ]
+                self._top[cafe_id] = top
+
+        return top[:k or self.k]
+
+
+recommender = CafeRecommender()
@@ -0,0 +1,307 @@
+"""Replay recorded traffic against a running Flask Cafe and compare builds.
+
+Record traces in production or staging with TRAFFIC_CAPTURE_PATH (see
+traffic.py), then replay them against two builds started locally on the
+same data:
+
+    python replay.py traffic.ndjson http://localhost:8000 http://localhost:8001
+
+or against one build at a time, saving the first run to compare with:
+
+    python replay.py traffic.ndjson http://localhost:8000 --save before.json
+    python replay.py traffic.ndjson http://localhost:8000 --baseline before.json
+
+Requests are sent at their recorded pace, sped up by --speedup, with at
+most --concurrency in flight. Logged-in requests get a session cookie
+signed with the app's SECRET_KEY. Recorded strings were replaced with
+placeholders, so form posts mostly come back as validation errors (which
+still exercises the view). Latency percentiles are printed per endpoint;
+endpoints whose median or 95th percentile got more than --threshold slower
+than the baseline are flagged as regressions.
+"""
+
+import argparse
+import json
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from flask.sessions import SecureCookieSessionInterface
+from itsdangerous import URLSafeTimedSerializer
+
+from config import get_config
+from traffic import STRING, USER_KEY
+
+
+# endpoints with fewer replayed requests aren't compared
+MIN_SAMPLES = 5
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Time each request on its own, without following redirects."""
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+opener = urllib.request.build_opener(NoRedirect)
+
+
+def load_traces(path, limit=None):
+    """Return traces from NDJSON file, oldest first."""
+
+    with open(path) as f:
+        traces = [json.loads(line) for line in f if line.strip()]
+
+    traces.sort(key=lambda trace: trace["ts"])
+    return traces[:limit]
+
+
+def fill(shape):
+    """Return a body matching a recorded shape, with strings left empty."""
+
+    if isinstance(shape, dict):
+        return {key: fill(item) for key, item in shape.items()}
+
+    if isinstance(shape, list):
+        return [fill(item) for item in shape]
+
+    if shape == STRING:
+        return ""
+
+    return shape
+
+
+def make_cookie_factory(config=None):
+    """Return function from user id to Cookie header logging them in.
+
+    Cookies are signed the way Flask's session interface signs them, with
+    the SECRET_KEY of config (a config name; see config.py). The app isn't
+    created, so none of its background threads or checks start.
+    """
+
+    config = get_config(config)
+    interface = SecureCookieSessionInterface()
+    serializer = URLSafeTimedSerializer(
+        config.SECRET_KEY,
+        salt=interface.salt,
+        serializer=interface.serializer,
+        signer_kwargs={
+            "key_derivation": interface.key_derivation,
+            "digest_method": interface.digest_method,
+        })
+    name = getattr(config, "SESSION_COOKIE_NAME", "session")
+    cookies = {}
+
+    def cookie(user_id):
+        if user_id not in cookies:
+            value = serializer.dumps({USER_KEY: user_id})
+            cookies[user_id] = f"{name}={value}"
+        return cookies[user_id]
+
+    return cookie
+
+
+def build_request(base_url, trace, cookie=None):
+    """Return urllib Request re-issuing trace against base_url."""
+
+    url = base_url.rstrip("/") + trace["path"]
+    if trace["args"]:
+        url += "?" + urlencode(trace["args"], doseq=True)
+
+    headers = {}
+    body = None
+
+    if "json" in trace:
+        body = json.dumps(fill(trace["json"])).encode()
+        headers["Content-Type"] = "application/json"
+    elif "form" in trace:
+        body = urlencode(fill(trace["form"])).encode()
+        headers["Content-Type"] = "application/x-www-form-urlencoded"
+
+    if trace["user_id"] is not None and cookie is not None:
+        headers["Cookie"] = cookie(trace["user_id"])
+
+    return urllib.request.Request(
+        url, data=body, method=trace["method"], headers=headers)
+
+
+def endpoint_of(trace):
+    return trace["endpoint"] or f"{trace['method']} {trace['path']}"
+
+
+def send(req):
+    """Make request; return (status, seconds taken)."""
+
+    started = time.perf_counter()
+
+    try:
+        with opener.open(req) as resp:
+            resp.read()
+            status = resp.status
+    except urllib.error.HTTPError as e:
+        e.read()
+        status = e.code
+    except urllib.error.URLError:
+        status = None
+
+    return status, time.perf_counter() - started
+
+
+def replay(traces, base_url, cookie=None, concurrency=8, speedup=1.0):
+    """Re-issue traces at their recorded pace.
+
+    Returns {endpoint: {"latencies": [...], "errors": count}}, where errors
+    are responses whose status differs from the recorded one.
+    """
+
+    results = {}
+    lock = threading.Lock()
+
+    def run(trace):
+        status, seconds = send(build_request(base_url, trace, cookie))
+
+        with lock:
+            result = results.setdefault(
+                endpoint_of(trace), {"latencies": [], "errors": 0})
+            result["latencies"].append(seconds)
+            if status != trace["status"]:
+                result["errors"] += 1
+
+    if not traces:
+        return results
+
+    first = traces[0]["ts"]
+    started = time.perf_counter()
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        for trace in traces:
+            delay = (trace["ts"] - first) / speedup - (
+                time.perf_counter() - started)
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(run, trace)
+
+    return results
+
+
+def percentiles(latencies):
+    """Return (median, 95th percentile) in milliseconds."""
+
+    if len(latencies) == 1:
+        return latencies[0] * 1000, latencies[0] * 1000
+
+    pct = statistics.quantiles(latencies, n=100)
+    return pct[49] * 1000, pct[94] * 1000
+
+
+def summarize(results):
+    """Return {endpoint: {"count", "p50", "p95", "errors"}}."""
+
+    summary = {}
+
+    for endpoint, result in sorted(results.items()):
+        p50, p95 = percentiles(result["latencies"])
+        summary[endpoint] = {
+            "count": len(result["latencies"]),
+            "p50": round(p50, 2),
+            "p95": round(p95, 2),
+            "errors": result["errors"],
+        }
+
+    return summary
+
+
+def compare(baseline, current, threshold=0.1):
+    """Return [(endpoint, before, after)] of endpoints that got slower.
+
+    An endpoint regressed if its median or 95th percentile grew by more
+    than threshold (a fraction), with MIN_SAMPLES requests in both runs.
+    """
+
+    regressions = []
+
+    for endpoint, after in current.items():
+        before = baseline.get(endpoint)
+
+        if (before is None
+                or min(before["count"], after["count"]) < MIN_SAMPLES):
+            continue
+
+        if any(after[key] > before[key] * (1 + threshold)
+               for key in ("p50", "p95")):
+            regressions.append((endpoint, before, after))
+
+    return regressions
+
+
+def print_summary(label, summary):
+    print(label)
+
+    for endpoint, stats in summary.items():
+        print(f"  {endpoint:<32} {stats['count']:6} reqs"
+              f"   p50 {stats['p50']:8.1f} ms   p95 {stats['p95']:8.1f} ms"
+              f"   {stats['errors']} status changes")
+
+
+def print_comparison(baseline, current, threshold):
+    regressions = compare(baseline, current, threshold)
+
+    if not regressions:
+        print(f"No endpoint more than {threshold:.0%} slower.")
+        return
+
+    print(f"Regressions (more than {threshold:.0%} slower):")
+
+    for endpoint, before, after in regressions:
+        print(f"  {endpoint:<32}"
+              f" p50 {before['p50']:8.1f} -> {after['p50']:8.1f} ms"
+              f"   p95 {before['p95']:8.1f} -> {after['p95']:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("traces")
+    parser.add_argument("base_urls", nargs="+", metavar="base_url",
+                        help="one build, or a baseline build then another")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--speedup", type=float, default=1.0)
+    parser.add_argument("--limit", type=int)
+    parser.add_argument("--config", default="production",
+                        help="config whose SECRET_KEY signs session cookies")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    parser.add_argument("--save", help="write last run's summary here")
+    parser.add_argument("--baseline", help="summary saved by an earlier run")
+    args = parser.parse_args()
+
+    traces = load_traces(args.traces, args.limit)
+    cookie = None
+    if any(trace["user_id"] is not None for trace in traces):
+        cookie = make_cookie_factory(args.config)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    for base_url in args.base_urls:
+        summary = summarize(replay(
+            traces, base_url, cookie, args.concurrency, args.speedup))
+        print_summary(f"{len(traces)} requests to {base_url}", summary)
+
+        if baseline is not None:
+            print_comparison(baseline, summary, args.threshold)
+
+        baseline = summary
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
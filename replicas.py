@@ -0,0 +1,190 @@
+"""Send reads from safe GET handlers to read replicas."""
+
+import functools
+import itertools
+import logging
+import threading
+import time
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event, text
+
+
+logger = logging.getLogger(__name__)
+
+# session key holding when this browser session last wrote to the primary
+WROTE_AT_KEY = "wrote_at"
+
+# seconds a replica is behind; 0 if it has replayed everything it received
+LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+"""
+
+
+class ReplicaSet:
+    """Engines for read replicas, health checked in a background thread.
+
+    A replica is healthy if it answers within REPLICA_CONNECT_TIMEOUT and is
+    no more than REPLICA_MAX_LAG_SECONDS behind the primary. Until the first
+    check finishes, every read goes to the primary.
+    """
+
+    def __init__(self):
+        self.engines = []
+        self.healthy = []
+        self.max_lag = 5
+        self.check_interval = 10
+        self._counter = itertools.count()
+        self._checker = None
+
+    def init_app(self, app):
+        app.config.setdefault("SQLALCHEMY_REPLICA_URIS", [])
+        app.config.setdefault("REPLICA_MAX_LAG_SECONDS", 5)
+        app.config.setdefault("REPLICA_CHECK_INTERVAL_SECONDS", 10)
+        app.config.setdefault("REPLICA_STICKY_SECONDS", 10)
+        app.config.setdefault("REPLICA_CONNECT_TIMEOUT", 3)
+
+        self.max_lag = app.config["REPLICA_MAX_LAG_SECONDS"]
+        self.check_interval = app.config["REPLICA_CHECK_INTERVAL_SECONDS"]
+        self.engines = [
+            create_engine(
+                uri,
+                pool_pre_ping=True,
+                connect_args={
+                    "connect_timeout": app.config["REPLICA_CONNECT_TIMEOUT"]
+                })
+            for uri in app.config["SQLALCHEMY_REPLICA_URIS"]
+        ]
+        self.healthy = []
+
+        # checked in the background, so startup doesn't wait on replicas
+        if self.engines:
+            self.start()
+
+    def check(self):
+        """Update list of healthy replicas.
+
+        A replica whose check fails in any way (not only with a database
+        error: pool timeouts, socket errors, odd lag values) is unhealthy.
+        """
+
+        healthy = []
+
+        for engine in self.engines:
+            try:
+                with engine.connect() as conn:
+                    lag = conn.execute(text(LAG_SQL)).scalar()
+
+                if lag is None or lag <= self.max_lag:
+                    healthy.append(engine)
+            except Exception as e:
+                logger.warning("Replica %s is unhealthy: %s", engine.url, e)
+
+        self.healthy = healthy
+
+    def start(self):
+        """Start background health checks, unless already running."""
+
+        if self._checker and self._checker.is_alive():
+            return
+
+        def run():
+            while True:
+                try:
+                    self.check()
+                except Exception:
+                    logger.exception("Could not check replicas")
+
+                time.sleep(self.check_interval)
+
+        self._checker = threading.Thread(target=run, daemon=True)
+        self._checker.start()
+
+    def after_fork(self):
+        """In a forked child: drop the parent's connections, restart checks."""
+
+        for engine in self.engines:
+            engine.dispose(close=False)
+
+        if self.engines:
+            self.start()
+
+    def choose(self):
+        """Return next healthy replica engine, or None if there are none."""
+
+        healthy = self.healthy
+        if not healthy:
+            return None
+
+        return healthy[next(self._counter) % len(healthy)]
+
+
+replicas = ReplicaSet()
+
+
+class RoutingSession(Session):
+    """Session that reads from a replica when the view allows it.
+
+    A request reads from one replica throughout, so its reads agree with
+    each other. Flushes and INSERT/UPDATE/DELETE statements always use the
+    primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        # a session bound to one connection (as in tests) uses only that
+        if bind is None and self.bind is not None:
+            return self.bind
+
+        if (bind is None
+                and not self._flushing
+                and not getattr(clause, "is_dml", False)
+                and has_request_context()
+                and g.get("read_replica")):
+            if "replica" not in g:
+                g.replica = replicas.choose()
+            if g.replica is not None:
+                return g.replica
+
+        return super().get_bind(
+            mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def mark_write():
+    """Keep this browser session on the primary for a while."""
+
+    session[WROTE_AT_KEY] = time.time()
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def remember_write(db_session, flush_context):
+    """Read from the primary for a while after any write in a request."""
+
+    if has_request_context():
+        mark_write()
+
+
+def read_replica(view):
+    """Let this GET handler read from a replica.
+
+    Sessions that wrote within REPLICA_STICKY_SECONDS keep reading from the
+    primary, so users see their own changes.
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        sticky = current_app.config.get("REPLICA_STICKY_SECONDS", 10)
+        wrote_at = session.get(WROTE_AT_KEY, 0)
+
+        g.read_replica = (
+            request.method in ("GET", "HEAD")
+            and wrote_at + sticky < time.time()
+        )
+
+        return view(*args, **kwargs)
+
+    return wrapper
@@ -1,17 +1,20 @@
 """Initial data."""
 
-from models import City, Cafe, User, db, connect_db
-from flask import Flask
+from models import City, Cafe, User, db
+from flask_migrate import upgrade
 
-app = Flask(__name__)
+from cafe_cards import rebuild_cafe_cards
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///flask_cafe'
-app.config['SQLALCHEMY_ECHO'] = False
+from app import create_app, init_migrate
 
-connect_db(app)
+app = create_app(SQLALCHEMY_ECHO=False, INVALIDATION_BUS_ENABLED=False)
+init_migrate(app)
+app.app_context().push()
 
 db.drop_all()
-db.create_all()
+db.session.execute(db.text("DROP TABLE IF EXISTS alembic_version"))
+db.session.commit()
+upgrade()
 
 
 #######################################
@@ -86,6 +89,9 @@ ua.liked_cafes.append(c1)
 
 db.session.commit()
 
+# likes added here bypass the like views, which keep card counts current
+rebuild_cafe_cards()
+
 
 #######################################
 # cafe maps
@@ -0,0 +1,256 @@
+"""Sitemap and Atom feed of cafes, streamed from server-side cursors."""
+
+from datetime import datetime
+import threading
+from xml.sax.saxutils import escape
+
+from flask import Response, abort, current_app, stream_with_context
+
+from models import db, Cafe, City
+
+
+# rows fetched from the cursor at a time
+YIELD_PER = 1000
+
+SITEMAP_NS = "http://www.sitemaps.org/schemas/sitemap/0.9"
+ATOM_NS = "http://www.w3.org/2005/Atom"
+
+
+def w3c_datetime(when):
+    return when.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class SitemapCache:
+    """Generated sitemap documents and feed, by name.
+
+    URLs in them start with SITE_URL, never the request's Host header, so
+    each document is stored once. Names are "sitemap" (the index, or the
+    only sitemap), "pages", "cafes-<shard>" and "feed". Cafe ids are sharded
+    into ranges of max_urls, so a cafe change only expires its own shard;
+    only shards up to the highest cafe id's are served, which bounds how
+    many there are.
+    """
+
+    def __init__(self):
+        self.max_urls = 50000
+        self.base_url = "http://localhost/"
+        self._docs = {}
+        self._version = 0
+        self._lock = threading.Lock()
+
+    @property
+    def version(self):
+        return self._version
+
+    def get(self, name):
+        return self._docs.get(name)
+
+    def set(self, name, body, version):
+        """Store document, unless something expired since version."""
+
+        with self._lock:
+            if version == self._version:
+                self._docs[name] = body
+
+    def expire(self, *names):
+        with self._lock:
+            self._version += 1
+            for name in names:
+                self._docs.pop(name, None)
+
+    def expire_cafe(self, cafe_id):
+        self.expire("sitemap", f"cafes-{cafe_id // self.max_urls}", "feed")
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._docs.clear()
+
+
+sitemap_cache = SitemapCache()
+
+
+def cached_xml(name, generate, mimetype):
+    """Return response streaming generate()'s chunks, caching the result.
+
+    Once cached, the document is sent whole.
+    """
+
+    host = sitemap_cache.base_url
+    body = sitemap_cache.get(name)
+
+    if body is not None:
+        return Response(body, mimetype=mimetype)
+
+    version = sitemap_cache.version
+
+    def stream():
+        chunks = []
+
+        for chunk in generate(host):
+            chunks.append(chunk)
+            yield chunk
+
+        sitemap_cache.set(name, "".join(chunks).encode(), version)
+
+    return Response(stream_with_context(stream()), mimetype=mimetype)
+
+
+def _streamed(query):
+    return db.session.execute(query.execution_options(yield_per=YIELD_PER))
+
+
+def _url(loc, lastmod=None):
+    if lastmod is None:
+        return f"<url><loc>{escape(loc)}</loc></url>\n"
+
+    return (f"<url><loc>{escape(loc)}</loc>"
+            f"<lastmod>{w3c_datetime(lastmod)}</lastmod></url>\n")
+
+
+def page_urls(host):
+    yield _url(f"{host}")
+    yield _url(f"{host}cafes")
+
+    for (code,) in _streamed(db.select(City.code).order_by(City.code)):
+        yield _url(f"{host}cities/{code}")
+
+
+def cafe_urls(host, shard=None):
+    query = db.select(Cafe.id, Cafe.updated_at).order_by(Cafe.id)
+
+    if shard is not None:
+        size = sitemap_cache.max_urls
+        query = query.where(
+            Cafe.id >= shard * size, Cafe.id < (shard + 1) * size)
+
+    for id, updated_at in _streamed(query):
+        yield _url(f"{host}cafes/{id}", updated_at)
+
+
+def urlset(*sources):
+    def generate(host):
+        yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+        yield f'<urlset xmlns="{SITEMAP_NS}">\n'
+        for source in sources:
+            yield from source(host)
+        yield "</urlset>\n"
+
+    return generate
+
+
+def sitemap_index(host):
+    size = sitemap_cache.max_urls
+    shards = _streamed(
+        db.select(Cafe.id // size, db.func.max(Cafe.updated_at))
+        .group_by(Cafe.id // size)
+        .order_by(Cafe.id // size)
+    )
+
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield f'<sitemapindex xmlns="{SITEMAP_NS}">\n'
+    yield f"<sitemap><loc>{escape(host)}sitemap-pages.xml</loc></sitemap>\n"
+
+    for shard, lastmod in shards:
+        yield (f"<sitemap><loc>{escape(host)}sitemap-cafes-{shard}.xml</loc>"
+               f"<lastmod>{w3c_datetime(lastmod)}</lastmod></sitemap>\n")
+
+    yield "</sitemapindex>\n"
+
+
+def serve_sitemap():
+    """Sitemap of every page; an index of shards past SITEMAP_MAX_URLS."""
+
+    def generate(host):
+        count = db.session.scalar(db.select(db.func.count(Cafe.id)))
+        count += db.session.scalar(db.select(db.func.count(City.code))) + 2
+
+        if count > sitemap_cache.max_urls:
+            yield from sitemap_index(host)
+        else:
+            yield from urlset(page_urls, cafe_urls)(host)
+
+    return cached_xml("sitemap", generate, "application/xml")
+
+
+def serve_pages_sitemap():
+    return cached_xml("pages", urlset(page_urls), "application/xml")
+
+
+def serve_cafes_sitemap(shard):
+    name = f"cafes-{shard}"
+
+    if sitemap_cache.get(name) is None:
+        last_id = db.session.scalar(db.select(db.func.max(Cafe.id)))
+
+        if last_id is None or shard > last_id // sitemap_cache.max_urls:
+            abort(404)
+
+    return cached_xml(
+        name,
+        urlset(lambda host: cafe_urls(host, shard)),
+        "application/xml")
+
+
+def feed(host):
+    size = current_app.config["FEED_SIZE"]
+    rows = iter(_streamed(
+        db.select(Cafe.id, Cafe.name, Cafe.description,
+                  Cafe.created_at, Cafe.updated_at)
+        .order_by(Cafe.updated_at.desc(), Cafe.id.desc())
+        .limit(size)
+    ))
+    first = next(rows, None)
+    updated = first.updated_at if first else datetime.utcnow()
+
+    yield '<?xml version="1.0" encoding="utf-8"?>\n'
+    yield f'<feed xmlns="{ATOM_NS}">\n'
+    yield "<title>Flask Cafe: new and updated cafes</title>\n"
+    yield f"<id>{escape(host)}cafes.atom</id>\n"
+    yield f'<link rel="self" href="{escape(host)}cafes.atom"/>\n'
+    yield f'<link href="{escape(host)}cafes"/>\n'
+    yield f"<updated>{w3c_datetime(updated)}</updated>\n"
+    yield "<author><name>Flask Cafe</name></author>\n"
+
+    if first is not None:
+        for row in (first, *rows):
+            url = escape(f"{host}cafes/{row.id}")
+            yield (
+                "<entry>"
+                f"<title>{escape(row.name)}</title>"
+                f"<id>{url}</id>"
+                f'<link href="{url}"/>'
+                f"<published>{w3c_datetime(row.created_at)}</published>"
+                f"<updated>{w3c_datetime(row.updated_at)}</updated>"
+                f"<summary>{escape(row.description)}</summary>"
+                "</entry>\n"
+            )
+
+    yield "</feed>\n"
+
+
+def serve_feed():
+    """Atom feed of the most recently added or updated cafes."""
+
+    return cached_xml("feed", feed, "application/atom+xml")
+
+
+def init_sitemap(app):
+    """Register sitemap and feed routes on app."""
+
+    app.config.setdefault("SITEMAP_MAX_URLS", 50000)
+    app.config.setdefault("FEED_SIZE", 50)
+    app.config.setdefault("SITE_URL", "http://localhost/")
+
+    sitemap_cache.max_urls = app.config["SITEMAP_MAX_URLS"]
+    sitemap_cache.base_url = app.config["SITE_URL"].rstrip("/") + "/"
+
+    app.add_url_rule(
+        "/sitemap.xml", endpoint="sitemap", view_func=serve_sitemap)
+    app.add_url_rule(
+        "/sitemap-pages.xml", endpoint="pages_sitemap",
+        view_func=serve_pages_sitemap)
+    app.add_url_rule(
+        "/sitemap-cafes-<int:shard>.xml", endpoint="cafes_sitemap",
+        view_func=serve_cafes_sitemap)
+    app.add_url_rule("/cafes.atom", endpoint="feed", view_func=serve_feed)
@@ -0,0 +1,181 @@
+"""Serve the last good result of a read when the database is slow or down."""
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import functools
+import logging
+import threading
+import time
+
+from flask import copy_current_request_context, g, make_response
+from sqlalchemy.exc import SQLAlchemyError
+
+
+logger = logging.getLogger(__name__)
+
+
+class StaleCache:
+    """Last good results of read paths, to fall back on.
+
+    fetch(key, load) calls load() and remembers what it returned. Next time,
+    if load() fails with a database error, the remembered result is returned
+    instead (and g.stale says so). Results younger than STALE_FRESH_SECONDS
+    are returned without calling load() at all; results older than
+    STALE_MAX_AGE are never used.
+
+    load() runs on the request's thread unless STALE_LATENCY_BUDGET is set.
+    Then it runs on a pool of STALE_REFRESH_WORKERS threads, and a load
+    taking longer than the budget is also served stale while it carries on
+    to refresh the result. Give the pool a worker per request the process
+    can serve at once, or requests queue behind each other and look slow.
+
+    Loaded results are shared between requests and threads, so they mustn't
+    need the database to render (no lazy loads).
+    """
+
+    def __init__(self, app=None):
+        self.latency_budget = None
+        self.fresh_seconds = 0
+        self.max_age = 24 * 60 * 60
+        self.max_entries = 10000
+        self.workers = 32
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("STALE_LATENCY_BUDGET", None)
+        app.config.setdefault("STALE_FRESH_SECONDS", 0)
+        app.config.setdefault("STALE_MAX_AGE", 24 * 60 * 60)
+        app.config.setdefault("STALE_MAX_ENTRIES", 10000)
+        app.config.setdefault("STALE_REFRESH_WORKERS", 32)
+
+        self.latency_budget = app.config["STALE_LATENCY_BUDGET"]
+        self.fresh_seconds = app.config["STALE_FRESH_SECONDS"]
+        self.max_age = app.config["STALE_MAX_AGE"]
+        self.max_entries = app.config["STALE_MAX_ENTRIES"]
+        self.workers = app.config["STALE_REFRESH_WORKERS"]
+
+    def after_fork(self):
+        """In a forked child: the parent's refresh threads are gone."""
+
+        self._executor = None
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def _store(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _refresh(self, key, load):
+        """Return future loading key in the background, sharing one per key."""
+
+        with self._lock:
+            future = self._loading.get(key)
+            if future is not None:
+                return future
+
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers,
+                    thread_name_prefix="stale-refresh")
+
+            # run in a copy of this request's context, in its own session,
+            # reading from the request's replica (if any)
+            read_replica = g.get("read_replica")
+            pinned = {"replica": g.replica} if "replica" in g else {}
+
+            @copy_current_request_context
+            def work():
+                g.read_replica = read_replica
+                for name, value in pinned.items():
+                    setattr(g, name, value)
+                try:
+                    value = load()
+                    self._store(key, value)
+                    return value
+                finally:
+                    with self._lock:
+                        self._loading.pop(key, None)
+
+            future = self._executor.submit(work)
+            self._loading[key] = future
+            return future
+
+    def fetch(self, key, load):
+        """Return load(), or its last good result if that's slow or fails."""
+
+        entry = self._get(key)
+        now = time.time()
+
+        if entry is None or now - entry[1] > self.max_age:
+            value = load()
+            self._store(key, value)
+            return value
+
+        value, stored_at = entry
+        age = now - stored_at
+
+        if age < self.fresh_seconds:
+            return value
+
+        try:
+            if self.latency_budget is None:
+                fresh = load()
+                self._store(key, fresh)
+                return fresh
+
+            return self._refresh(key, load).result(timeout=self.latency_budget)
+        except TimeoutError:
+            reason = "slow"
+        except SQLAlchemyError as e:
+            logger.warning("Serving stale %s: %s", key, e)
+            reason = "error"
+
+        g.stale = (reason, age)
+        return value
+
+
+stale_cache = StaleCache()
+
+
+def serve_stale(view):
+    """Decorator: mark responses built from stale results.
+
+    They get an X-Stale header (why, and how old) and aren't cached.
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        g.stale = None
+        resp = view(*args, **kwargs)
+
+        if g.stale:
+            reason, age = g.stale
+            resp = make_response(resp)
+            resp.headers["X-Stale"] = reason
+            resp.headers["Age"] = str(int(age))
+            resp.cache_control.no_store = True
+
+        return resp
+
+    return wrapper
@@ -1,46 +1,50 @@
 "use strict";
 
 const CAFE_ID = $("#c-id").attr("data-cafe-id");
+const $likeBtn = $("#like-btn");
 
-async function getLikeStatus() {
+// like state the user last asked for, and the last state the server confirmed
+let wantLiked = $likeBtn.data("liked") === true;
+let serverLiked = wantLiked;
+let syncing = false;
 
-  const resp = await axios.get('/api/likes', {params: {"cafe_id": CAFE_ID}});
-  const likeStatus = resp.data.likes;
- 
-  return likeStatus;
+function updateLikeBtnText() {
+  $likeBtn.text(wantLiked ? "Unlike" : "Like");
 }
 
-async function updateLikeBtnText() {
-  const likeStatus = await getLikeStatus();
-
-  if (likeStatus) {
-    $('#like-btn').text("Unlike");
-  } else {
-    $('#like-btn').text("Like");
-  }
-}
-
-function handleLikeClick(evt)  {
+function handleLikeClick(evt) {
   evt.preventDefault();
 
-  const likeBtnText = $('#like-btn').text()
-
-  if (likeBtnText === 'Unlike') {
-    unlike();
-  } else if (likeBtnText === 'Like') {
-    like();
-  }
-}
-
-async function unlike() {
-  await axios.post('/api/unlike', {"cafe_id": CAFE_ID});
-  $('#like-btn').text('Like');
+  wantLiked = !wantLiked;
+  updateLikeBtnText();
+  syncLikeState();
 }
 
-async function like() {
-  await axios.post('/api/like', {"cafe_id": CAFE_ID});
-  $('#like-btn').text('Unlike');
+/** Send the requested like state to the server, one request at a time.
+ *
+ * Clicks made while a request is in flight are coalesced: once it finishes,
+ * at most one more request is sent (none, if the clicks cancelled out).
+ * If a request fails, the button goes back to the last confirmed state.
+ */
+async function syncLikeState() {
+  if (syncing) return;
+  syncing = true;
+
+  try {
+    while (wantLiked !== serverLiked) {
+      const target = wantLiked;
+      const url = target ? '/api/like' : '/api/unlike';
+      const resp = await axios.post(url, {"cafe_id": CAFE_ID});
+
+      if (resp.data.error) throw new Error(resp.data.error);
+      serverLiked = target;
+    }
+  } catch (err) {
+    wantLiked = serverLiked;
+    updateLikeBtnText();
+  } finally {
+    syncing = false;
+  }
 }
 
-$(window).on('load', updateLikeBtnText);
-$('#like-btn').on('click', handleLikeClick);
+$likeBtn.on('click', handleLikeClick);
@@ -1,31 +1,150 @@
 """Tests for Flask Cafe."""
 
 
-from models import db, Cafe, City, User, Like, connect_db  # , User, Like
+from models import db, Cafe, CafeCard, City, User, Like  # , User, Like
 from forms import CafeForm
+from like_buffer import LikeBuffer, like_buffer
+from like_api import (
+    init_like_api, like_api, close_pool, get_pool, session_cookie)
+from assets import asset_url, STATIC_DIR
+from autocomplete import autocomplete, word_keys
+from city_counts import city_counts
+from compression import compressed_cache, is_shared
+import events
+from health import WaitHistogram
+from images import _fetch, mirror_image, thumbnail_url
+from invalidation import InvalidationBus, invalidation_bus
+from page_cache import page_cache, TMP_PREFIX
+from recommendations import CafeRecommender, recommender
+from replay import build_request, compare, make_cookie_factory
+from replicas import ReplicaSet, RoutingSession, replicas, WROTE_AT_KEY
+from sitemap import sitemap_cache
+from stale import StaleCache, stale_cache
+from traffic import traffic_recorder
+from trending import TrendingCafes, trending
 from unittest import TestCase
+from unittest.mock import MagicMock, patch
 
 import os
 
-os.environ["DATABASE_URL"] = "postgresql:///flaskcafe_test"
-
-from app import app, CURR_USER_KEY
+from app import create_app, CURR_USER_KEY
+from config import TestingConfig
 
+import asyncio
+import gzip
+import hashlib
+import json
 import re
+import shutil
+import tempfile
+import threading
+import time
+
+from flask import session, g, has_request_context, request
+from flask.testing import FlaskClient
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import NullPool
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+
+#######################################
+# test database
+
+# Run the suite on every core with pytest-xdist:
+#
+#     pytest -n auto tests.py
+#
+# Each worker process gets its own database, cloned from the one in
+# TEST_DATABASE_URL (flaskcafe_test), which is kept empty as the template.
+# Tests then run inside a transaction that is rolled back afterwards; see
+# DatabaseTestCase.
+
+# advisory lock held while building the template or cloning it
+TEMPLATE_LOCK_ID = 40470
+
+
+def schema_fingerprint():
+    """Return hash of the DDL for the models' tables and indexes."""
+
+    dialect = postgresql.dialect()
+    ddl = []
+
+    for table in db.metadata.sorted_tables:
+        ddl.append(str(CreateTable(table).compile(dialect=dialect)))
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            ddl.append(str(CreateIndex(index).compile(dialect=dialect)))
+
+    return hashlib.sha1("".join(ddl).encode()).hexdigest()
+
+
+def clone_test_database(url):
+    """Return URL of a fresh copy of the test database for this process.
+
+    The template database at url gets the current schema first, if the
+    models changed since it was built. Other backends use url as it is.
+    """
+
+    url = make_url(url)
 
-from flask import session
+    if url.get_backend_name() != "postgresql":
+        return url.render_as_string(hide_password=False)
 
-# Make Flask errors be real errors, rather than HTML pages with error info
-app.config['TESTING'] = True
+    template = url.database
+    clone = f"{template}_{os.environ.get('PYTEST_XDIST_WORKER', 'main')}"
+    fingerprint = schema_fingerprint()
 
-# This is a bit of hack, but don't use Flask DebugToolbar
-app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+    admin = create_engine(
+        url.set(database="postgres"),
+        isolation_level="AUTOCOMMIT",
+        poolclass=NullPool)
 
-# Don't req CSRF for testing
-app.config['WTF_CSRF_ENABLED'] = False
+    with admin.connect() as conn:
+        conn.execute(
+            text("SELECT pg_advisory_lock(:id)"), {"id": TEMPLATE_LOCK_ID})
 
-db.drop_all()
-db.create_all()
+        try:
+            built = conn.scalar(
+                text("SELECT shobj_description(oid, 'pg_database') "
+                     "FROM pg_database WHERE datname = :name"),
+                {"name": template})
+
+            if built != fingerprint:
+                engine = create_engine(url, poolclass=NullPool)
+                db.metadata.drop_all(engine)
+                db.metadata.create_all(engine)
+                engine.dispose()
+
+                conn.execute(text(
+                    f"COMMENT ON DATABASE \"{template}\" IS '{fingerprint}'"))
+
+            conn.execute(text(f'DROP DATABASE IF EXISTS "{clone}"'))
+            conn.execute(text(
+                f'CREATE DATABASE "{clone}" TEMPLATE "{template}"'))
+
+        finally:
+            conn.execute(
+                text("SELECT pg_advisory_unlock(:id)"), {"id": TEMPLATE_LOCK_ID})
+
+    admin.dispose()
+
+    return url.set(database=clone).render_as_string(hide_password=False)
+
+
+# TESTING makes Flask errors be real errors, rather than HTML pages with
+# error info; see TestingConfig for the rest
+app = create_app(
+    "testing",
+    SQLALCHEMY_DATABASE_URI=clone_test_database(
+        TestingConfig.SQLALCHEMY_DATABASE_URI))
+app.app_context().push()
+init_like_api(app)
+
+if db.engine.url.get_backend_name() != "postgresql":
+    db.drop_all()
+    db.create_all()
 
 
 #######################################
@@ -47,6 +166,220 @@ def login_for_test(client, user_id):
         sess[CURR_USER_KEY] = user_id
 
 
+#######################################
+# query budgets
+
+
+# Most SQL statements one request to each endpoint may run, as measured on
+# Postgres. The test client fails any request over budget, or that runs
+# queries for an endpoint not listed here.
+QUERY_BUDGETS = {
+    # includes loading the recommender's likes on first use
+    "cafes.cafe_detail": 4,
+    "cafes.cafe_list": 3,
+    "cafes.city_cafe_list": 3,
+    # the user, cities, both inserts & city, then the cafe after commit
+    "cafes.handle_add_cafe": 6,
+    # includes loading the name index & like counts on first use
+    "cafes.handle_autocomplete_query": 3,
+    # the user, cafe & cities, both updates, then the cafe after commit
+    "cafes.handle_edit_cafe": 6,
+    "cafes.handle_edit_profile": 2,
+    # the user, cafe & their likes, the insert & card count, then the user
+    # & cafe again after commit
+    "cafes.handle_like_cafe": 7,
+    "cafes.handle_like_query": 2,
+    "cafes.handle_login": 1,
+    "cafes.handle_logout": 1,
+    "cafes.handle_signup": 2,
+    # includes loading the trending index on first use
+    "cafes.handle_trending_query": 3,
+    # as for handle_like_cafe, with the delete in place of the insert
+    "cafes.handle_unlike_cafe": 7,
+    # the logged-in user
+    "cafes.homepage": 1,
+    "cafes.show_user_profile": 3,
+    "cafes.trending_cafes": 3,
+    # the last cafe id, then the shard's cafes
+    "cafes_sitemap": 2,
+    "feed": 1,
+    "readyz": 1,
+    "serve_image": 1,
+    "sitemap": 3,
+}
+
+
+class QueryCounter:
+    """Context manager counting SQL statements run, for each request.
+
+    Statements run outside a request are counted under None.
+    """
+
+    active = []
+
+    def __init__(self):
+        # request -> [endpoint, statements run]
+        self.requests = {}
+
+    def __enter__(self):
+        QueryCounter.active.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        QueryCounter.active.remove(self)
+
+    def record(self):
+        if has_request_context():
+            key = request._get_current_object()
+            endpoint = request.endpoint
+        else:
+            key = endpoint = None
+
+        self.requests.setdefault(key, [endpoint, 0])[1] += 1
+
+    @property
+    def count(self):
+        return sum(count for endpoint, count in self.requests.values())
+
+
+# the savepoints DatabaseTestCase's sessions use in place of transactions
+SAVEPOINT_STATEMENTS = ("SAVEPOINT", "RELEASE SAVEPOINT", "ROLLBACK TO SAVEPOINT")
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    if statement.startswith(SAVEPOINT_STATEMENTS):
+        return
+
+    for counter in QueryCounter.active:
+        counter.record()
+
+
+class BudgetedClient(FlaskClient):
+    """Test client checking each request against QUERY_BUDGETS.
+
+    Each request starts with an empty identity map, as it would in its own
+    worker, so objects the test already loaded don't hide its queries.
+    """
+
+    def open(self, *args, **kwargs):
+        db.session.expunge_all()
+
+        with QueryCounter() as counter:
+            resp = super().open(*args, **kwargs)
+
+        for key, (endpoint, count) in counter.requests.items():
+            if key is None or endpoint is None:
+                continue
+
+            if endpoint not in QUERY_BUDGETS:
+                raise AssertionError(
+                    f"{endpoint} ran {count} SQL statements but has no "
+                    f"entry in QUERY_BUDGETS")
+
+            if count > QUERY_BUDGETS[endpoint]:
+                raise AssertionError(
+                    f"{endpoint} ran {count} SQL statements; its budget is "
+                    f"{QUERY_BUDGETS[endpoint]}")
+
+        return resp
+
+
+app.test_client_class = BudgetedClient
+
+
+#######################################
+# test cases using the database
+
+
+def reset_caches():
+    """Forget everything cached from earlier tests' data."""
+
+    autocomplete.invalidate()
+    city_counts.invalidate()
+    recommender.reset()
+    sitemap_cache.clear()
+    stale_cache.clear()
+    trending.reset()
+
+
+def start_patches(test, *patchers):
+    """Start patchers for the rest of test; they stop in its cleanup."""
+
+    for patcher in patchers:
+        patcher.start()
+        test.addCleanup(patcher.stop)
+
+
+def sandbox_side_effects(test):
+    """Keep test off the network and out of the working tree.
+
+    Committed cafes don't fetch maps, committed image URLs don't start
+    mirroring, and images mirrored anyway go to a temporary directory.
+    """
+
+    mirror_dir = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, mirror_dir, ignore_errors=True)
+
+    start_patches(
+        test,
+        patch("app.refresh_in_background"),
+        patch("app.save_map_in_background"),
+        patch("images.MIRROR_DIR", mirror_dir))
+
+
+class DatabaseTestCase(TestCase):
+    """Test case whose database changes are rolled back afterwards.
+
+    Each test runs in a transaction on one connection; the session joins it,
+    turning its own commits and rollbacks into savepoints, so after-commit
+    events still fire but nothing is ever committed.
+
+    Code reading through other connections (db.engine, asyncpg, like_buffer)
+    can't see the test's rows: use CommittedDatabaseTestCase for that.
+    """
+
+    def setUp(self):
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+
+        db.session.remove()
+        db.session.configure(
+            bind=self.connection, join_transaction_mode="create_savepoint")
+
+        self.addCleanup(self.roll_back)
+        reset_caches()
+        sandbox_side_effects(self)
+
+    def roll_back(self):
+        db.session.remove()
+        db.session.configure(
+            bind=None, join_transaction_mode="conditional_savepoint")
+
+        self.transaction.rollback()
+        self.connection.close()
+
+
+class CommittedDatabaseTestCase(TestCase):
+    """Test case whose changes are committed, then deleted afterwards.
+
+    Slower than DatabaseTestCase; for code that uses its own connections.
+    """
+
+    def setUp(self):
+        self.addCleanup(self.delete_all)
+        reset_caches()
+        sandbox_side_effects(self)
+
+    def delete_all(self):
+        db.session.rollback()
+
+        for table in reversed(db.metadata.sorted_tables):
+            db.session.execute(table.delete())
+
+        db.session.commit()
+
+
 #######################################
 # data to use for test objects / testing forms
 
@@ -130,14 +463,13 @@ class HomepageViewsTestCase(TestCase):
 # cities
 
 
-class CityModelTestCase(TestCase):
+class CityModelTestCase(DatabaseTestCase):
     """Tests for City Model."""
 
     def setUp(self):
         """Before all tests, add sample city & users"""
 
-        Cafe.query.delete()
-        City.query.delete()
+        super().setUp()
 
         sf = City(**CITY_DATA)
         db.session.add(sf)
@@ -149,13 +481,6 @@ class CityModelTestCase(TestCase):
 
         self.cafe = cafe
 
-    def tearDown(self):
-        """After each test, remove all cafes."""
-
-        Cafe.query.delete()
-        City.query.delete()
-        db.session.commit()
-
     # depending on how you solve exercise, you may have things to test on
     # the City model, so here's a good place to put that stuff.
 
@@ -164,14 +489,13 @@ class CityModelTestCase(TestCase):
 # cafes
 
 
-class CafeModelTestCase(TestCase):
+class CafeModelTestCase(DatabaseTestCase):
     """Tests for Cafe Model."""
 
     def setUp(self):
         """Before all tests, add sample city & users"""
 
-        Cafe.query.delete()
-        City.query.delete()
+        super().setUp()
 
         sf = City(**CITY_DATA)
         db.session.add(sf)
@@ -183,25 +507,103 @@ class CafeModelTestCase(TestCase):
 
         self.cafe = cafe
 
-    def tearDown(self):
-        """After each test, remove all cafes."""
+    def test_get_city_state(self):
+        self.assertEqual(self.cafe.get_city_state(), "San Francisco, CA")
+
+    def test_get_detail(self):
+        detail = Cafe.get_detail(self.cafe.id)
+
+        self.assertEqual(detail.name, "Test Cafe")
+        self.assertEqual(detail.get_city_state(), "San Francisco, CA")
+        self.assertEqual(detail.like_count, 0)
+        self.assertFalse(detail.liked)
+
+        with self.assertRaises(AttributeError):
+            detail.name = "new-name"
+
+    def test_get_detail_missing(self):
+        self.assertIsNone(Cafe.get_detail(0))
 
-        Cafe.query.delete()
-        City.query.delete()
+
+class CafeChangeEventsTestCase(CommittedDatabaseTestCase):
+    """Tests for after-commit hooks on cafe changes."""
+
+    def setUp(self):
+        """Before each test, add sample city & start recording events."""
+
+        super().setUp()
+
+        db.session.add(City(**CITY_DATA))
         db.session.commit()
 
-    def test_get_city_state(self):
-        self.assertEqual(self.cafe.get_city_state(), "San Francisco, CA")
+        # subscribe only for this test
+        subscribers = list(events._subscribers)
+        start_patches(self, patch.object(events, "_subscribers", subscribers))
+
+        self.events = []
+        events.on_change(Cafe)(self.events.append)
+
+    @patch("app.save_map_in_background")
+    def test_events(self, save_map):
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+        db.session.flush()
+        cafe.name = "Renamed"
+        db.session.commit()
+
+        [event] = self.events
+        self.assertEqual(event.action, "insert")
+        self.assertEqual(event.id, cafe.id)
+        self.assertEqual(event.changes["name"], (None, "Renamed"))
+        save_map.assert_called_once_with(
+            cafe.id, "500 Sansome St", "San Francisco, CA")
+
+        cafe.description = "new-description"
+        db.session.commit()
+
+        self.assertEqual(self.events[-1].action, "update")
+        self.assertEqual(
+            self.events[-1].changes,
+            {"description": ("Test description", "new-description")})
+        save_map.assert_called_once()
+
+        cafe.address = "1 Market St"
+        db.session.commit()
+        self.assertEqual(save_map.call_count, 2)
+
+    def test_rollback_discards_events(self):
+        db.session.add(Cafe(**CAFE_DATA))
+        db.session.flush()
+        db.session.rollback()
+        db.session.commit()
+
+        self.assertEqual(self.events, [])
+
+    def test_get_detail_without_card(self):
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+        db.session.commit()
+        db.session.execute(
+            CafeCard.__table__.delete().where(CafeCard.id == cafe.id))
+        db.session.commit()
+
+        detail = Cafe.get_detail(cafe.id)
+        self.assertEqual(detail.name, "Test Cafe")
+        self.assertEqual(detail.get_city_state(), "San Francisco, CA")
+        self.assertFalse(detail.liked)
+
+        db.session.commit()
+        self.assertIsNotNone(db.session.get(CafeCard, cafe.id))
+        self.assertEqual(Cafe.get_detail(cafe.id), detail)
 
 
-class CafeViewsTestCase(TestCase):
+class CafeViewsTestCase(DatabaseTestCase):
     """Tests for views on cafes."""
 
     def setUp(self):
         """Before all tests, add sample city & users"""
 
-        Cafe.query.delete()
-        City.query.delete()
+        super().setUp()
 
         sf = City(**CITY_DATA)
         db.session.add(sf)
@@ -213,19 +615,75 @@ class CafeViewsTestCase(TestCase):
 
         self.cafe_id = cafe.id
 
-    def tearDown(self):
-        """After each test, remove all cafes."""
+    def test_list(self):
+        with app.test_client() as client:
+            resp = client.get("/cafes")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Test Cafe", resp.data)
+            self.assertIn(b"San Francisco (1)", resp.data)
+
+    def test_list_query_budget(self):
+        # a per-card query for each cafe's city would push the list over
+        for i in range(5):
+            db.session.add(Cafe(**CAFE_DATA))
+        db.session.commit()
+
+        with app.test_client() as client:
+            client.get("/cafes")
+
+            with patch.dict(QUERY_BUDGETS, {"cafes.cafe_list": 0}):
+                with self.assertRaisesRegex(AssertionError, "budget is 0"):
+                    client.get("/cafes")
 
-        Cafe.query.delete()
-        City.query.delete()
+    def test_list_by_city(self):
+        db.session.add(City(code="oak", name="Oakland", state="CA"))
         db.session.commit()
 
-    def test_list(self):
         with app.test_client() as client:
-            resp = client.get("/cafes")
+            resp = client.get("/cities/sf")
             self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Cafes in San Francisco, CA", resp.data)
             self.assertIn(b"Test Cafe", resp.data)
 
+            resp = client.get("/cafes?city=oak")
+            self.assertNotIn(b"Test Cafe", resp.data)
+            self.assertIn(b"Oakland (0)", resp.data)
+
+            resp = client.get("/cities/nope")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_city_counts_follow_changes(self):
+        db.session.add(City(code="oak", name="Oakland", state="CA"))
+        db.session.commit()
+        self.assertEqual(
+            city_counts.get(), [("oak", "Oakland", 0), ("sf", "San Francisco", 1)])
+
+        cafe = db.session.get(Cafe, self.cafe_id)
+        cafe.city_code = "oak"
+        db.session.add(Cafe(**CAFE_DATA))
+        db.session.commit()
+        self.assertEqual(
+            city_counts.get(), [("oak", "Oakland", 1), ("sf", "San Francisco", 1)])
+
+        db.session.delete(cafe)
+        db.session.commit()
+        self.assertEqual(city_counts.total(), 1)
+
+    def test_city_counts_keep_changes_during_load(self):
+        execute = db.session.execute
+
+        def racing_execute(*args, **kwargs):
+            result = execute(*args, **kwargs)
+            city_counts.invalidate()
+            return result
+
+        with patch.object(db.session, "execute", racing_execute):
+            self.assertEqual(city_counts.total(), 1)
+        self.assertIsNone(city_counts._counts)
+
+        self.assertEqual(city_counts.total(), 1)
+        self.assertIsNotNone(city_counts._counts)
+
     def test_detail(self):
         with app.test_client() as client:
             resp = client.get(f"/cafes/{self.cafe_id}")
@@ -234,15 +692,229 @@ class CafeViewsTestCase(TestCase):
             self.assertIn(b'testcafe.com', resp.data)
 
 
-class CafeAdminViewsTestCase(TestCase):
+class SitemapViewsTestCase(DatabaseTestCase):
+    """Tests for the sitemap and feed."""
+
+    def setUp(self):
+        super().setUp()
+
+        db.session.add(City(**CITY_DATA))
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+        db.session.commit()
+
+        self.cafe_id = cafe.id
+
+    def test_sitemap(self):
+        with app.test_client() as client:
+            resp = client.get("/sitemap.xml")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIsNone(resp.content_length)
+            self.assertIn(b"<urlset", resp.data)
+            self.assertIn(
+                f"<loc>http://localhost/cafes/{self.cafe_id}</loc>".encode(),
+                resp.data)
+            self.assertIn(b"<loc>http://localhost/cities/sf</loc>", resp.data)
+
+            # now sent whole, from the cache, whatever Host is sent
+            resp = client.get(
+                "/sitemap.xml", headers={"Host": "forged.example"})
+            self.assertEqual(resp.content_length, len(resp.data))
+            self.assertNotIn(b"forged.example", resp.data)
+            self.assertEqual(list(sitemap_cache._docs), ["sitemap"])
+
+    def test_sitemap_index(self):
+        with patch.object(sitemap_cache, "max_urls", 2):
+            with app.test_client() as client:
+                resp = client.get("/sitemap.xml")
+                self.assertIn(b"<sitemapindex", resp.data)
+                self.assertIn(b"sitemap-pages.xml", resp.data)
+
+                shard = self.cafe_id // 2
+                self.assertIn(f"sitemap-cafes-{shard}.xml".encode(), resp.data)
+
+                resp = client.get(f"/sitemap-cafes-{shard}.xml")
+                self.assertIn(f"/cafes/{self.cafe_id}<".encode(), resp.data)
+
+                # past the last cafe: not generated, nor cached
+                resp = client.get(f"/sitemap-cafes-{shard + 1}.xml")
+                self.assertEqual(resp.status_code, 404)
+                self.assertNotIn(f"cafes-{shard + 1}", sitemap_cache._docs)
+
+    def test_feed_expires_on_cafe_change(self):
+        with app.test_client() as client:
+            resp = client.get("/cafes.atom")
+            self.assertEqual(resp.mimetype, "application/atom+xml")
+            self.assertIn(b"<title>Test Cafe</title>", resp.data)
+
+            cafe = db.session.get(Cafe, self.cafe_id)
+            cafe.name = "Renamed & Improved"
+            db.session.commit()
+
+            resp = client.get("/cafes.atom")
+            self.assertIn(b"<title>Renamed &amp; Improved</title>", resp.data)
+
+
+class StaleCafeViewsTestCase(DatabaseTestCase):
+    """Tests for serving the last good cafe pages when the database fails."""
+
+    def setUp(self):
+        super().setUp()
+
+        db.session.add(City(**CITY_DATA))
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+        db.session.commit()
+
+        self.cafe_id = cafe.id
+
+    def test_detail_served_stale_on_error(self):
+        with app.test_client() as client:
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            self.assertNotIn("X-Stale", resp.headers)
+
+            with patch.object(Cafe, "get_detail",
+                              side_effect=OperationalError("", {}, None)):
+                resp = client.get(f"/cafes/{self.cafe_id}")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers["X-Stale"], "error")
+            self.assertIn("no-store", resp.headers["Cache-Control"])
+            self.assertIn(b"Test Cafe", resp.data)
+
+    def test_error_without_stale_copy(self):
+        with app.test_client() as client:
+            with patch.object(Cafe, "get_detail",
+                              side_effect=OperationalError("", {}, None)):
+                with self.assertRaises(OperationalError):
+                    client.get(f"/cafes/{self.cafe_id}")
+
+    def test_loads_on_request_thread(self):
+        cache = StaleCache()
+        threads = []
+
+        def load():
+            threads.append(threading.get_ident())
+            return 1
+
+        with app.test_request_context():
+            cache.fetch("key", load)
+            cache.fetch("key", load)
+
+        self.assertEqual(threads, [threading.get_ident()] * 2)
+        self.assertIsNone(cache._executor)
+
+    def test_slow_load_served_stale_then_refreshed(self):
+        cache = StaleCache()
+        cache.latency_budget = 0.05
+
+        with app.test_request_context():
+            self.assertEqual(cache.fetch("key", lambda: 1), 1)
+
+            def slow_load():
+                time.sleep(0.2)
+                return 2
+
+            self.assertEqual(cache.fetch("key", slow_load), 1)
+            self.assertEqual(g.stale[0], "slow")
+
+            time.sleep(0.3)
+            self.assertEqual(cache._get("key")[0], 2)
+
+
+class PageCacheTestCase(DatabaseTestCase):
+    """Tests for caching pages for logged-out visitors."""
+
+    def setUp(self):
+        """Before each test, add sample cafe & use an empty page cache."""
+
+        super().setUp()
+
+        db.session.add(City(**CITY_DATA))
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+        user = User.register(**TEST_USER_DATA)
+        db.session.add(user)
+        db.session.commit()
+
+        self.cafe_id = cafe.id
+        self.user_id = user.id
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        start_patches(
+            self,
+            patch.dict(app.config, PAGE_CACHE_ENABLED=True),
+            patch.object(page_cache, "directory", directory))
+
+    def test_anonymous_pages_cached(self):
+        with app.test_client() as client:
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            self.assertEqual(resp.headers["X-Page-Cache"], "MISS")
+
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            self.assertEqual(resp.headers["X-Page-Cache"], "HIT")
+            self.assertIn(b"Test Cafe", resp.data)
+            self.assertEqual(resp.mimetype, "text/html")
+
+            # args the view doesn't read don't make new pages
+            resp = client.get(f"/cafes/{self.cafe_id}?x=1")
+            self.assertEqual(resp.headers["X-Page-Cache"], "HIT")
+
+            client.get("/cafes")
+            resp = client.get("/cafes?city=sf&x=1")
+            self.assertEqual(resp.headers["X-Page-Cache"], "MISS")
+            resp = client.get("/cafes?x=2&city=sf")
+            self.assertEqual(resp.headers["X-Page-Cache"], "HIT")
+
+    def test_prune_and_clear(self):
+        page_cache.set("/old", "text/html", b"old")
+        page_cache.set("/new", "text/html", b"new")
+        _, partial = tempfile.mkstemp(
+            dir=page_cache.directory, prefix=TMP_PREFIX)
+
+        past = time.time() - page_cache.ttl - 1
+        os.utime(page_cache._path("/old"), (past, past))
+        page_cache.prune()
+
+        self.assertIsNone(page_cache.get("/old"))
+        self.assertFalse(os.path.exists(page_cache._path("/old")))
+        self.assertIsNotNone(page_cache.get("/new"))
+
+        page_cache.clear()
+        self.assertIsNone(page_cache.get("/new"))
+        # another request's page being written is left to finish
+        self.assertTrue(os.path.exists(partial))
+
+    def test_logged_in_bypasses_cache(self):
+        with app.test_client() as client:
+            client.get("/cafes")
+            login_for_test(client, self.user_id)
+
+            resp = client.get("/cafes")
+            self.assertNotIn("X-Page-Cache", resp.headers)
+
+    def test_cafe_change_expires_pages(self):
+        with app.test_client() as client:
+            client.get("/cafes")
+
+            cafe = db.session.get(Cafe, self.cafe_id)
+            cafe.name = "Renamed Cafe"
+            db.session.commit()
+
+            resp = client.get("/cafes")
+            self.assertEqual(resp.headers["X-Page-Cache"], "MISS")
+            self.assertIn(b"Renamed Cafe", resp.data)
+
+
+class CafeAdminViewsTestCase(DatabaseTestCase):
     """Tests for add/edit views on cafes."""
 
     def setUp(self):
         """Before each test, add sample city, users, and cafes"""
 
-        City.query.delete()
-        Cafe.query.delete()
-        User.query.delete()
+        super().setUp()
 
         # add city and cafe for testing
         sf = City(**CITY_DATA)
@@ -263,14 +935,6 @@ class CafeAdminViewsTestCase(TestCase):
         
         self.admin_id = admin.id
 
-    def tearDown(self):
-        """After each test, delete the cities, cafes, and users"""
-
-        Cafe.query.delete()
-        City.query.delete()
-        User.query.delete()
-        db.session.commit()
-
     def test_add(self):
         with app.test_client() as client:
             login_for_test(client, self.admin_id)
@@ -330,73 +994,442 @@ class CafeAdminViewsTestCase(TestCase):
             self.assertIn(b'Test description', resp.data)
 
 
-#######################################
-# users
-
-
-class UserModelTestCase(TestCase):
-    """Tests for the user model."""
+class AutocompleteViewsTestCase(DatabaseTestCase):
+    """Tests for autocompleting cafe names."""
 
     def setUp(self):
-        """Before each test, add sample users."""
+        """Before each test, add cafes in two cities, one of them liked."""
 
-        User.query.delete()
+        super().setUp()
 
         user = User.register(**TEST_USER_DATA)
-        db.session.add(user)
-
+        sf = City(**CITY_DATA)
+        oak = City(code="oak", name="Oakland", state="CA")
+        door = Cafe(**{**CAFE_DATA, "name": "The Blue Door"})
+        bottle = Cafe(**{**CAFE_DATA, "name": "Blue Bottle", "city_code": "oak"})
+        reveille = Cafe(**{**CAFE_DATA, "name": "Café Réveille"})
+        db.session.add_all([user, sf, oak, door, bottle, reveille])
+        user.liked_cafes.append(bottle)
         db.session.commit()
 
-        self.user = user
+        self.door_id = door.id
 
-    def tearDown(self):
-        """After each test, remove all users."""
+    def search(self, client, q):
+        resp = client.get("/api/cafes/autocomplete", query_string={"q": q})
+        return [cafe["name"] for cafe in resp.json["cafes"]]
 
-        User.query.delete()
-        db.session.commit()
+    def test_word_keys(self):
+        self.assertEqual(
+            word_keys("The Blue-Door"), ["the blue door", "blue door", "door"])
 
-    def test_authenticate(self):
-        rez = User.authenticate("test", "secret")
-        self.assertEqual(rez, self.user)
+    def test_autocomplete(self):
+        with app.test_client() as client:
+            self.assertEqual(
+                self.search(client, "blu"), ["Blue Bottle", "The Blue Door"])
+            self.assertEqual(self.search(client, "the b"), ["The Blue Door"])
+            self.assertEqual(self.search(client, "oakl"), ["Blue Bottle"])
+            self.assertEqual(self.search(client, "cafe rev"), ["Café Réveille"])
+            self.assertEqual(self.search(client, ""), [])
+
+            resp = client.get("/api/cafes/autocomplete?q=blue&limit=1")
+            self.assertEqual(resp.json["cafes"], [{
+                "id": resp.json["cafes"][0]["id"],
+                "name": "Blue Bottle",
+                "city": "Oakland",
+                "likes": 1,
+            }])
+
+    def test_follows_changes(self):
+        with app.test_client() as client:
+            self.search(client, "blue")
 
-    def test_authenticate_fail(self):
-        rez = User.authenticate("no-such-user", "secret")
-        self.assertFalse(rez)
+            door = db.session.get(Cafe, self.door_id)
+            door.name = "Red Door"
+            db.session.add(Cafe(**{**CAFE_DATA, "name": "Bluebird"}))
+            db.session.commit()
 
-        rez = User.authenticate("test", "password")
-        self.assertFalse(rez)
+            # answered from the updated index, without reloading it
+            with patch.dict(QUERY_BUDGETS,
+                            {"cafes.handle_autocomplete_query": 0}):
+                self.assertEqual(
+                    self.search(client, "blue"), ["Blue Bottle", "Bluebird"])
+                self.assertEqual(self.search(client, "red"), ["Red Door"])
 
-    def test_full_name(self):
-        self.assertEqual(self.user.get_full_name(), "Testy MacTest")
+    def test_keeps_changes_during_load(self):
+        execute = db.session.execute
 
-    def test_register(self):
-        u = User.register(**TEST_USER_DATA)
-        # test that password gets bcrypt-hashed (all start w/$2b$)
-        self.assertEqual(u.hashed_password[:4], "$2b$")
-        db.session.rollback()
+        def racing_execute(*args, **kwargs):
+            result = execute(*args, **kwargs)
+            autocomplete.invalidate()
+            return result
 
+        with patch.object(db.session, "execute", racing_execute):
+            results = autocomplete.search("door")
+        self.assertEqual([result[1] for result in results], ["The Blue Door"])
+        self.assertFalse(autocomplete._loaded)
 
-class AuthViewsTestCase(TestCase):
-    """Tests for views on logging in/logging out/registration."""
+        autocomplete.search("door")
+        self.assertTrue(autocomplete._loaded)
+
+    def test_limit(self):
+        with app.test_client() as client:
+            for limit in [0, -5, 1]:
+                resp = client.get(
+                    "/api/cafes/autocomplete",
+                    query_string={"q": "blu", "limit": limit})
+                self.assertEqual(len(resp.json["cafes"]), 1)
+
+
+class CafeCardTestCase(DatabaseTestCase):
+    """Tests for keeping the cafe_cards read model current."""
+
+    def setUp(self):
+        """Add a user, and a cafe in a city, whose card the tests follow."""
+
+        super().setUp()
+
+        user = User.register(**TEST_USER_DATA)
+        sf = City(**CITY_DATA)
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add_all([user, sf, cafe])
+        db.session.commit()
+
+        self.user_id = user.id
+        self.cafe_id = cafe.id
+
+    def card(self):
+        """Return the cafe's card row, read afresh (cards change via Core)."""
+
+        return db.session.execute(
+            db.select(CafeCard.__table__)
+            .where(CafeCard.id == self.cafe_id)).one()
+
+    def test_card_follows_cafe(self):
+        card = self.card()
+        self.assertEqual(card.name, "Test Cafe")
+        self.assertEqual(card.city_state, "San Francisco, CA")
+        self.assertEqual(card.map_path, f"maps/{self.cafe_id}.jpg")
+        self.assertEqual(card.like_count, 0)
+
+        db.session.add(City(code="oak", name="Oakland", state="CA"))
+        cafe = db.session.get(Cafe, self.cafe_id)
+        cafe.name = "New Name"
+        cafe.city_code = "oak"
+        db.session.commit()
+
+        card = self.card()
+        self.assertEqual(card.name, "New Name")
+        self.assertEqual(card.city_code, "oak")
+        self.assertEqual(card.city_state, "Oakland, CA")
+
+        db.session.get(City, "oak").name = "East Bay"
+        db.session.commit()
+
+        self.assertEqual(self.card().city_state, "East Bay, CA")
+
+    def test_card_counts_likes(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            client.post('/api/like', json={"cafe_id": self.cafe_id})
+            self.assertEqual(self.card().like_count, 1)
+
+            client.post('/api/unlike', json={"cafe_id": self.cafe_id})
+            self.assertEqual(self.card().like_count, 0)
+
+    def test_rebuild(self):
+        user = db.session.get(User, self.user_id)
+        user.liked_cafes.append(db.session.get(Cafe, self.cafe_id))
+        db.session.execute(CafeCard.__table__.delete())
+        db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=["rebuild-cafe-cards"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Rebuilt 1 cafe cards", result.output)
+        self.assertEqual(self.card().like_count, 1)
+
+
+#######################################
+# database
+
+
+class HealthViewsTestCase(TestCase):
+    """Tests for health checks and pool metrics."""
+
+    def test_healthz(self):
+        with app.test_client() as client:
+            resp = client.get("/healthz")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json["status"], "ok")
+            self.assertIn("checked_out", resp.json["pool"])
+            self.assertIn("idle", resp.json["pool"])
+
+    def test_readyz(self):
+        with app.test_client() as client:
+            resp = client.get("/readyz")
+            self.assertEqual(resp.status_code, 200)
+            self.assertGreater(resp.json["pool"]["wait_seconds"]["count"], 0)
+
+    def test_metrics(self):
+        with app.test_client() as client:
+            resp = client.get("/metrics")
+            self.assertIn(b"flaskcafe_db_pool_checked_out ", resp.data)
+            self.assertIn(
+                b'flaskcafe_db_pool_wait_seconds_bucket{le="+Inf"}', resp.data)
+
+    def test_wait_histogram(self):
+        histogram = WaitHistogram(buckets=(0.01, 0.1))
+        for seconds in (0.001, 0.01, 0.05, 3):
+            histogram.observe(seconds)
+
+        self.assertEqual(
+            histogram.cumulative(), [(0.01, 2), (0.1, 3), (float("inf"), 4)])
+        self.assertEqual(histogram.summary()["max"], 3)
+
+
+class IndexReportTestCase(TestCase):
+    """Tests for the index-report command."""
+
+    def test_index_report(self):
+        result = app.test_cli_runner().invoke(args=["index-report"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Unused indexes", result.output)
+        self.assertIn("Foreign keys with no index", result.output)
+
+
+#######################################
+# static assets
+
+
+class AssetViewsTestCase(TestCase):
+    """Tests for fingerprinted static assets."""
+
+    def test_asset_url(self):
+        self.assertRegex(asset_url("app.js"), r"^/assets/app\.[0-9a-f]{10}\.js$")
+        self.assertEqual(asset_url("maps/nope.jpg"), "/static/maps/nope.jpg")
+
+    def test_serve_asset(self):
+        with app.test_client() as client:
+            resp = client.get(asset_url("app.js"))
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"syncLikeState", resp.data)
+            self.assertIn("immutable", resp.headers["Cache-Control"])
+
+            resp = client.get("/assets/app.0123456789.js")
+            self.assertEqual(resp.status_code, 302)
+            self.assertIn(asset_url("app.js"), resp.location)
+
+    def test_serve_precompressed_asset(self):
+        sidecar = f"{STATIC_DIR}/app.js.gz"
+
+        with open(f"{STATIC_DIR}/app.js", "rb") as f:
+            data = f.read()
+        with open(sidecar, "wb") as f:
+            f.write(gzip.compress(data))
+
+        try:
+            with app.test_client() as client:
+                resp = client.get(
+                    asset_url("app.js"),
+                    headers={"Accept-Encoding": "gzip"})
+                self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+                self.assertIn("javascript", resp.mimetype)
+                self.assertEqual(gzip.decompress(resp.data), data)
+        finally:
+            os.remove(sidecar)
+
+
+class CompressionTestCase(TestCase):
+    """Tests for compressed responses."""
+
+    def setUp(self):
+        compressed_cache.clear()
+
+    def test_gzip(self):
+        with app.test_client() as client:
+            plain = client.get("/")
+            self.assertNotIn("Content-Encoding", plain.headers)
+
+            resp = client.get("/", headers={"Accept-Encoding": "gzip"})
+            self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+            self.assertEqual(resp.headers["Vary"], "Accept-Encoding")
+            self.assertEqual(gzip.decompress(resp.data), plain.data)
+
+            etag = resp.headers["ETag"]
+            self.assertTrue(etag.endswith('-gzip"'))
+
+            resp = client.get("/", headers={
+                "Accept-Encoding": "gzip", "If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+    def test_prefers_brotli(self):
+        with app.test_client() as client:
+            resp = client.get("/", headers={"Accept-Encoding": "gzip, br"})
+            self.assertEqual(resp.headers["Content-Encoding"], "br")
+            self.assertEqual(len(compressed_cache._bodies), 1)
+
+            resp = client.get("/", headers={"Accept-Encoding": "br;q=0, gzip"})
+            self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+
+    def test_doesnt_cache_private_responses(self):
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            resp = client.get("/", headers={"Accept-Encoding": "gzip"})
+            self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+            self.assertIn("Cookie", resp.headers["Vary"])
+            self.assertEqual(len(compressed_cache._bodies), 0)
+
+        with app.test_request_context():
+            self.assertTrue(is_shared(app.response_class("")))
+
+            for cache_control in ["private", "no-store"]:
+                resp = app.response_class(
+                    "", headers={"Cache-Control": cache_control})
+                self.assertFalse(is_shared(resp), cache_control)
+
+            resp = app.response_class("", headers={"Vary": "Cookie"})
+            self.assertFalse(is_shared(resp))
+
+    def test_skips_small_responses(self):
+        with app.test_client() as client:
+            resp = client.get(
+                "/api/cafes/trending", headers={"Accept-Encoding": "gzip"})
+            self.assertNotIn("Content-Encoding", resp.headers)
+
+
+#######################################
+# images
+
+
+class ImageViewsTestCase(DatabaseTestCase):
+    """Tests for mirrored image variants."""
+
+    def setUp(self):
+        """Before each test, add sample city and cafe with default image."""
+
+        super().setUp()
+
+        sf = City(**CITY_DATA)
+        cafe = Cafe(**{**CAFE_DATA, "image_url": Cafe.image_url.default.arg})
+        db.session.add_all([sf, cafe])
+
+        db.session.commit()
+
+        self.cafe_id = cafe.id
+        self.image_url = cafe.image_url
+
+    def test_thumbnail_url(self):
+        url = thumbnail_url("cafe", 1, "http://a.com/1.jpg")
+        self.assertTrue(url.startswith("/img/cafe/1/thumb?v="))
+        self.assertNotEqual(url, thumbnail_url("cafe", 1, "http://a.com/2.jpg"))
+
+    def test_unmirrored_redirects_to_source(self):
+        with app.test_client() as client:
+            resp = client.get(f"/img/cafe/{self.cafe_id}/thumb?v=0123456789ab")
+            self.assertEqual(resp.status_code, 302)
+            self.assertIn(self.image_url, resp.location)
+
+    def test_bad_version(self):
+        with app.test_client() as client:
+            resp = client.get(f"/img/cafe/{self.cafe_id}/thumb?v=../../..")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_fetch_refuses_internal_urls(self):
+        for url in ["http://127.0.0.1/a.jpg", "http://[::1]/a.jpg",
+                    "http://10.0.0.1/a.jpg", "file:///etc/passwd",
+                    "/static/../config.py"]:
+            with self.assertRaises(ValueError, msg=url):
+                _fetch(url)
+
+    def test_mirrored_image(self):
+        mirror_image("cafe", self.cafe_id, self.image_url)
+        url = thumbnail_url("cafe", self.cafe_id, self.image_url)
+
+        with app.test_client() as client:
+            resp = client.get(url, headers={"Accept": "image/webp"})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, "image/webp")
+            self.assertIn("immutable", resp.headers["Cache-Control"])
+
+            resp = client.get(url, headers={"Accept": "image/jpeg"})
+            self.assertEqual(resp.mimetype, "image/jpeg")
+
+
+#######################################
+# users
+
+
+class UserModelTestCase(DatabaseTestCase):
+    """Tests for the user model."""
 
     def setUp(self):
         """Before each test, add sample users."""
 
-        User.query.delete()
+        super().setUp()
 
         user = User.register(**TEST_USER_DATA)
         db.session.add(user)
 
         db.session.commit()
 
-        self.user_id = user.id
+        self.user = user
+
+    def test_authenticate(self):
+        rez = User.authenticate("test", "secret")
+        self.assertEqual(rez, self.user)
+
+    def test_authenticate_fail(self):
+        rez = User.authenticate("no-such-user", "secret")
+        self.assertFalse(rez)
 
-    def tearDown(self):
-        """After each test, remove all users."""
+        rez = User.authenticate("test", "password")
+        self.assertFalse(rez)
+
+    def test_full_name(self):
+        self.assertEqual(self.user.get_full_name(), "Testy MacTest")
+
+    def test_get_liked_cafes_page(self):
+        sf = City(**CITY_DATA)
+        cafes = [Cafe(**{**CAFE_DATA, "name": name}) for name in "CAB"]
+        db.session.add_all([sf, *cafes])
+        self.user.liked_cafes.extend(cafes)
+        db.session.commit()
+
+        self.assertEqual(self.user.count_liked_cafes(), 3)
+        self.assertEqual(self.user.count_liked_cafes(up_to=2), 2)
+
+        # in the order the cafes were added
+        page, after = self.user.get_liked_cafes_page(per_page=2)
+        self.assertEqual([c.name for c in page], ["C", "A"])
+
+        page, after = self.user.get_liked_cafes_page(after, per_page=2)
+        self.assertEqual([c.name for c in page], ["B"])
+        self.assertIsNone(after)
+
+    def test_register(self):
+        u = User.register(**TEST_USER_DATA)
+        # test that password gets bcrypt-hashed (all start w/$2b$)
+        self.assertEqual(u.hashed_password[:4], "$2b$")
+        db.session.rollback()
+
+
+class AuthViewsTestCase(DatabaseTestCase):
+    """Tests for views on logging in/logging out/registration."""
+
+    def setUp(self):
+        """Before each test, add sample users."""
+
+        super().setUp()
+
+        user = User.register(**TEST_USER_DATA)
+        db.session.add(user)
 
-        User.query.delete()
         db.session.commit()
 
+        self.user_id = user.id
+
     def test_signup(self):
         with app.test_client() as client:
             resp = client.get("/signup")
@@ -456,13 +1489,13 @@ class AuthViewsTestCase(TestCase):
             self.assertEqual(session.get(CURR_USER_KEY), None)
 
 
-class NavBarTestCase(TestCase):
+class NavBarTestCase(DatabaseTestCase):
     """Tests navigation bar."""
 
     def setUp(self):
         """Before tests, add sample user."""
 
-        User.query.delete()
+        super().setUp()
 
         user = User.register(**TEST_USER_DATA)
 
@@ -471,12 +1504,6 @@ class NavBarTestCase(TestCase):
 
         self.user_id = user.id
 
-    def tearDown(self):
-        """After tests, remove all users."""
-
-        User.query.delete()
-        db.session.commit()
-
     def test_anon_navbar(self):
         with app.test_client() as client:
             resp = client.get('/cafes')
@@ -492,13 +1519,13 @@ class NavBarTestCase(TestCase):
             self.assertIn('Log Out</button>', html)
 
 
-class ProfileViewsTestCase(TestCase):
+class ProfileViewsTestCase(DatabaseTestCase):
     """Tests for views on user profiles."""
 
     def setUp(self):
         """Before each test, add sample user."""
 
-        User.query.delete()
+        super().setUp()
 
         user = User.register(**TEST_USER_DATA)
         db.session.add(user)
@@ -507,12 +1534,6 @@ class ProfileViewsTestCase(TestCase):
 
         self.user_id = user.id
 
-    def tearDown(self):
-        """After each test, remove all users."""
-
-        User.query.delete()
-        db.session.commit()
-
     def test_anon_profile(self):
         with app.test_client() as client:
             resp = client.get('/profile', follow_redirects=True)
@@ -527,6 +1548,29 @@ class ProfileViewsTestCase(TestCase):
             user = User.query.get(self.user_id)
             self.assertIn(f'{user.first_name} {user.last_name}', html)
 
+    def test_liked_cafes_pages(self):
+        user = db.session.get(User, self.user_id)
+        db.session.add(City(**CITY_DATA))
+        cafes = [Cafe(**{**CAFE_DATA, "name": f"Cafe {i}"}) for i in range(3)]
+        user.liked_cafes.extend(cafes)
+        db.session.commit()
+        after = cafes[1].id
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            with patch("app.LIKED_CAFES_PER_PAGE", 2), \
+                    patch("app.LIKED_COUNT_LIMIT", 2):
+                html = client.get('/profile').get_data(as_text=True)
+                self.assertIn("Cafes you have liked (2+)", html)
+                self.assertIn(f'/profile?after={after}', html)
+                self.assertNotIn("Cafe 2", html)
+
+                html = client.get(f'/profile?after={after}').get_data(
+                    as_text=True)
+                self.assertIn("Cafe 2", html)
+                self.assertNotIn("Cafe 1", html)
+
     def test_anon_profile_edit(self):
         with app.test_client() as client:
             resp = client.get('/profile/edit', follow_redirects=True)
@@ -554,13 +1598,13 @@ class ProfileViewsTestCase(TestCase):
 # likes
 
 
-class LikeViewsTestCase(TestCase):
+class LikeViewsTestCase(DatabaseTestCase):
     """Tests for views on likes."""
 
     def setUp(self):
-        """Before each test, add sample user, sample city, and sample cafe."""
+        """Add a user to log in as, and a cafe in a city for them to like."""
 
-        User.query.delete()
+        super().setUp()
 
         user = User.register(**TEST_USER_DATA)
         sf = City(**CITY_DATA)
@@ -572,20 +1616,11 @@ class LikeViewsTestCase(TestCase):
         self.user_id = user.id
         self.cafe_id = cafe.id
 
-    def tearDown(self):
-        """After each test, remove all likes, users, cafes, and cities."""
-
-        Like.query.delete()
-        User.query.delete()
-        Cafe.query.delete()
-        City.query.delete()
-
-        db.session.commit()
-
     def test_like_a_cafe_logged_in(self):
         user = User.query.get(self.user_id)
         cafe = Cafe.query.get(self.cafe_id)
         user.liked_cafes.append(cafe)
+        db.session.commit()
 
         with app.test_client() as client:
             login_for_test(client, self.user_id)
@@ -594,17 +1629,32 @@ class LikeViewsTestCase(TestCase):
             self.assertIn('Test Cafe', html)
 
     def test_get_like_status(self):
-        #FIXME: test passes when individual/class test run, but fails when all run
         user = User.query.get(self.user_id)
         cafe = Cafe.query.get(self.cafe_id)
         user.liked_cafes.append(cafe)
+        db.session.commit()
 
         with app.test_client() as client:
             login_for_test(client, self.user_id)
-            resp = client.get('/api/likes', query_string={"cafe_id": 1})
-            print("response json is=", resp.json)
+            resp = client.get('/api/likes', query_string={"cafe_id": self.cafe_id})
             self.assertEqual({"likes": True}, resp.json)
 
+    def test_detail_shows_like_state(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get(f'/cafes/{self.cafe_id}')
+            html = resp.get_data(as_text=True)
+            self.assertIn('data-liked="false"', html)
+
+            client.post('/api/like', json={"cafe_id": self.cafe_id})
+
+            resp = client.get(f'/cafes/{self.cafe_id}')
+            html = resp.get_data(as_text=True)
+            self.assertIn('data-liked="true"', html)
+            self.assertIn('Unlike', html)
+            self.assertIn('1 like', html)
+
     def test_like_cafe(self):
         with app.test_client() as client:
             login_for_test(client, self.user_id)
@@ -616,8 +1666,567 @@ class LikeViewsTestCase(TestCase):
         user = User.query.get(self.user_id)
         cafe = Cafe.query.get(self.cafe_id)
         user.liked_cafes.append(cafe)
+        db.session.commit()
 
         with app.test_client() as client:
             login_for_test(client, self.user_id)
             resp = client.post('/api/unlike', json={"cafe_id": self.cafe_id})
             self.assertEqual({"unliked": self.cafe_id}, resp.json)
+
+    def test_detail_shows_similar_cafes(self):
+        other = Cafe(**{**CAFE_DATA, "name": "Other Cafe"})
+        db.session.add(other)
+        db.session.commit()
+        other_id = other.id
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            client.post('/api/like', json={"cafe_id": self.cafe_id})
+            client.post('/api/like', json={"cafe_id": other_id})
+
+            resp = client.get(f'/cafes/{self.cafe_id}')
+            html = resp.get_data(as_text=True)
+            self.assertIn('People who liked this also liked', html)
+            self.assertIn('Other Cafe', html)
+
+    def test_remote_like(self):
+        recommender.load()
+        trending.load()
+
+        # written by another worker, which then published it
+        user = db.session.get(User, self.user_id)
+        user.liked_cafes.append(db.session.get(Cafe, self.cafe_id))
+        db.session.commit()
+        invalidation_bus._dispatch("likes", [self.user_id, self.cafe_id])
+
+        self.assertEqual(recommender.like_count(self.cafe_id), 1)
+        self.assertEqual(trending.top()[0][0], self.cafe_id)
+
+        user.liked_cafes.clear()
+        db.session.commit()
+        invalidation_bus._dispatch("likes", [self.user_id, self.cafe_id])
+
+        self.assertEqual(recommender.like_count(self.cafe_id), 0)
+        self.assertEqual(trending.top(), [])
+
+    def test_remote_cafe_change_keeps_trending(self):
+        db.session.add(City(code="oak", name="Oakland", state="CA"))
+        user = db.session.get(User, self.user_id)
+        user.liked_cafes.append(db.session.get(Cafe, self.cafe_id))
+        db.session.commit()
+        trending.load()
+
+        with patch.object(trending, "load") as load:
+            # edited by another worker, which then published it
+            cafe = db.session.get(Cafe, self.cafe_id)
+            cafe.description = "new-description"
+            db.session.commit()
+            invalidation_bus._dispatch("cafes", self.cafe_id)
+            self.assertEqual(trending.top()[0][0], self.cafe_id)
+
+            Cafe.query.filter_by(id=self.cafe_id).update(
+                {"city_code": "oak"})
+            invalidation_bus._dispatch("cafes", self.cafe_id)
+            self.assertEqual(trending.top(city_code="sf"), [])
+            self.assertEqual(
+                trending.top(city_code="oak")[0][0], self.cafe_id)
+
+        load.assert_not_called()
+
+    def test_trending(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            client.post('/api/like', json={"cafe_id": self.cafe_id})
+
+            resp = client.get('/api/cafes/trending')
+            self.assertEqual(
+                [(self.cafe_id, "Test Cafe")],
+                [(c["id"], c["name"]) for c in resp.json["cafes"]])
+
+            resp = client.get('/api/cafes/trending?city=oak')
+            self.assertEqual([], resp.json["cafes"])
+
+            resp = client.get('/api/cafes/trending?limit=-5')
+            self.assertEqual(1, len(resp.json["cafes"]))
+
+            resp = client.get('/cafes/trending?city=sf')
+            self.assertIn(b'Test Cafe', resp.data)
+
+    def test_reads_own_writes_from_primary(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            client.get(f'/cafes/{self.cafe_id}')
+            self.assertTrue(g.read_replica)
+
+            client.post('/api/like', json={"cafe_id": self.cafe_id})
+            self.assertIn(WROTE_AT_KEY, session)
+
+            client.get(f'/cafes/{self.cafe_id}')
+            self.assertFalse(g.read_replica)
+
+
+class LikeWriteBehindTestCase(CommittedDatabaseTestCase):
+    """Tests for liking with likes written behind."""
+
+    def setUp(self):
+        """Commit a user and a cafe, for the like buffer's connections."""
+
+        super().setUp()
+
+        user = User.register(**TEST_USER_DATA)
+        sf = City(**CITY_DATA)
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add_all([user, sf, cafe])
+
+        db.session.commit()
+
+        self.user_id = user.id
+        self.cafe_id = cafe.id
+
+    def test_write_behind(self):
+        like_buffer.enabled = True
+
+        try:
+            with app.test_client() as client:
+                login_for_test(client, self.user_id)
+                trending.load()
+                client.post('/api/like', json={"cafe_id": self.cafe_id})
+                self.assertEqual(Like.query.count(), 0)
+                # not trending until written
+                self.assertEqual(trending.top(), [])
+
+                # as if the next request went to another worker
+                like_buffer._pending.clear()
+
+                # reads write the user's buffered likes first
+                with patch.dict(QUERY_BUDGETS, {
+                        "cafes.handle_like_query": 2 + 5,
+                        "cafes.cafe_detail": 4 + 3}):
+                    resp = client.get(
+                        '/api/likes', query_string={"cafe_id": self.cafe_id})
+                    self.assertEqual({"likes": True}, resp.json)
+                    self.assertEqual(Like.query.count(), 1)
+                    self.assertEqual(trending.top()[0][0], self.cafe_id)
+
+                    client.post(
+                        '/api/unlike', json={"cafe_id": self.cafe_id})
+                    resp = client.get(f'/cafes/{self.cafe_id}')
+                    self.assertIn(b'data-liked="false"', resp.data)
+
+                like_buffer.flush()
+                self.assertEqual(Like.query.count(), 0)
+
+        finally:
+            like_buffer.enabled = False
+            like_buffer.flush()
+
+    def test_last_write_wins_across_buffers(self):
+        worker_a = LikeBuffer(app)
+        worker_b = LikeBuffer(app)
+        # the buffers write on connections of their own
+        db.session.commit()
+
+        # A's like is older than B's unlike, but flushed after it
+        worker_a.record(self.user_id, self.cafe_id, liked=True)
+        worker_b.record(self.user_id, self.cafe_id, liked=False)
+        worker_b.flush()
+        worker_a.flush()
+        self.assertEqual(Like.query.count(), 0)
+        db.session.commit()
+
+        worker_a.record(self.user_id, self.cafe_id, liked=False)
+        worker_b.record(self.user_id, self.cafe_id, liked=True)
+        worker_b.flush()
+        worker_a.flush()
+        self.assertEqual(Like.query.count(), 1)
+
+
+class LikeBufferTestCase(TestCase):
+    """Tests for queueing likes."""
+
+    def test_record(self):
+        buffer = LikeBuffer()
+
+        buffer.record(1, 10, liked=True)
+        buffer.record(1, 10, liked=False)
+        buffer.record(1, 10, liked=True)
+        buffer.record(2, 11, liked=False)
+
+        self.assertEqual(
+            {key: liked for key, (liked, stamp) in buffer._pending.items()},
+            {(1, 10): True, (2, 11): False})
+
+
+class AsyncLikeApiTestCase(CommittedDatabaseTestCase):
+    """Tests for the ASGI like endpoints."""
+
+    def setUp(self):
+        """Commit a user and a cafe, for the asyncpg pool's connections."""
+
+        super().setUp()
+
+        user = User.register(**TEST_USER_DATA)
+        sf = City(**CITY_DATA)
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add_all([user, sf, cafe])
+
+        db.session.commit()
+
+        self.user_id = user.id
+        self.cafe_id = cafe.id
+
+    def call_api(self, method, path, user_id=None, data=None, query=None):
+        """Call like API; return (status, headers, json)."""
+
+        if query is None:
+            query = f"cafe_id={self.cafe_id}"
+
+        headers = []
+        if user_id:
+            cookie = session_cookie({CURR_USER_KEY: user_id})
+            headers.append((b"cookie", cookie.encode()))
+
+        scope = {
+            "type": "http",
+            "method": method,
+            "path": path,
+            "query_string": query.encode(),
+            "headers": headers,
+        }
+        sent = []
+
+        async def receive():
+            return {"type": "http.request", "body": json.dumps(data).encode()}
+
+        async def send(message):
+            sent.append(message)
+
+        async def run():
+            await like_api(scope, receive, send)
+            await close_pool()
+
+        asyncio.run(run())
+
+        start, body = sent
+        return start["status"], dict(start["headers"]), json.loads(body["body"])
+
+    def test_not_logged_in(self):
+        status, headers, data = self.call_api("GET", "/api/likes")
+        self.assertEqual(data, {"error": "Not logged in"})
+
+    def test_like_and_unlike(self):
+        cafe_json = {"cafe_id": self.cafe_id}
+
+        status, headers, data = self.call_api(
+            "POST", "/api/like", self.user_id, cafe_json)
+        self.assertEqual(data, {"liked": self.cafe_id})
+        self.assertIn(b"set-cookie", headers)
+
+        status, headers, data = self.call_api("GET", "/api/likes", self.user_id)
+        self.assertEqual(data, {"likes": True})
+
+        status, headers, data = self.call_api(
+            "POST", "/api/unlike", self.user_id, cafe_json)
+        self.assertEqual(data, {"unliked": self.cafe_id})
+        self.assertEqual(Like.query.count(), 0)
+
+    def test_first_requests_share_pool(self):
+        async def run():
+            pools = await asyncio.gather(get_pool(), get_pool())
+            await close_pool()
+            return pools
+
+        first, second = asyncio.run(run())
+        self.assertIs(first, second)
+
+    def test_bad_cafe_id(self):
+        for query in ["", "cafe_id=", "cafe_id=abc", f"cafe_id={2 ** 31}"]:
+            status, headers, data = self.call_api(
+                "GET", "/api/likes", self.user_id, query=query)
+            self.assertEqual(status, 400)
+            self.assertEqual(data, {"error": "Invalid cafe_id"})
+
+        for body in [{}, {"cafe_id": None}, {"cafe_id": "1.5"}, [1]]:
+            status, headers, data = self.call_api(
+                "POST", "/api/like", self.user_id, body)
+            self.assertEqual(status, 400)
+
+        self.assertEqual(Like.query.count(), 0)
+
+
+class ReplicaSetTestCase(TestCase):
+    """Tests for choosing read replicas."""
+
+    def test_choose(self):
+        replica_set = ReplicaSet()
+        self.assertIsNone(replica_set.choose())
+
+        replica_set.healthy = ["a", "b"]
+        self.assertEqual(
+            [replica_set.choose() for i in range(4)],
+            ["a", "b", "a", "b"])
+
+    def test_request_reads_one_replica(self):
+        session = RoutingSession(db)
+        query = db.select(Cafe.id)
+
+        # each request has its own app context, and so its own g
+        with patch.object(replicas, "healthy", ["a", "b"]):
+            with app.app_context(), app.test_request_context():
+                g.read_replica = True
+                binds = {session.get_bind(clause=query) for i in range(3)}
+                self.assertEqual(len(binds), 1)
+
+            # the next request gets the next replica
+            with app.app_context(), app.test_request_context():
+                g.read_replica = True
+                self.assertNotIn(session.get_bind(clause=query), binds)
+
+    def test_check(self):
+        replica_set = ReplicaSet()
+        replica_set.engines = [db.engine]
+        replica_set.check()
+        self.assertEqual(replica_set.healthy, [db.engine])
+
+    def test_check_marks_failing_replica_unhealthy(self):
+        broken = MagicMock()
+        broken.connect.side_effect = TimeoutError("pool exhausted")
+
+        replica_set = ReplicaSet()
+        replica_set.engines = [broken, db.engine]
+        replica_set.healthy = [broken, db.engine]
+
+        with self.assertLogs("replicas", "WARNING"):
+            replica_set.check()
+        self.assertEqual(replica_set.healthy, [db.engine])
+
+
+class InvalidationBusTestCase(TestCase):
+    """Tests for handling cache invalidation messages."""
+
+    def setUp(self):
+        self.bus = InvalidationBus()
+        self.evicted = []
+        self.bus.subscribe("cafes")(self.evicted.append)
+
+    def message(self, id, version, origin="elsewhere"):
+        return json.dumps(
+            {"entity": "cafes", "id": id, "version": version, "origin": origin})
+
+    def test_receive(self):
+        self.bus.receive(self.message(1, 5))
+        self.bus.receive(self.message(2, 6, origin=self.bus.origin))
+        self.bus.receive(self.message(3, 4))
+
+        self.assertEqual(self.evicted, [1, 3])
+        self.assertEqual(self.bus.version, 6)
+
+    def test_catch_up(self):
+        self.bus.catch_up(10)
+        self.assertEqual(self.evicted, [])
+
+        self.bus.receive(self.message(1, 11))
+        self.bus.catch_up(11)
+        self.assertEqual(self.evicted, [1])
+
+        self.bus.catch_up(13)
+        self.assertEqual(self.evicted, [1, None])
+        self.assertEqual(self.bus.version, 13)
+
+    def test_listen(self):
+        class Received(Exception):
+            pass
+
+        def receive(payload):
+            raise Received(json.loads(payload))
+
+        publisher = InvalidationBus()
+        publisher.enabled = True
+        self.bus._app = app
+
+        # publish once listening, and stop at the first message
+        with patch.object(self.bus, "catch_up",
+                          lambda version: publisher.publish("cafes", 7)), \
+                patch.object(self.bus, "receive", receive):
+            with self.assertRaises(Received) as cm:
+                self.bus._listen()
+
+        message = cm.exception.args[0]
+        self.assertEqual((message["entity"], message["id"]), ("cafes", 7))
+        self.assertEqual(message["origin"], publisher.origin)
+
+
+class TrendingTestCase(TestCase):
+    """Tests for trending cafes."""
+
+    def setUp(self):
+        self.now = time.time()
+        self.hour = 60 * 60
+
+        self.trending = TrendingCafes(half_life_hours=1)
+        self.trending.load([
+            (1, 10, "sf", self.now - 2 * self.hour),
+            (2, 10, "sf", self.now - 2 * self.hour),
+            (1, 11, "oak", self.now),
+        ])
+
+    def test_top(self):
+        top = self.trending.top()
+        self.assertEqual([id for id, score in top], [11, 10])
+        self.assertAlmostEqual(top[0][1], 1, places=2)
+        self.assertAlmostEqual(top[1][1], 0.5, places=2)
+
+        self.assertEqual([id for id, s in self.trending.top(city_code="sf")], [10])
+
+    def test_updates(self):
+        self.trending.add_like(3, 10, "sf")
+        self.assertEqual([id for id, s in self.trending.top()], [10, 11])
+
+        self.trending.remove_like(3, 10)
+        self.trending.remove_like(1, 11)
+        self.assertEqual([id for id, s in self.trending.top()], [10])
+
+        self.trending.move_cafe(10, "oak")
+        self.assertEqual(self.trending.top(city_code="sf"), [])
+        self.assertEqual([id for id, s in self.trending.top(city_code="oak")], [10])
+
+    def test_remove_cafe(self):
+        self.trending.remove_cafe(10)
+        self.assertEqual([id for id, s in self.trending.top()], [11])
+        self.assertEqual(self.trending.top(city_code="sf"), [])
+
+        # its likes are gone too, so taking one back changes nothing
+        self.trending.remove_like(1, 10)
+        self.trending.add_like(3, 10, "sf", self.now - 4 * self.hour)
+        self.assertEqual(
+            [id for id, s in self.trending.top(city_code="sf")], [10])
+
+
+class RecommenderTestCase(TestCase):
+    """Tests for cafe recommendations."""
+
+    def test_similar(self):
+        rec = CafeRecommender(k=2)
+        rec.load([(1, 10), (1, 11), (2, 10), (2, 11), (2, 12), (3, 12)])
+
+        self.assertEqual(rec.similar(10), [(11, 1.0), (12, 0.5)])
+        self.assertEqual(rec.like_count(12), 2)
+
+    def test_incremental_updates(self):
+        rec = CafeRecommender()
+        rec.load([(1, 10), (1, 11)])
+        self.assertEqual(rec.similar(12), [])
+
+        rec.add_like(2, 10)
+        rec.add_like(2, 12)
+        self.assertEqual([id for id, score in rec.similar(12)], [10])
+
+        rec.remove_like(2, 12)
+        self.assertEqual(rec.similar(12), [])
+        self.assertEqual(rec.like_count(10), 2)
+
+
+#######################################
+# traffic capture & replay
+
+
+class TrafficRecorderTestCase(DatabaseTestCase):
+    """Tests for recording sampled request traces."""
+
+    def setUp(self):
+        """Before each test, add sample user & cafe, and record every request."""
+
+        super().setUp()
+
+        user = User.register(**TEST_USER_DATA)
+        sf = City(**CITY_DATA)
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add_all([user, sf, cafe])
+        db.session.commit()
+
+        self.user_id = user.id
+        self.cafe_id = cafe.id
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = f"{directory}/traffic.ndjson"
+
+        start_patches(
+            self,
+            patch.object(traffic_recorder, "path", self.path),
+            patch.object(traffic_recorder, "sample_rate", 1))
+
+        self.addCleanup(traffic_recorder.close)
+
+    def read_traces(self):
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_records_sanitized_traces(self):
+        with app.test_client() as client:
+            client.get("/cafes?city=sf&token=secret")
+            login_for_test(client, self.user_id)
+            client.post(
+                "/api/like", json={"cafe_id": self.cafe_id, "note": "secret"})
+
+        listing, like = self.read_traces()
+
+        self.assertEqual(listing["endpoint"], "cafes.cafe_list")
+        self.assertEqual(listing["args"], {"city": ["sf"], "token": [""]})
+        self.assertIsNone(listing["user_id"])
+        self.assertEqual(listing["status"], 200)
+
+        self.assertEqual(like["method"], "POST")
+        self.assertEqual(like["json"], {"cafe_id": self.cafe_id, "note": "<str>"})
+        self.assertEqual(like["user_id"], self.user_id)
+
+        with open(self.path, "rb") as f:
+            self.assertNotIn(b"secret", f.read())
+
+    def test_not_sampled(self):
+        with patch.object(traffic_recorder, "sample_rate", 0):
+            with app.test_client() as client:
+                client.get("/cafes")
+
+        self.assertFalse(os.path.exists(self.path))
+
+
+class ReplayTestCase(TestCase):
+    """Tests for replaying traces and comparing runs."""
+
+    def test_build_request(self):
+        req = build_request("http://localhost:8000/", {
+            "method": "POST",
+            "path": "/api/like",
+            "args": {"v": ["1", "2"]},
+            "json": {"cafe_id": 3, "note": "<str>"},
+            "user_id": 7,
+        }, cookie=lambda user_id: f"session={user_id}")
+
+        self.assertEqual(req.full_url, "http://localhost:8000/api/like?v=1&v=2")
+        self.assertEqual(json.loads(req.data), {"cafe_id": 3, "note": ""})
+        self.assertEqual(req.get_header("Cookie"), "session=7")
+
+    def test_cookie_factory(self):
+        name, value = make_cookie_factory("testing")(7).split("=", 1)
+        serializer = app.session_interface.get_signing_serializer(app)
+
+        self.assertEqual(name, app.config["SESSION_COOKIE_NAME"])
+        self.assertEqual(serializer.loads(value), {CURR_USER_KEY: 7})
+
+    def test_compare(self):
+        before = {
+            "a": {"count": 10, "p50": 10, "p95": 20},
+            "b": {"count": 10, "p50": 10, "p95": 20},
+            "c": {"count": 2, "p50": 10, "p95": 20},
+        }
+        after = {
+            "a": {"count": 10, "p50": 10.5, "p95": 21},
+            "b": {"count": 10, "p50": 10, "p95": 30},
+            "c": {"count": 2, "p50": 50, "p95": 90},
+            "d": {"count": 10, "p50": 50, "p95": 90},
+        }
+
+        self.assertEqual(
+            [endpoint for endpoint, *stats in compare(before, after)], ["b"])
@@ -0,0 +1,141 @@
+"""Record a sample of live requests, to replay later with replay.py."""
+
+import json
+import os
+import random
+import threading
+import time
+
+from flask import g, request, session
+
+
+# app.CURR_USER_KEY
+USER_KEY = "curr_user"
+
+# query args whose values are never recorded
+SENSITIVE_ARGS = {"password", "token", "csrf_token", "email"}
+
+# stands in for every string in recorded JSON and form bodies
+STRING = "<str>"
+
+
+def body_shape(value):
+    """Return value with each string replaced by STRING.
+
+    Numbers, booleans and nulls are kept (replays need ids), as is the
+    structure of lists and objects.
+    """
+
+    if isinstance(value, dict):
+        return {key: body_shape(item) for key, item in value.items()}
+
+    if isinstance(value, list):
+        return [body_shape(item) for item in value]
+
+    if isinstance(value, str):
+        return STRING
+
+    return value
+
+
+class TrafficRecorder:
+    """Sanitized traces of sampled requests, appended to an NDJSON file.
+
+    Each line holds a request's time, method, path, endpoint, query args,
+    the shape of its JSON or form body (see body_shape), the logged-in user
+    id, response status and how long the view took. Every worker appends
+    to the same file.
+
+    Records TRAFFIC_SAMPLE_RATE of requests once TRAFFIC_CAPTURE_PATH is
+    set; off otherwise.
+    """
+
+    def __init__(self, app=None):
+        self.path = None
+        self.sample_rate = 0.01
+        self._file = None
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("TRAFFIC_CAPTURE_PATH", None)
+        app.config.setdefault("TRAFFIC_SAMPLE_RATE", 0.01)
+
+        self.path = app.config["TRAFFIC_CAPTURE_PATH"]
+        self.sample_rate = app.config["TRAFFIC_SAMPLE_RATE"]
+
+        app.before_request(self._start)
+        app.after_request(self._record)
+
+    def after_fork(self):
+        """In a forked child: open the file afresh."""
+
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        if self.path and random.random() < self.sample_rate:
+            g.traffic_started = (time.time(), time.perf_counter())
+        else:
+            g.traffic_started = None
+
+    def _record(self, resp):
+        started = g.get("traffic_started")
+
+        if started is not None:
+            started_at, started_counter = started
+            self.write(trace(resp, started_at, started_counter))
+
+        return resp
+
+    def write(self, data):
+        """Append trace to file in one write, so workers don't interleave."""
+
+        line = (json.dumps(data, separators=(",", ":")) + "\n").encode()
+
+        with self._lock:
+            if self._file is None:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self._file = open(self.path, "ab", buffering=0)
+
+            self._file.write(line)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+traffic_recorder = TrafficRecorder()
+
+
+def trace(resp, started_at, started_counter):
+    """Return dict describing the current request and its response."""
+
+    args = {
+        key: ["" if key in SENSITIVE_ARGS else value for value in values]
+        for key, values in request.args.lists()
+    }
+
+    data = {
+        "ts": round(started_at, 3),
+        "method": request.method,
+        "path": request.path,
+        "endpoint": request.endpoint,
+        "args": args,
+        "user_id": session.get(USER_KEY),
+        "status": resp.status_code,
+        "ms": round((time.perf_counter() - started_counter) * 1000, 2),
+    }
+
+    if request.is_json:
+        data["json"] = body_shape(request.get_json(silent=True))
+    elif request.form:
+        data["form"] = {key: STRING for key in request.form}
+
+    return data
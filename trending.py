@@ -0,0 +1,211 @@
+"""Trending cafes, ranked by time-decayed like counts."""
+
+import math
+import threading
+import time
+from bisect import bisect_left, insort
+from datetime import timezone
+
+from models import db, Cafe, Like
+
+
+HALF_LIFE_HOURS = 72
+
+# rebase scores before exp() gets anywhere near overflowing a float
+MAX_EXPONENT = 500
+
+
+def _timestamp(when):
+    """Return POSIX timestamp for a naive UTC datetime (or a number)."""
+
+    if isinstance(when, (int, float)):
+        return when
+
+    return when.replace(tzinfo=timezone.utc).timestamp()
+
+
+class TrendingCafes:
+    """Cafes ranked by likes, each like's weight halving every half-life.
+
+    This uses forward decay: a like at time t adds e^(rate * (t - landmark))
+    to its cafe's score. Every score decays at the same rate, so the order
+    of cafes never changes just because time passes; only likes and unlikes
+    move a cafe. Rankings are kept in sorted lists, one across all cafes and
+    one per city, so the top N is a slice.
+
+    The index is loaded from the likes table on first use.
+    """
+
+    def __init__(self, half_life_hours=HALF_LIFE_HOURS):
+        self.rate = math.log(2) / (half_life_hours * 60 * 60)
+        self._lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        """Forget everything; the index is reloaded on next use."""
+
+        with self._lock:
+            self._loaded = False
+            self._landmark = time.time()
+            self._scores = {}
+            self._counts = {}
+            self._cities = {}
+            self._like_times = {}
+            # None (all cafes) or city code -> sorted [(-score, cafe_id)]
+            self._ranked = {None: []}
+
+    def load(self, likes=None):
+        """Build index from (user_id, cafe_id, city_code, created_at) rows.
+
+        likes defaults to every row of the likes table.
+        """
+
+        with self._lock:
+            if likes is None:
+                likes = db.session.execute(
+                    db.select(
+                        Like.user_id,
+                        Like.cafe_id,
+                        Cafe.city_code,
+                        Like.created_at)
+                    .join(Cafe, Cafe.id == Like.cafe_id)
+                    .order_by(Like.created_at)
+                ).all()
+
+            self.reset()
+
+            for user_id, cafe_id, city_code, created_at in likes:
+                self._add(user_id, cafe_id, city_code, _timestamp(created_at))
+
+            self._loaded = True
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+
+    def _rebase(self, landmark):
+        """Move landmark forward, shrinking all scores to match."""
+
+        factor = math.exp(-self.rate * (landmark - self._landmark))
+        self._landmark = landmark
+        self._scores = {id: s * factor for id, s in self._scores.items()}
+        self._ranked = {
+            scope: [(s * factor, id) for s, id in ranked]
+            for scope, ranked in self._ranked.items()
+        }
+
+    def _weight(self, when):
+        exponent = self.rate * (when - self._landmark)
+
+        if exponent > MAX_EXPONENT:
+            self._rebase(when)
+            exponent = 0
+
+        return math.exp(exponent)
+
+    def _unrank(self, cafe_id):
+        score = self._scores.get(cafe_id)
+        if score is None:
+            return
+
+        for scope in (None, self._cities.get(cafe_id)):
+            ranked = self._ranked[scope]
+            i = bisect_left(ranked, (-score, cafe_id))
+            if i < len(ranked) and ranked[i][1] == cafe_id:
+                del ranked[i]
+
+    def _rank(self, cafe_id):
+        if not self._counts.get(cafe_id):
+            self._scores.pop(cafe_id, None)
+            return
+
+        entry = (-self._scores[cafe_id], cafe_id)
+
+        for scope in (None, self._cities.get(cafe_id)):
+            insort(self._ranked.setdefault(scope, []), entry)
+
+    def _add(self, user_id, cafe_id, city_code, when):
+        if (user_id, cafe_id) in self._like_times:
+            return
+
+        weight = self._weight(when)
+
+        self._unrank(cafe_id)
+        self._cities[cafe_id] = city_code
+        self._like_times[(user_id, cafe_id)] = when
+        self._scores[cafe_id] = self._scores.get(cafe_id, 0) + weight
+        self._counts[cafe_id] = self._counts.get(cafe_id, 0) + 1
+        self._rank(cafe_id)
+
+    def add_like(self, user_id, cafe_id, city_code, when=None):
+        """Record like at when (default: now). (No-op until loaded.)"""
+
+        with self._lock:
+            if self._loaded:
+                self._add(
+                    user_id,
+                    cafe_id,
+                    city_code,
+                    time.time() if when is None else _timestamp(when))
+
+    def remove_like(self, user_id, cafe_id):
+        """Take back the weight of a like. (No-op until loaded.)"""
+
+        with self._lock:
+            if not self._loaded:
+                return
+
+            when = self._like_times.pop((user_id, cafe_id), None)
+            if when is None:
+                return
+
+            self._unrank(cafe_id)
+            self._scores[cafe_id] -= math.exp(
+                self.rate * (when - self._landmark))
+            self._counts[cafe_id] -= 1
+            self._rank(cafe_id)
+
+    def move_cafe(self, cafe_id, city_code):
+        """Record that cafe is now in another city."""
+
+        with self._lock:
+            if cafe_id not in self._cities:
+                return
+
+            self._unrank(cafe_id)
+            self._cities[cafe_id] = city_code
+            self._rank(cafe_id)
+
+    def remove_cafe(self, cafe_id):
+        """Forget a deleted cafe and its likes."""
+
+        with self._lock:
+            if cafe_id not in self._cities:
+                return
+
+            self._unrank(cafe_id)
+            self._scores.pop(cafe_id, None)
+            self._counts.pop(cafe_id, None)
+            del self._cities[cafe_id]
+            self._like_times = {
+                key: when for key, when in self._like_times.items()
+                if key[1] != cafe_id
+            }
+
+    def top(self, n=10, city_code=None):
+        """Return up to n [(cafe_id, score), ...], highest first.
+
+        Scores are in units of "likes made just now"; city_code limits the
+        ranking to one city.
+        """
+
+        self._ensure_loaded()
+
+        with self._lock:
+            decay = math.exp(-self.rate * (time.time() - self._landmark))
+            ranked = self._ranked.get(city_code, [])
+
+            return [(id, -score * decay) for score, id in ranked[:n]]
+
+
+trending = TrendingCafes()